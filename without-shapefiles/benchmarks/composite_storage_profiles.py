@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+@brief Compare the storage profiles for composite netCDF files (functions.template.STORAGE_PROFILES). For each profile
+a set of daily composite files is written, and the file size, the time to read a full map and the time to read the
+window around each buoy (+/- 2 degrees, as in functions.common.append_satellite_sst_data) are reported
+@usage
+template_file: composite template
+sst_file: existing composite whose sst field is written to every test file, or None for a synthetic field with
+cloud gaps
+n_files: number of daily files written per profile (window reads are timed over all of them, like a buoy time series)
+buoys: window centers (lon, lat)
+work_dir: directory the test files are written to (removed afterwards)
+Files that were just written are read back from the page cache; use more files than fit in memory, or drop the
+caches between profiles, for cold-read numbers
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from netCDF4 import Dataset
+import functions.template as tp
+
+
+def synthetic_sst(template, seed=0):
+    # smooth large-scale field with small-scale noise and cloud gaps, so that compression is representative
+    lon = template.static_data['lon']
+    lat = template.static_data['lat']
+    rs = np.random.RandomState(seed)
+    sst = (25 - 0.6 * (lat[:, None] - np.min(lat)) + np.sin(np.radians(lon[None, :]) * 20)
+           + rs.normal(0, 0.2, (len(lat), len(lon))))
+    clouds = rs.rand(len(lat) // 16 + 1, len(lon) // 16 + 1) < 0.3
+    sst[np.repeat(np.repeat(clouds, 16, axis=0), 16, axis=1)[:len(lat), :len(lon)]] = np.nan
+    if 'mask' in template.static_data:
+        sst[np.ma.filled(template.static_data['mask'], 1) == 1] = np.nan
+    return sst.astype('f4')
+
+
+def window_index(template, buoy, half_width=2):
+    lon = template.static_data['lon']
+    lat = template.static_data['lat']
+    lon_ind = np.flatnonzero(np.logical_and(lon > buoy[0] - half_width, lon < buoy[0] + half_width))
+    lat_ind = np.flatnonzero(np.logical_and(lat > buoy[1] - half_width, lat < buoy[1] + half_width))
+    if len(lon_ind) == 0 or len(lat_ind) == 0:
+        return None
+    return slice(lat_ind[0], lat_ind[-1] + 1), slice(lon_ind[0], lon_ind[-1] + 1)
+
+
+def benchmark_profile(template, profile, sst, n_files, windows, work_dir):
+    files = [os.path.join(work_dir, 'composite_{:03d}.nc'.format(n)) for n in range(n_files)]
+    t0 = time.time()
+    for n, f in enumerate(files):
+        day_sst = sst + np.float32(0.01 * n)
+        day_sst[np.isnan(day_sst)] = -999
+        with template.new_file(f, profile=profile) as nc:
+            nc.variables['sst'][0, 0, :, :] = day_sst
+    write_time = (time.time() - t0) / n_files
+
+    with Dataset(files[0], 'r') as nc:
+        chunks = nc.variables['sst'].chunking()
+
+    t0 = time.time()
+    for f in files:
+        with Dataset(f, 'r') as nc:
+            nc.variables['sst'][0, 0, :, :]
+    map_time = (time.time() - t0) / n_files
+
+    # time each window read (open, read, close) separately
+    window_times = []
+    for ys, xs in windows:
+        for f in files:
+            t0 = time.time()
+            with Dataset(f, 'r') as nc:
+                nc.variables['sst'][:, :, ys, xs]
+            window_times.append(time.time() - t0)
+
+    return dict(profile='template' if profile is None else profile, chunks=chunks,
+                size=np.mean([os.path.getsize(f) for f in files]), write_time=write_time, map_time=map_time,
+                window_median=np.median(window_times), window_p95=np.percentile(window_times, 95))
+
+
+def main(template_file, sst_file, n_files, buoys, work_dir, profiles):
+    template = tp.get_template(template_file)
+    if sst_file is None:
+        sst = synthetic_sst(template)
+    else:
+        with Dataset(sst_file, 'r') as nc:
+            sst = np.ma.filled(nc.variables['sst'][0, 0, :, :].astype('f4'), np.nan)
+        sst[sst == -999] = np.nan
+
+    windows = [w for w in [window_index(template, b) for b in buoys] if w is not None]
+    print('grid {} x {}, {} files per profile, {} buoy windows ({})'.format(
+        len(template.static_data['lat']), len(template.static_data['lon']), n_files, len(windows),
+        ', '.join(['{}x{}'.format(ys.stop - ys.start, xs.stop - xs.start) for ys, xs in windows])))
+
+    results = []
+    for profile in profiles:
+        profile_dir = tempfile.mkdtemp(dir=work_dir)
+        try:
+            results.append(benchmark_profile(template, profile, sst, n_files, windows, profile_dir))
+        finally:
+            shutil.rmtree(profile_dir)
+
+    print('\n{:<10} {:<18} {:>10} {:>10} {:>10} {:>12} {:>12}'.format('profile', 'sst chunks', 'size (MB)',
+                                                                    'write (s)', 'map (ms)', 'window (ms)',
+                                                                    'p95 (ms)'))
+    for r in results:
+        print('{:<10} {:<18} {:>10.2f} {:>10.3f} {:>10.1f} {:>12.2f} {:>12.2f}'.format(
+            r['profile'], str(r['chunks']), r['size'] / 1e6, r['write_time'], r['map_time'] * 1e3,
+            r['window_median'] * 1e3, r['window_p95'] * 1e3))
+
+
+if __name__ == '__main__':
+    template_file = '/home/coolgroup/bpu/wrf/data/daily_avhrr/templates/wrf_9km_template.nc'
+    sst_file = None  # e.g. an existing composite: '/home/coolgroup/bpu/wrf/data/daily_avhrr/composites/2018/avhrr_coldest-pixel_20180701.nc'
+    n_files = 30
+    # window centers (lon, lat), e.g. NDBC buoys 44009, 44065 and 44025
+    buoys = [(-74.70, 38.46), (-73.70, 40.37), (-73.16, 40.25)]
+    work_dir = tempfile.gettempdir()
+    profiles = [None, 'map', 'balanced', 'point']  # None: chunking and compression of the template
+    main(template_file, sst_file, n_files, buoys, work_dir, profiles)
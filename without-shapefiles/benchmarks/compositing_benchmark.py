@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""
+@brief Time the coldest pixel compositors (daily, daily with worker processes, historical, historical tile by tile
+and reprocess) on synthetic AVHRR passes (see synthetic_avhrr.py). Each case runs in a fresh Python process, and passes
+per second, peak resident memory and bytes read are reported
+@usage
+work_dir: directory the synthetic data and the composites are written to (removed afterwards unless keep is True)
+start_date: first day of passes
+n_days: number of days of passes; each case composites all of them
+passes_per_day: number of synthetic passes per day
+nlon, nlat: size of the composite grid
+Peak RSS is the largest of the case process and its worker processes (Linux and macOS). Bytes read are the bytes the
+case process and its workers read through read system calls (rchar in /proc/<pid>/io, Linux only), which includes
+reads served from the page cache. The passes are written just before the runs, so the cases read warm files
+"""
+
+from sys import argv
+import os
+import pickle
+import resource
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from netCDF4 import Dataset
+import functions.common as cf
+import functions.regrid as rg
+import synthetic_avhrr as sa
+
+coldest_pixel_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'coldest_pixel')
+
+
+def proc_io():
+    # bytes read by this process and its reaped children, None where /proc/self/io isn't available
+    try:
+        with open('/proc/self/io') as f:
+            io = dict([line.split(':') for line in f.read().splitlines()])
+    except OSError:
+        return None
+    return int(io['rchar'])
+
+
+def measure(case_file):
+    """
+    Run one case in this process and write its elapsed time, peak RSS and bytes read back to case_file. Cases either
+    run a script as __main__ with the given argv, or load the script as a module and call its main(*args)
+    """
+    with open(case_file, 'rb') as f:
+        case = pickle.load(f)
+    rchar0 = proc_io()
+    t0 = time.time()
+    if 'argv' in case:
+        sys.argv = [case['script']] + case['argv']
+        try:
+            runpy.run_path(case['script'], run_name='__main__')
+        except SystemExit:
+            pass
+    else:
+        runpy.run_path(case['script'], run_name='benchmark')['main'](*case['args'])
+    elapsed = time.time() - t0
+    rchar1 = proc_io()
+
+    # ru_maxrss is in kB on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    maxrss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                 resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+    stats = dict(elapsed=elapsed, maxrss=maxrss, rchar=None if rchar0 is None else rchar1 - rchar0)
+    with open(case_file, 'wb') as f:
+        pickle.dump(stats, f)
+
+
+def run_case(case, work_dir):
+    # run a case in a fresh interpreter, so that memory and I/O of earlier cases aren't counted
+    fd, case_file = tempfile.mkstemp(suffix='.pkl', dir=work_dir)
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump(case, f)
+    try:
+        subprocess.run([sys.executable, os.path.abspath(__file__), 'measure', case_file], check=True,
+                       stdout=subprocess.DEVNULL, cwd=work_dir)
+        with open(case_file, 'rb') as f:
+            return pickle.load(f)
+    finally:
+        os.remove(case_file)
+
+
+def count_passes(files):
+    # passes in the composites, from the included_passes of each file
+    n = 0
+    for f in files:
+        with Dataset(f, 'r') as nc:
+            pass_info = str(nc.variables['included_passes'][0])
+        n += len([p for p in pass_info.split(',') if p.strip() != ''])
+    return n
+
+
+def main(work_dir, start_date, n_days, passes_per_day, nlon, nlat, keep=False):
+    start_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    days = [start_date + timedelta(n) for n in range(n_days)]
+    template_file = os.path.join(work_dir, 'composite_template.nc')
+    avhrr_dir = os.path.join(work_dir, 'avhrr_nc')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    t0 = time.time()
+    sa.write_template(template_file, nlon=nlon, nlat=nlat)
+    pass_files = sa.make_passes(avhrr_dir, start_date, n_days, passes_per_day)
+    print('{} synthetic passes ({:.1f} MB) on a {} x {} grid written in {:.1f} s'.format(
+        len(pass_files), sum([os.path.getsize(f) for f in pass_files]) / 1e6, nlat, nlon, time.time() - t0))
+
+    daily_script = os.path.join(coldest_pixel_dir, 'DailyAvhrrColdestPixelComposite_DaylightWindow.py')
+    historical_script = os.path.join(coldest_pixel_dir, 'DailyAvhrrColdestPixelComposite_DaylightWindow_historical.py')
+    reprocess_script = os.path.join(coldest_pixel_dir, 'DailyAvhrrColdestPixelComposite_DaylightWindow_reprocess.py')
+    dates = [d.strftime('%m-%d-%Y') for d in days]
+
+    # each case: name, script runs, output directory. The reprocess case updates a copy of the daily composites
+    cases = []
+    for name, options in [('daily', []), ('daily workers=4', ['workers=4'])]:
+        out_dir = os.path.join(work_dir, name.replace(' ', '_').replace('=', ''))
+        runs = [dict(script=daily_script, argv=[template_file, avhrr_dir, out_dir, d, '0', '24'] + options)
+                for d in dates]
+        cases.append((name, runs, out_dir))
+    # the historical runs use a single process, so that all reads are counted in the case process
+    for name, tile_size in [('historical', None), ('historical tiled', (64, 64))]:
+        out_dir = os.path.join(work_dir, name.replace(' ', '_'))
+        args = (template_file, avhrr_dir, os.path.join(out_dir, 'avhrr_passes.db'), out_dir,
+                rg.template_cache_dir(template_file), days[0], days[-1] + timedelta(days=1), 1, 0, tile_size)
+        cases.append((name, [dict(script=historical_script, args=args)], os.path.join(out_dir, str(days[0].year))))
+    out_dir = os.path.join(work_dir, 'reprocess')
+    cases.append(('reprocess', [dict(script=reprocess_script, argv=[template_file, avhrr_dir, out_dir, d, '0', '24'])
+                                for d in dates], out_dir))
+
+    results = []
+    try:
+        for name, runs, out_dir in cases:
+            if name == 'reprocess':
+                shutil.copytree(os.path.join(work_dir, 'daily'), out_dir)
+            else:
+                cf.create_dir(out_dir)
+            stats = [run_case(run, work_dir) for run in runs]
+            out_files = [os.path.join(out_dir, 'avhrr_coldest-pixel_{}.nc'.format(d.strftime('%Y%m%d'))) for d in days]
+            elapsed = sum([s['elapsed'] for s in stats])
+            rchar = None if stats[0]['rchar'] is None else sum([s['rchar'] for s in stats])
+            results.append(dict(name=name, elapsed=elapsed, maxrss=max([s['maxrss'] for s in stats]), rchar=rchar,
+                                n_passes=count_passes(out_files)))
+            print('{}: {:.1f} s'.format(name, elapsed))
+    finally:
+        if not keep:
+            shutil.rmtree(work_dir)
+
+    print('\n{:<18} {:>8} {:>10} {:>12} {:>14} {:>14}'.format('case', 'passes', 'time (s)', 'passes/sec',
+                                                              'peak RSS (MB)', 'read (MB)'))
+    for r in results:
+        print('{:<18} {:>8} {:>10.2f} {:>12.2f} {:>14.1f} {:>14}'.format(
+            r['name'], r['n_passes'], r['elapsed'], r['n_passes'] / r['elapsed'], r['maxrss'] / 1e6,
+            'n/a' if r['rchar'] is None else '{:.1f}'.format(r['rchar'] / 1e6)))
+
+
+if __name__ == '__main__':
+    if len(argv) == 3 and argv[1] == 'measure':
+        measure(argv[2])
+    else:
+        work_dir = os.path.join(tempfile.gettempdir(), 'compositing_benchmark')
+        start_date = datetime(2018, 7, 1)
+        n_days = 2
+        passes_per_day = 12
+        nlon, nlat = 300, 200
+        main(work_dir, start_date, n_days, passes_per_day, nlon, nlat)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""
+@brief Write synthetic AVHRR single-pass files (YYMMDD.DOY.HHMM.nNN.BPU.CF.nc) and a matching composite template, so
+that the compositors can be run and benchmarked without the real pass archive. Like the real files, the passes have
+1D lon/lat axes with masked (fill value) points at the edges, descending axes, -999 fills for clouds and a footprint
+that only partly overlaps the composite domain; some passes miss the domain entirely and some are fully cloudy
+@usage
+out_dir: directory the template (composite_template.nc) and the passes (out_dir/avhrr_nc/) are written to
+start_date: first day of passes
+n_days: number of days of passes
+passes_per_day: number of passes per day, at random times
+"""
+
+import os
+from datetime import datetime, timedelta
+import numpy as np
+from netCDF4 import Dataset
+import functions.coldest_pixel as cp
+import functions.template as tp
+
+
+# composite domain of the coldest pixel template (see coldest_pixel/ColdestPixelTemplate.py)
+DOMAIN = [-83.25, -56.9, 31, 47.33]
+
+
+def write_template(template_file, nlon=300, nlat=200, domain=DOMAIN, profile=None):
+    """
+    Composite template with the variables of coldest_pixel/ColdestPixelTemplate.py on a regular grid over domain
+    :param nlon: number of grid longitudes
+    :param nlat: number of grid latitudes
+    :param profile: optional storage profile for the gridded variables (see functions.template.STORAGE_PROFILES)
+    """
+    temp = Dataset(template_file, 'w', format='NETCDF4')
+    temp.createDimension('lat', nlat)
+    temp.createDimension('lon', nlon)
+    temp.createDimension('time', None)
+    temp.createDimension('z', 1)
+
+    time_var = temp.createVariable('time', 'f8', ('time',), zlib=True, least_significant_digit=0)
+    time_var.units = 'seconds since 1981-01-01 00:00:00 UTC'
+    time_var.calendar = 'gregorian'
+    temp.createVariable('lon', 'f4', ('lon',))[:] = np.linspace(domain[0], domain[1], nlon)
+    temp.createVariable('lat', 'f4', ('lat',))[:] = np.linspace(domain[2], domain[3], nlat)
+    temp.createVariable('z', 'f4', ('z',))[:] = 0
+    mask = temp.createVariable('mask', 'i1', ('lat', 'lon'), **tp.storage_options(profile, (nlat, nlon)))
+    # land in the north-west corner
+    lon_idx, lat_idx = np.arange(nlon)[None, :], np.arange(nlat)[:, None]
+    mask[:, :] = np.logical_and(lon_idx < nlon // 4, lat_idx > nlat // 2).astype('i1')
+    temp.createVariable('sst', 'f4', ('time', 'z', 'lat', 'lon'), fill_value=-999,
+                        **tp.storage_options(profile, (1, 1, nlat, nlon)))
+    temp.createVariable('sst_qc_flag', 'i4', ('time', 'z', 'lat', 'lon'), fill_value=-1,
+                        **tp.storage_options(profile, (1, 1, nlat, nlon)))
+    temp.createVariable('platform', str, (), zlib=True, complevel=4)[0] = 'NOAA-AVHRR'
+    temp.createVariable('composite_start_time', 'i1', ('time',), fill_value=-1, zlib=True, complevel=4)
+    temp.createVariable('composite_end_time', 'i1', ('time',), fill_value=-1, zlib=True, complevel=4)
+    temp.createVariable('included_passes', str, ('time',), fill_value='none', zlib=True, complevel=4)
+    temp.createVariable('minimum_sun_angle', 'i1', ('time',), fill_value=-99, zlib=True, complevel=4)
+    cp.add_provenance_variables(temp)
+
+    temp.title = 'Daily Daylight-Hours AVHRR Coldest Pixel Composite (synthetic)'
+    temp.history = ''
+    temp.date_created = ''
+    temp.contributor_name = 'synthetic'
+    temp.contributor_role = 'benchmark'
+    temp.time_coverage_duration = '1 day'
+    temp.close()
+
+
+def write_pass(avhrr_file, lon, lat, sst):
+    """
+    Write a pass in the layout of the real files: lon(lon), lat(lat) and mcsst(time, lat, lon), with -999 fills
+    :param lon: 1D longitudes, masked where there is no coordinate
+    :param lat: 1D latitudes, masked where there is no coordinate
+    :param sst: 2D (lat, lon) SST, nans where cloudy
+    """
+    avhrr_data = Dataset(avhrr_file, 'w', format='NETCDF4')
+    avhrr_data.createDimension('time', 1)
+    avhrr_data.createDimension('lat', len(lat))
+    avhrr_data.createDimension('lon', len(lon))
+    avhrr_data.createVariable('lon', 'f4', ('lon',), fill_value=-999.)[:] = lon
+    avhrr_data.createVariable('lat', 'f4', ('lat',), fill_value=-999.)[:] = lat
+    mcsst = avhrr_data.createVariable('mcsst', 'f4', ('time', 'lat', 'lon'), fill_value=-999., zlib=True)
+    sst = np.where(np.isnan(sst), -999, sst).astype('f4')
+    mcsst[0, :, :] = sst
+    avhrr_data.close()
+
+
+def synthetic_pass(rs, width=15., height=12., resolution=0.02, domain=DOMAIN, cloud_fraction=0.4):
+    """
+    Coordinates and SST of one synthetic pass: a width x height degree swath at a random position around domain,
+    with descending axes, a few masked coordinates at the edges, a smooth SST field and blobby clouds
+    :param rs: numpy RandomState
+    :param resolution: grid spacing (degrees)
+    :param cloud_fraction: approximate fraction of cloudy (-999) pixels
+    :return: lon, lat (1D, masked), sst (2D, nans where cloudy)
+    """
+    lon0 = rs.uniform(domain[0] - width, domain[1])
+    lat0 = rs.uniform(domain[2] - height * 0.75, domain[3] - height * 0.25)
+    lon = np.arange(lon0, lon0 + width, resolution)[::-1]
+    lat = np.arange(lat0, lat0 + height, resolution)[::-1]
+
+    # SST decreasing to the north with eddies and noise
+    sst = (28 - 0.7 * (lat[:, None] - domain[2]) + 1.5 * np.sin(np.radians(lon[None, :]) * 40)
+           * np.cos(np.radians(lat[:, None]) * 30) + rs.normal(0, 0.15, (len(lat), len(lon))))
+    # clouds from a coarse random field, upsampled
+    coarse = rs.rand(len(lat) // 25 + 2, len(lon) // 25 + 2) < cloud_fraction
+    clouds = np.repeat(np.repeat(coarse, 25, axis=0), 25, axis=1)[:len(lat), :len(lon)]
+    sst[clouds] = np.nan
+
+    # missing coordinates at the swath edges
+    lon = np.ma.masked_array(lon, mask=np.arange(len(lon)) < rs.randint(1, 5))
+    lat = np.ma.masked_array(lat, mask=np.arange(len(lat)) >= len(lat) - rs.randint(0, 3))
+    return lon, lat, sst
+
+
+def make_passes(avhrr_dir, start_date, n_days, passes_per_day, seed=0, resolution=0.02, domain=DOMAIN):
+    """
+    Write passes_per_day synthetic passes for each of n_days days. About one pass in ten is fully cloudy
+    :return: list of pass files
+    """
+    if not os.path.isdir(avhrr_dir):
+        os.makedirs(avhrr_dir)
+    rs = np.random.RandomState(seed)
+    files = []
+    for n in range(n_days):
+        d = start_date + timedelta(days=n)
+        for hm in sorted(rs.choice(24 * 60, passes_per_day, replace=False)):
+            satellite = str(rs.choice(['15', '18', '19']))
+            avhrr_file = os.path.join(avhrr_dir, cp.pass_file_name(d, '{:02d}'.format(hm // 60),
+                                                                   '{:02d}'.format(hm % 60), satellite))
+            cloud_fraction = 1.01 if rs.rand() < 0.1 else rs.uniform(0.2, 0.8)
+            write_pass(avhrr_file, *synthetic_pass(rs, resolution=resolution, domain=domain,
+                                                   cloud_fraction=cloud_fraction))
+            files.append(avhrr_file)
+    return files
+
+
+def main(out_dir, start_date, n_days, passes_per_day):
+    template_file = os.path.join(out_dir, 'composite_template.nc')
+    write_template(template_file)
+    files = make_passes(os.path.join(out_dir, 'avhrr_nc'), start_date, n_days, passes_per_day)
+    print('Wrote {} and {} passes to {}'.format(template_file, len(files), os.path.join(out_dir, 'avhrr_nc')))
+
+
+if __name__ == '__main__':
+    out_dir = '/tmp/synthetic_avhrr'
+    start_date = datetime(2018, 7, 1)
+    n_days = 3
+    passes_per_day = 12
+    main(out_dir, start_date, n_days, passes_per_day)
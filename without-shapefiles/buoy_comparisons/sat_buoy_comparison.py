@@ -4,10 +4,12 @@
 @modified by Lori Garzio on 1/16/2019
 @brief compare buoy data with satellite SST data
 @usage
-sDir: location to save plots
+sDir: location to save plots and the neighbour tables of the buoys
 avgrad: radius around the buoy from which to grab satellite data. options: x (average all data within radius x km of
 the buoy), 'closest' (grabs the closest data point), 'closestiwithinx' (get the closest non-nan measurement as long as
-it is within x km of the buoy
+it is within x km of the buoy), or a list of options, which are all evaluated from a single read of each file (the
+plots use the first one). The daily SST of every option is written to <buoy>_sst_matchups_<t0>-<t1>.csv, one column
+per product and option, so that a sensitivity study takes a single run
 models: list of models to plot. options: WRFsport_avhrr = plot all three models along with buoy data, WRFonly = plot
 WRF input only along with buoy data, WRFsport = plot WRF input and SPoRT models along with buoy data
 buoys: list of buoys
@@ -23,12 +25,8 @@ import glob
 import os
 import functions.common as cf
 import functions.plotting as pf
-
-
-def initialize_empty_array(time_array):
-    empty_array = np.empty(np.shape(time_array))
-    empty_array[:] = np.nan
-    return empty_array
+import functions.grid_index as gi
+import functions.sst_cube as sc
 
 
 def plot_avhrr(axis, x, y):
@@ -62,6 +60,7 @@ def plot_wrf_input(axis, x, y):
 
 
 def main(t0, t1, buoys, avgrad, sDir, models):
+    index_cache_dir = gi.table_cache_dir(sDir)
     bpudatadir = '/Volumes/boardwalk/coolgroup/bpu/wrf/data/'
 
     if not isinstance(t0, int):  # if t0 is not integer, define date
@@ -87,7 +86,8 @@ def main(t0, t1, buoys, avgrad, sDir, models):
     all_years = np.unique(times.year)  ###########  make this an input option ######################
     all_years = np.append(all_years, 9999)  # 9999 buoy year is for 'real-time' data (past 45 days)
 
-    # get buoy SST data
+    # get buoy SST data and locations
+    buoy_data = dict()
     for buoy in buoys:
         buoy_dict = cf.get_buoy_data(buoy, all_years, t0, t1)
 
@@ -101,57 +101,76 @@ def main(t0, t1, buoys, avgrad, sDir, models):
             buoy_status = 'all_nans'
         else:
             buoy_status = 'valid'
+        buoy_data[buoy] = dict(full=buoy_full, daily=buoy_daily, status=buoy_status, lon=buoy_dict['lon'],
+                               lat=buoy_dict['lat'])
+
+    # buoys with a location
+    located = [b for b in buoys if type(buoy_data[b]['lon']) == np.float32 and type(buoy_data[b]['lat']) == np.float32]
+    buoylons = [buoy_data[b]['lon'] for b in located]
+    buoylats = [buoy_data[b]['lat'] for b in located]
+    avgrads = avgrad if isinstance(avgrad, list) else [avgrad]
+
+    # SST "at" each buoy (buoys, times, averaging options) from the daily AVHRR-only coldest pixel composite, the 3-day
+    # AVHRR + SPoRT coldest pixel composite (WRF input) and SPoRT (on server). Each file is opened once for all buoys
+    # and averaging options
+    coldsst_all = np.full((len(located), len(times), len(avgrads)), np.nan)
+    coldsportsst_all = np.full((len(located), len(times), len(avgrads)), np.nan)
+    sportsst_all = np.full((len(located), len(times), len(avgrads)), np.nan)
+
+    if len(located) > 0:
+        # daily AVHRR coldest pixel composite: the pixels around the buoys are read from all the days at once
+        satfiles = ['{}daily_avhrr/composites/{}/avhrr_coldest-pixel_{}.nc'.format(bpudatadir, t.strftime('%Y'),
+                                                                                   t.strftime('%Y%m%d')) for t in times]
+        cube = sc.extract_sst_cube(satfiles, buoylats, buoylons, 'daily_avhrr', 'sst', radii=avgrads, times=times,
+                                   index_cache_dir=index_cache_dir)
+        coldsst_all = cube.average_rules(avgrads)
+
+        for i, t in enumerate(times):
+            #  3-day AVHRR + SPoRT coldest pixel composite (WRF input)
+            if t >= datetime.strptime('01-01-2017', '%m-%d-%Y'):
+                sat_pre = bpudatadir + 'composites/procdate_'
+            else:
+                sat_pre = bpudatadir + 'composites/archive_no_time_field/sport_'
+            spcomp_file = glob.glob(sat_pre + t.strftime('%Y%m%d') + '*.nc')
+            if len(spcomp_file) == 1:
+                try:
+                    coldsportsst_all[:, i] = cf.extract_satellite_sst(spcomp_file[0], buoylats, buoylons, avgrads,
+                                                                      'cold_sport', 'sst',
+                                                                      index_cache_dir=index_cache_dir)
+                except:
+                    print('Issue reading from {}'.format(spcomp_file[0]))
 
-        buoylon = buoy_dict['lon']
-        buoylat = buoy_dict['lat']
-
-        # array for SST "at" buoy from daily AVHRR-only coldest pixel composite
-        coldsst = initialize_empty_array(times)
-
-        # array for SST "at" buoy from 3-day AVHRR + SPoRT coldest pixel composite (WRF input)
-        coldsportsst = initialize_empty_array(times)
-
-        # array for SST "at" buoy from SPoRT (on server)
-        sportsst = initialize_empty_array(times)
+            else:
+                print('{} files found for SPoRT+AVHRR at time {}'.format(str(len(spcomp_file)), t.strftime('%Y-%m-%d')))
 
-        if type(buoylon) == np.float32 and type(buoylat) == np.float32:
-            for t in times:
-                # daily AVHRR coldest pixel composite
-                satfile = '{}daily_avhrr/composites/{}/avhrr_coldest-pixel_{}.nc'.format(bpudatadir, t.strftime('%Y'),
-                                                                                         t.strftime('%Y%m%d'))
+            # SPoRT only
+            sp_file = glob.glob(bpudatadir + 'sport_nc/' + t.strftime('%Y%m%d') + '*.nc')
+            if len(sp_file) == 1:
                 try:
-                    cvalue = cf.append_satellite_sst_data(satfile, buoylat, buoylon, avgrad, 'daily_avhrr', 'sst')
-                    coldsst[times == t] = cvalue
+                    sportsst_all[:, i] = cf.extract_satellite_sst(sp_file[0], buoylats, buoylons, avgrads, 'sport',
+                                                                  'TMP_P0_L1_GLL0', index_cache_dir=index_cache_dir)
                 except:
-                    print('Issue reading from {}'.format(satfile))
-
-                #  3-day AVHRR + SPoRT coldest pixel composite (WRF input)
-                if t >= datetime.strptime('01-01-2017', '%m-%d-%Y'):
-                    sat_pre = bpudatadir + 'composites/procdate_'
-                else:
-                    sat_pre = bpudatadir + 'composites/archive_no_time_field/sport_'
-                spcomp_file = glob.glob(sat_pre + t.strftime('%Y%m%d') + '*.nc')
-                if len(spcomp_file) == 1:
-                    try:
-                        csvalue = cf.append_satellite_sst_data(spcomp_file[0], buoylat, buoylon, avgrad, 'cold_sport', 'sst')
-                        coldsportsst[times == t] = csvalue
-                    except:
-                        print('Issue reading from {}'.format(spcomp_file[0]))
-
-                else:
-                    print('{} files found for SPoRT+AVHRR at time {}'.format(str(len(spcomp_file)), t.strftime('%Y-%m-%d')))
-
-                # SPoRT only
-                sp_file = glob.glob(bpudatadir + 'sport_nc/' + t.strftime('%Y%m%d') + '*.nc')
-                if len(sp_file) == 1:
-                    try:
-                        svalue = cf.append_satellite_sst_data(sp_file[0], buoylat, buoylon, avgrad, 'sport', 'TMP_P0_L1_GLL0')
-                        sportsst[times == t] = svalue
-                    except:
-                        print('Issue reading from {}'.format(sp_file[0]))
-
-                else:
-                    print('{} files found for SPoRT at time {}'.format(str(len(sp_file)), t.strftime('%Y-%m-%d')))
+                    print('Issue reading from {}'.format(sp_file[0]))
+
+            else:
+                print('{} files found for SPoRT at time {}'.format(str(len(sp_file)), t.strftime('%Y-%m-%d')))
+
+    for buoy in buoys:
+        buoy_full = buoy_data[buoy]['full']
+        buoy_daily = buoy_data[buoy]['daily']
+        buoy_status = buoy_data[buoy]['status']
+        if buoy in located:
+            coldsst_rules = coldsst_all[located.index(buoy)]
+            coldsportsst_rules = coldsportsst_all[located.index(buoy)]
+            sportsst_rules = sportsst_all[located.index(buoy)]
+        else:
+            coldsst_rules = np.full((len(times), len(avgrads)), np.nan)
+            coldsportsst_rules = np.full((len(times), len(avgrads)), np.nan)
+            sportsst_rules = np.full((len(times), len(avgrads)), np.nan)
+        # the plots use the first averaging option
+        coldsst = coldsst_rules[:, 0]
+        coldsportsst = coldsportsst_rules[:, 0]
+        sportsst = sportsst_rules[:, 0]
 
         # plot
         times_plt = times + timedelta(days=1)
@@ -163,6 +182,16 @@ def main(t0, t1, buoys, avgrad, sDir, models):
             save_dir = os.path.join(sDir, t1.strftime('%Y%m%d'))
             cf.create_dir(save_dir)
 
+            # daily matchups, one column per product and averaging option
+            daily_means = buoy_daily[['time_plt', 'buoy_sst_mean']].rename(columns={'time_plt': 'time'})
+            matchups = pd.merge(pd.DataFrame(data={'time': times_plt}), daily_means, on='time', how='left')
+            products = [('avhrr', coldsst_rules), ('wrf_input', coldsportsst_rules), ('sport', sportsst_rules)]
+            for name, values in products:
+                for k, rule in enumerate(avgrads):
+                    matchups['{}_sst_{}'.format(name, rule)] = values[:, k]
+            mname = '{}_sst_matchups_{}-{}.csv'.format(buoy, t0.strftime('%Y%m%d'), t1.strftime('%Y%m%d'))
+            matchups.to_csv(os.path.join(save_dir, mname), index=False)
+
             for model in models:
                 sname = '{}_sst_comparison_{}_{}-{}'.format(buoy, model, t0.strftime('%Y%m%d'), t1.strftime('%Y%m%d'))
                 if model == 'WRFsport_avhrr':
@@ -217,6 +246,7 @@ if __name__ == '__main__':
     buoys = ['41001', '41002', '41004', '41008', '41013', '44005', '44007', '44008', '44009', '44011', '44013', '44014',
              '44017', '44018', '44020', '44025', '44027', '44065']
     avgrad = 'closestwithin5'
+    # avgrad = ['closestwithin5', 'closest', 'closestwithin10', 5, 10]  # sensitivity study
     sDir = '/Users/lgarzio/Documents/rucool/satellite/sst_buoy_comp'
     models = ['WRFsport_avhrr', 'WRFonly', 'WRFsport']  # ['WRFsport_avhrr', 'WRFonly', 'WRFsport']
     main(t0, t1, buoys, avgrad, sDir, models)
@@ -3,7 +3,7 @@
 Created by Lori Garzio on 2/12/2019
 @brief compare buoy data with individual daylight window passes of AVHRR satellite SST data, by month
 @usage
-sDir: location to save plots
+sDir: location to save plots and the neighbour tables of the buoys
 avgrad: radius around the buoy from which to grab satellite data. options: x (average all data within radius x km of
 the buoy), 'closest' (grabs the closest data point), 'closestwithinx' (get the closest non-nan measurement as long as
 it is within x km of the buoy
@@ -20,6 +20,8 @@ import pandas as pd
 import os
 import functions.common as cf
 import functions.plotting as pf
+import functions.grid_index as gi
+import functions.pass_catalog as pc
 
 
 def plot_avhrr(axis, x, y, rmse, n):
@@ -33,9 +35,45 @@ def plot_buoy_full(axis, x, y, buoy):
     return axis
 
 
+def get_avhrr_data(catalog, times, buoy_dicts, avgrad, H0_lst, H1_lst, index_cache_dir):
+    """
+    SST "at" the buoys from each daytime-window AVHRR pass, each pass read once for all the buoys
+    :param catalog: PassCatalog of the AVHRR pass files (see functions.pass_catalog)
+    :param buoy_dicts: dictionary of buoy name: buoy data (from functions.common.get_buoy_data); buoys without data
+    have no location and are left out
+    :param H0_lst: beginning daylight hour (GMT) of each month
+    :param H1_lst: ending daylight hour (GMT) of each month
+    :return: dictionary of buoy name: dictionary of the time ('t') and SST ('sst') of each pass
+    """
+    located = [b for b in buoy_dicts if len(buoy_dicts[b]['t']) > 0]
+    buoylats = [buoy_dicts[b]['lat'] for b in located]
+    buoylons = [buoy_dicts[b]['lon'] for b in located]
+    avhrr_data = dict()
+    for b in located:
+        avhrr_data[b] = {'t': np.array([], dtype='datetime64[ns]'), 'sst': np.array([])}
+    if len(located) == 0:
+        return avhrr_data
+
+    for tm in times:
+        # passes within the pre-defined daylight hour limits for that month
+        H0 = H0_lst[tm.month - 1]
+        H1 = H1_lst[tm.month - 1]
+        for p in catalog.query(tm, tm + timedelta(days=1), H0, H1):
+            fmdt = np.datetime64(p['time'])
+            data = cf.extract_satellite_sst(p['path'], buoylats, buoylons, [avgrad], 'avhrr', 'mcsst',
+                                            index_cache_dir=index_cache_dir)
+            for b, svalue in zip(located, data[:, 0]):
+                avhrr_data[b]['t'] = np.append(avhrr_data[b]['t'], fmdt)
+                avhrr_data[b]['sst'] = np.append(avhrr_data[b]['sst'], svalue)
+    return avhrr_data
+
+
 def main(start, end, buoys, avgrad, sDir):
+    index_cache_dir = gi.table_cache_dir(sDir)
     avhrr_dir = '/Volumes/boardwalk/coolgroup/bpu/wrf/data/avhrr_nc/'
     #avhrr_dir = '/home/coolgroup/bpu/wrf/data/avhrr_nc/'  # boardwalk
+    catalog_file = '/Users/lgarzio/Documents/rucool/satellite/avhrr_passes.db'
+    #catalog_file = '/home/lgarzio/rucool/satellite/avhrr_passes.db'  # boardwalk
     # daylight hours limits for each month
     H0_lst = [14, 14, 13, 13, 12, 12, 12, 12, 13, 13, 14, 14]
     H1_lst = [20, 20, 20, 22, 22, 23, 23, 23, 21, 20, 20, 20]
@@ -53,80 +91,68 @@ def main(start, end, buoys, avgrad, sDir):
     # for bulk stats
     all_data = dict(bdata=np.array([]), avhrrdata=np.array([]), buoys=[])
     monthly_data = {}
-    for buoy in buoys:
-        print(buoy)
-
-        # start_dates = [start]  # for debugging
-        # end_dates = [end]  # for debugging
-
-        dt_start = datetime.strptime(start, '%m-%d-%Y')
-        dt_end = datetime.strptime(end, '%m-%d-%Y')
-        start_dates = [dt_start.strftime('%m-%d-%Y')]
-        end_dates = []
-        ts1 = dt_start
-        while ts1 <= dt_end:
-            ts2 = ts1 + timedelta(days=1)
-            if ts2.month != ts1.month:
-                start_dates.append(ts2.strftime('%m-%d-%Y'))
-                end_dates.append(ts1.strftime('%m-%d-%Y'))
-            ts1 = ts2
-
-        end_dates.append(dt_end.strftime('%m-%d-%Y'))
 
-        for t0, t1 in zip(start_dates, end_dates):
-            if not isinstance(t0, int):  # if t0 is not integer, define date
-                t0 = cf.format_dates(t0)
+    # start and end of each month
+    dt_start = datetime.strptime(start, '%m-%d-%Y')
+    dt_end = datetime.strptime(end, '%m-%d-%Y')
+    start_dates = [dt_start.strftime('%m-%d-%Y')]
+    end_dates = []
+    ts1 = dt_start
+    while ts1 <= dt_end:
+        ts2 = ts1 + timedelta(days=1)
+        if ts2.month != ts1.month:
+            start_dates.append(ts2.strftime('%m-%d-%Y'))
+            end_dates.append(ts1.strftime('%m-%d-%Y'))
+        ts1 = ts2
+
+    end_dates.append(dt_end.strftime('%m-%d-%Y'))
+
+    # index of the AVHRR pass files, refreshed once (only new or changed files are read) instead of listing the pass
+    # directory for every day
+    catalog = pc.open_catalog(catalog_file, avhrr_dir)
+
+    # buoy SST data of each month, and SST "at" the buoys from each pass of the month read once for all the buoys
+    months = []
+    for t0, t1 in zip(start_dates, end_dates):
+        if not isinstance(t0, int):  # if t0 is not integer, define date
+            t0 = cf.format_dates(t0)
+
+        if not isinstance(t1, int):  # if t1 is not integer, define date
+            t1 = cf.format_dates(t1)
+
+        if isinstance(t0, int):  # if t0 is integer, redefine as t1-[t0 days]
+            t0 = t1-timedelta(days=t0)
+
+        if isinstance(t1, int):  # if t1 is integer, redefine as t0+[t1 days]
+            t1 = t0+timedelta(days=t1)
+
+        # define array of times
+        times = pd.to_datetime(np.arange(t0, t1+timedelta(days=1), timedelta(days=1)))
+
+        all_years = np.unique(times.year)
+        #all_years = np.append(all_years, 9999)  # 9999 buoy year is for 'real-time' data (past 45 days)
+
+        # get buoy SST data
+        buoy_dicts = dict()
+        for buoy in buoys:
+            buoy_dicts[buoy] = cf.get_buoy_data(buoy, all_years, t0, t1)
+        avhrr_buoys = get_avhrr_data(catalog, times, buoy_dicts, avgrad, H0_lst, H1_lst, index_cache_dir)
+        months.append((t0, t1, buoy_dicts, avhrr_buoys))
+    catalog.close()
 
-            if not isinstance(t1, int):  # if t1 is not integer, define date
-                t1 = cf.format_dates(t1)
-
-            if isinstance(t0, int):  # if t0 is integer, redefine as t1-[t0 days]
-                t0 = t1-timedelta(days=t0)
-
-            if isinstance(t1, int):  # if t1 is integer, redefine as t0+[t1 days]
-                t1 = t0+timedelta(days=t1)
+    for buoy in buoys:
+        print(buoy)
 
-            # define array of times
-            times = pd.to_datetime(np.arange(t0, t1+timedelta(days=1), timedelta(days=1)))
+        for t0, t1, buoy_dicts, avhrr_buoys in months:
             month = t0.strftime('%Y%m')
 
-            all_years = np.unique(times.year)
-            #all_years = np.append(all_years, 9999)  # 9999 buoy year is for 'real-time' data (past 45 days)
-
-            # get buoy SST data
-            buoy_dict = cf.get_buoy_data(buoy, all_years, t0, t1)
-
+            buoy_dict = buoy_dicts[buoy]
             buoy_full = pd.DataFrame(data={'time': buoy_dict['t'], 'buoy_sst': buoy_dict['sst']})
             buoy_full.drop_duplicates(inplace=True)
             buoy_full = buoy_full.dropna()
 
             if len(buoy_full) > 1:
-                buoylon = buoy_dict['lon']
-                buoylat = buoy_dict['lat']
-
-                # get SST data "at" buoy from each daytime-window AVHRR pass
-                avhrr_data = {'t': np.array([], dtype='datetime64[ns]'), 'sst': np.array([])}
-                for tm in times:
-                    dd = datetime.strftime(tm, '%y%m%d')
-                    #print(dd)
-                    avhrr_files = []
-                    for file in os.listdir(avhrr_dir):
-                        if file.startswith(dd) and file.endswith('.CF.nc'):
-                            avhrr_files.append(os.path.join(avhrr_dir, file))
-                    if len(avhrr_files) > 0:
-                        # select pre-defined daylight hour limits for that month
-                        H0 = H0_lst[tm.month - 1]
-                        H1 = H1_lst[tm.month - 1]
-                        for avhrr in avhrr_files:
-                            passH = avhrr[-18:-16]  # hour
-                            passM = avhrr[-16:-14]  # minute
-                            dt = 'T'.join((dd, (passH + passM)))
-                            if H0 <= int(passH) < H1:
-                                fmdt = np.datetime64(datetime.strptime(dt, '%y%m%dT%H%M'))
-                                avhrr_data['t'] = np.append(avhrr_data['t'], fmdt)
-                                data = cf.append_satellite_sst_data(avhrr, buoylat, buoylon, avgrad, 'avhrr', 'mcsst')
-                                avhrr_data['sst'] = np.append(avhrr_data['sst'], data)
-
+                avhrr_data = avhrr_buoys[buoy]
                 avhrr_df = pd.DataFrame(data={'time': avhrr_data['t'], 'avhrr_sst': avhrr_data['sst']})
                 avhrr_df = avhrr_df.dropna()
 
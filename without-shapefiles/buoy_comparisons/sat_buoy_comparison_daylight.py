@@ -4,7 +4,7 @@ Created by Lori Garzio on 4/29/2019
 @brief monthly comparisons of buoy data with: 1) coldest pixel composite satellite SST data, 2) RTG data, and 3) SPoRT
 (buoy average daylight hours only)
 @usage
-sDir: location to save plots
+sDir: location to save plots and the neighbour tables of the buoys
 avgrad: radius around the buoy from which to grab satellite data. options: x (average all data within radius x km of
 the buoy), 'closest' (grabs the closest data point), 'closestwithinx' (get the closest non-nan measurement as long as
 it is within x km of the buoy
@@ -21,6 +21,7 @@ import os
 import glob
 import functions.common as cf
 import functions.plotting as pf
+import functions.grid_index as gi
 
 
 def plot_buoy_full(axis, x, y, buoy):
@@ -52,7 +53,63 @@ def plot_satdata(axis, x, y, rmse, n):
     return axis
 
 
+def get_sat_data(model, times, buoy_dicts, avgrad, bpudatadir, index_cache_dir):
+    """
+    SST "at" the buoys from the daily files of a satellite product or model, each file read once for all the buoys
+    :param buoy_dicts: dictionary of buoy name: buoy data (from functions.common.get_buoy_data); buoys without data
+    have no location and are left out
+    :return: dictionary of buoy name: dictionary of the day ('t') and SST ('sst') of each file read
+    """
+    located = [b for b in buoy_dicts if len(buoy_dicts[b]['t']) > 0]
+    buoylats = [buoy_dicts[b]['lat'] for b in located]
+    buoylons = [buoy_dicts[b]['lon'] for b in located]
+    sat_data = dict()
+    for b in located:
+        sat_data[b] = {'t': np.array([], dtype='datetime64[ns]'), 'sst': np.array([])}
+    if len(located) == 0:
+        return sat_data
+
+    for tm in times:
+        fmtm = np.datetime64(datetime.strftime(tm, '%Y-%m-%d'))
+        dd = datetime.strftime(tm, '%Y%m%d')
+        svalues = None
+        if model == 'coldestpix':
+            sat_file = glob.glob('{}{}{}/avhrr_coldest-pixel_{}.nc'.format(bpudatadir, 'daily_avhrr/composites/',
+                                                                           str(tm.year), dd))
+            if len(sat_file) == 1:
+                svalues = cf.extract_satellite_sst(sat_file[0], buoylats, buoylons, [avgrad], 'daily_avhrr', 'sst',
+                                                   index_cache_dir=index_cache_dir)
+        elif model == 'sport':
+            sp_file = glob.glob(bpudatadir + 'sport_nc/' + dd + '*.nc')
+            if len(sp_file) == 1:
+                try:
+                    svalues = cf.extract_satellite_sst(sp_file[0], buoylats, buoylons, [avgrad], 'sport',
+                                                       'TMP_P0_L1_GLL0', index_cache_dir=index_cache_dir)
+                except:
+                    print('Issue reading from {}'.format(sp_file[0]))
+            else:
+                print('{} files found for SPoRT at time {}'.format(str(len(sp_file)), tm.strftime('%Y-%m-%d')))
+        elif model == 'rtg':
+            rtg_files = []
+            rtg_dir = '{}{}/{}/'.format(bpudatadir, 'rtg_nc', str(tm.year))
+            for file in os.listdir(rtg_dir):
+                if file.startswith('rtg_sst_grb') and file.endswith('{}.nc'.format(dd)):
+                    rtg_files.append(os.path.join(rtg_dir, file))
+            if len(rtg_files) == 1:
+                svalues = cf.extract_satellite_sst(rtg_files[0], buoylats, buoylons, ['closest'], 'rtg',
+                                                   'TMP_173_SFC', index_cache_dir=index_cache_dir)
+            else:
+                print('{} files found for RTG at time {}'.format(str(len(rtg_files)), tm.strftime('%Y-%m-%d')))
+
+        if svalues is not None:
+            for b, svalue in zip(located, svalues[:, 0]):
+                sat_data[b]['t'] = np.append(sat_data[b]['t'], fmtm)
+                sat_data[b]['sst'] = np.append(sat_data[b]['sst'], svalue)
+    return sat_data
+
+
 def main(start, end, buoys, avgrad, models, sDir):
+    index_cache_dir = gi.table_cache_dir(sDir)
     bpudatadir = '/Volumes/boardwalk/coolgroup/bpu/wrf/data/'
     #dir = '/Volumes/boardwalk/coolgroup/bpu/wrf/data/daily_avhrr/composites/'
     #dir = '/home/coolgroup/bpu/wrf/data/daily_avhrr/composites/'  # boardwalk
@@ -65,6 +122,55 @@ def main(start, end, buoys, avgrad, models, sDir):
                 'mean_diff', 'sd_diff', 'q1_diff', 'median_diff', 'q3_diff', 'mean_abs_diff', 'sd_abs_diff',
                 'q1_abs_diff', 'median_abs_diff', 'q3_abs_diff', 'diff (sat-buoy)']
 
+    # start and end of each month
+    dt_start = datetime.strptime(start, '%m-%d-%Y')
+    dt_end = datetime.strptime(end, '%m-%d-%Y')
+    start_dates = [dt_start.strftime('%m-%d-%Y')]
+    end_dates = []
+    ts1 = dt_start
+    while ts1 <= dt_end:
+        ts2 = ts1 + timedelta(days=1)
+        if ts2.month != ts1.month:
+            start_dates.append(ts2.strftime('%m-%d-%Y'))
+            end_dates.append(ts1.strftime('%m-%d-%Y'))
+        ts1 = ts2
+
+    end_dates.append(dt_end.strftime('%m-%d-%Y'))
+
+    # buoy SST data of each month, for all the models
+    months = []
+    for t0, t1 in zip(start_dates, end_dates):
+        if not isinstance(t0, int):  # if t0 is not integer, define date
+            t0 = cf.format_dates(t0)
+
+        if not isinstance(t1, int):  # if t1 is not integer, define date
+            t1 = cf.format_dates(t1)
+
+        if isinstance(t0, int):  # if t0 is integer, redefine as t1-[t0 days]
+            t0 = t1-timedelta(days=t0)
+
+        if isinstance(t1, int):  # if t1 is integer, redefine as t0+[t1 days]
+            t1 = t0+timedelta(days=t1)
+
+        # define array of times
+        times = pd.to_datetime(np.arange(t0, t1+timedelta(days=1), timedelta(days=1)))
+
+        #upwelling events only
+        times = [datetime(2016, 7, 4), datetime(2016, 7, 5), datetime(2016, 7, 6), datetime(2016, 7, 8),
+                 datetime(2016, 7, 9), datetime(2016, 7, 10), datetime(2016, 7, 11), datetime(2016, 7, 12),
+                 datetime(2016, 7, 19), datetime(2016, 7, 20), datetime(2016, 7, 21), datetime(2016, 7, 22),
+                 datetime(2016, 7, 23), datetime(2016, 7, 24), datetime(2016, 7, 26), datetime(2016, 7, 27),
+                 datetime(2016, 7, 28), datetime(2016, 7, 29), datetime(2016, 7, 30)]
+
+        all_years = np.unique(times.year)
+        #all_years = np.append(all_years, 9999)  # 9999 buoy year is for 'real-time' data (past 45 days)
+
+        # get buoy SST data
+        buoy_dicts = dict()
+        for buoy in buoys:
+            buoy_dicts[buoy] = cf.get_buoy_data(buoy, all_years, t0, t1)
+        months.append((t0, t1, times, buoy_dicts))
+
     for model in models:
         print(model)
         if len(buoys) == 3:
@@ -76,59 +182,19 @@ def main(start, end, buoys, avgrad, models, sDir):
         # for bulk stats
         all_data = dict(bdata=np.array([]), satdata=np.array([]), buoys=[])
         monthly_data = {}
+
+        # get SST data "at" the buoys, reading each file of the month once for all the buoys
+        sat_months = [get_sat_data(model, times, buoy_dicts, avgrad, bpudatadir, index_cache_dir)
+                      for t0, t1, times, buoy_dicts in months]
         for buoy in buoys:
             print(buoy)
 
-            # start_dates = [start]  # for debugging
-            # end_dates = [end]  # for debugging
-
-            dt_start = datetime.strptime(start, '%m-%d-%Y')
-            dt_end = datetime.strptime(end, '%m-%d-%Y')
-            start_dates = [dt_start.strftime('%m-%d-%Y')]
-            end_dates = []
-            ts1 = dt_start
-            while ts1 <= dt_end:
-                ts2 = ts1 + timedelta(days=1)
-                if ts2.month != ts1.month:
-                    start_dates.append(ts2.strftime('%m-%d-%Y'))
-                    end_dates.append(ts1.strftime('%m-%d-%Y'))
-                ts1 = ts2
-
-            end_dates.append(dt_end.strftime('%m-%d-%Y'))
-
-            for t0, t1 in zip(start_dates, end_dates):
-                if not isinstance(t0, int):  # if t0 is not integer, define date
-                    t0 = cf.format_dates(t0)
-
-                if not isinstance(t1, int):  # if t1 is not integer, define date
-                    t1 = cf.format_dates(t1)
-
-                if isinstance(t0, int):  # if t0 is integer, redefine as t1-[t0 days]
-                    t0 = t1-timedelta(days=t0)
-
-                if isinstance(t1, int):  # if t1 is integer, redefine as t0+[t1 days]
-                    t1 = t0+timedelta(days=t1)
-
-                # define array of times
-                times = pd.to_datetime(np.arange(t0, t1+timedelta(days=1), timedelta(days=1)))
-
-                #upwelling events only
-                times = [datetime(2016, 7, 4), datetime(2016, 7, 5), datetime(2016, 7, 6), datetime(2016, 7, 8),
-                         datetime(2016, 7, 9), datetime(2016, 7, 10), datetime(2016, 7, 11), datetime(2016, 7, 12),
-                         datetime(2016, 7, 19), datetime(2016, 7, 20), datetime(2016, 7, 21), datetime(2016, 7, 22),
-                         datetime(2016, 7, 23), datetime(2016, 7, 24), datetime(2016, 7, 26), datetime(2016, 7, 27),
-                         datetime(2016, 7, 28), datetime(2016, 7, 29), datetime(2016, 7, 30)]
-
+            for (t0, t1, times, buoy_dicts), sat_buoys in zip(months, sat_months):
                 month = t0.strftime('%Y%m')
                 H0 = H0_lst[t0.month - 1]
                 H1 = H1_lst[t0.month - 1]
 
-                all_years = np.unique(times.year)
-                #all_years = np.append(all_years, 9999)  # 9999 buoy year is for 'real-time' data (past 45 days)
-
-                # get buoy SST data
-                buoy_dict = cf.get_buoy_data(buoy, all_years, t0, t1)
-
+                buoy_dict = buoy_dicts[buoy]
                 buoy_full = pd.DataFrame(data={'time': buoy_dict['t'], 'buoy_sst': buoy_dict['sst']})
                 buoy_full.drop_duplicates(inplace=True)
                 buoy_full = buoy_full.dropna()
@@ -137,51 +203,7 @@ def main(start, end, buoys, avgrad, models, sDir):
                 buoy_daylight_daily = buoy_full_daylight.resample('d', on='time').mean().dropna(how='all').reset_index()  # resample daily
 
                 if len(buoy_full) > 1:
-                    buoylon = buoy_dict['lon']
-                    buoylat = buoy_dict['lat']
-
-                    # get SST data "at" buoy
-                    sat_data = {'t': np.array([], dtype='datetime64[ns]'), 'sst': np.array([])}
-                    for tm in times:
-                        fmtm = np.datetime64(datetime.strftime(tm, '%Y-%m-%d'))
-                        dd = datetime.strftime(tm, '%Y%m%d')
-                        if model == 'coldestpix':
-                            sat_file = glob.glob('{}{}{}/avhrr_coldest-pixel_{}.nc'.format(bpudatadir,
-                                                                                           'daily_avhrr/composites/',
-                                                                                           str(tm.year), dd))
-                            if len(sat_file) == 1:
-                                sat_data['t'] = np.append(sat_data['t'], fmtm)
-                                svalue = cf.append_satellite_sst_data(sat_file[0], buoylat, buoylon, avgrad,
-                                                                      'daily_avhrr', 'sst')
-                                sat_data['sst'] = np.append(sat_data['sst'], svalue)
-                        elif model == 'sport':
-                            sp_file = glob.glob(bpudatadir + 'sport_nc/' + dd + '*.nc')
-                            if len(sp_file) == 1:
-                                try:
-                                    svalue = cf.append_satellite_sst_data(sp_file[0], buoylat, buoylon, avgrad, 'sport',
-                                                                          'TMP_P0_L1_GLL0')
-                                    sat_data['sst'] = np.append(sat_data['sst'], svalue)
-                                    sat_data['t'] = np.append(sat_data['t'], fmtm)
-                                except:
-                                    print('Issue reading from {}'.format(sp_file[0]))
-                            else:
-                                print('{} files found for SPoRT at time {}'.format(str(len(sp_file)),
-                                                                                   tm.strftime('%Y-%m-%d')))
-                        elif model == 'rtg':
-                            rtg_files = []
-                            rtg_dir = '{}{}/{}/'.format(bpudatadir, 'rtg_nc', str(tm.year))
-                            for file in os.listdir(rtg_dir):
-                                if file.startswith('rtg_sst_grb') and file.endswith('{}.nc'.format(dd)):
-                                    rtg_files.append(os.path.join(rtg_dir, file))
-                            if len(rtg_files) == 1:
-                                svalue = cf.append_satellite_sst_data(rtg_files[0], buoylat, buoylon, 'closest', 'rtg',
-                                                                      'TMP_173_SFC')
-                                sat_data['sst'] = np.append(sat_data['sst'], svalue)
-                                sat_data['t'] = np.append(sat_data['t'], fmtm)
-                            else:
-                                print('{} files found for RTG at time {}'.format(str(len(rtg_files)),
-                                                                                 tm.strftime('%Y-%m-%d')))
-
+                    sat_data = sat_buoys[buoy]
                     sat_df = pd.DataFrame(data={'time': sat_data['t'], 'sat_sst': sat_data['sst']})
                     sat_df = sat_df.dropna()
 
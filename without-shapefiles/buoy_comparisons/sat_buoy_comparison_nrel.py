@@ -4,7 +4,7 @@
 @modified by Lori Garzio on 1/16/2019
 @brief compare buoy data with satellite SST data from the NREL case study, by month
 @usage
-sDir: location to save plots
+sDir: location to save plots and the neighbour tables of the buoys
 avgrad: radius around the buoy from which to grab satellite data. options: x (average all data within radius x km of
 the buoy), 'closest' (grabs the closest data point), 'closestwithinx' (get the closest non-nan measurement as long as
 it is within x km of the buoy
@@ -22,12 +22,7 @@ import glob
 import os
 import functions.common as cf
 import functions.plotting as pf
-
-
-def initialize_empty_array(time_array):
-    empty_array = np.empty(np.shape(time_array))
-    empty_array[:] = np.nan
-    return empty_array
+import functions.grid_index as gi
 
 
 def plot_avhrr(axis, x, y, rmse, n):
@@ -68,7 +63,69 @@ def plot_sport(axis, x, y, rmse, n):
     return axis
 
 
+def get_sat_data(times, buoy_dicts, avgrad, bpudatadir, index_cache_dir):
+    """
+    SST "at" the buoys from the daily AVHRR coldest pixel composite, SPoRT and the NREL case study, each file read once
+    for all the buoys
+    :param buoy_dicts: dictionary of buoy name: buoy data (from functions.common.get_buoy_data); buoys without data
+    have no location and are left out
+    :return: dictionary of buoy name: arrays of the coldest pixel composite, SPoRT and NREL SST "at" the buoy at each
+    time (nan where there is no data)
+    """
+    located = [b for b in buoy_dicts if len(buoy_dicts[b]['t']) > 0]
+    buoylats = [buoy_dicts[b]['lat'] for b in located]
+    buoylons = [buoy_dicts[b]['lon'] for b in located]
+    if len(located) == 0:
+        return dict()
+    coldsst = np.full((len(located), len(times)), np.nan)
+    sportsst = np.full((len(located), len(times)), np.nan)
+    nrelsst = np.full((len(located), len(times)), np.nan)
+
+    for i, t in enumerate(times):
+        # daily AVHRR coldest pixel composite
+        ldir = '/Users/lgarzio/Documents/rucool/satellite/coldest_pixel/'
+        # satfile = '{}daily_avhrr/composites/{}/avhrr_coldest-pixel_{}.nc'.format(bpudatadir, t.strftime('%Y'),
+        #                                                                          t.strftime('%Y%m%d'))
+        satfile = '{}daily_avhrr/composites/{}/avhrr_coldest-pixel_{}.nc'.format(ldir, t.strftime('%Y'),
+                                                                                 t.strftime('%Y%m%d'))
+        try:
+            coldsst[:, i] = cf.extract_satellite_sst(satfile, buoylats, buoylons, [avgrad], 'daily_avhrr', 'sst',
+                                                     index_cache_dir=index_cache_dir)[:, 0]
+        except:
+            print('Issue reading from {}'.format(satfile))
+
+        # SPoRT only
+        sp_file = glob.glob(bpudatadir + 'sport_nc/' + t.strftime('%Y%m%d') + '*.nc')
+        if len(sp_file) == 1:
+            try:
+                sportsst[:, i] = cf.extract_satellite_sst(sp_file[0], buoylats, buoylons, [avgrad], 'sport',
+                                                          'TMP_P0_L1_GLL0', index_cache_dir=index_cache_dir)[:, 0]
+            except:
+                print('Issue reading from {}'.format(sp_file[0]))
+
+        else:
+            print('{} files found for SPoRT at time {}'.format(str(len(sp_file)), t.strftime('%Y-%m-%d')))
+
+        # NREL case study
+        nrel_dir = '{}composite_archive/NREL_case_study/'.format(bpudatadir)
+        nrel_file = glob.glob(nrel_dir + '/procdate_' + t.strftime('%Y%m%d') + '*.nc')
+        if len(nrel_file) == 1:
+            try:
+                nrelsst[:, i] = cf.extract_satellite_sst(nrel_file[0], buoylats, buoylons, [avgrad], 'nrel', 'sst',
+                                                         index_cache_dir=index_cache_dir)[:, 0]
+            except:
+                print('Issue reading from {}'.format(nrel_file))
+        else:
+            print('{} files found for NREL file at time {}'.format(str(len(nrel_file)), t.strftime('%Y-%m-%d')))
+
+    sat_data = dict()
+    for n, b in enumerate(located):
+        sat_data[b] = (coldsst[n], sportsst[n], nrelsst[n])
+    return sat_data
+
+
 def main(start, end, buoys, avgrad, sDir):
+    index_cache_dir = gi.table_cache_dir(sDir)
     bpudatadir = '/Volumes/boardwalk/coolgroup/bpu/wrf/data/'
     headers = ['buoy', 'year-month', 'mean_buoy_nrel', 'sd_buoy_nrel', 'mean_nrel', 'sd_nrel', 'mean_buoy_avhrr',
                'sd_buoy_avhrr', 'mean_avhrr', 'sd_avhrr', 'mean_buoy_sport', 'sd_buoy_sport', 'mean_sport', 'sd_sport',
@@ -76,50 +133,59 @@ def main(start, end, buoys, avgrad, sDir):
                'diff_nrel (sat-buoy)', 'diff_avhrr (sat-buoy)', 'diff_sport (sat-buoy)']
     summary = []
     dsummary = pd.DataFrame(columns=['buoy', 'time', 'buoy_sst_mean', 'dailyavhrr_sst', 'sport_sst', 'nrel_sst'])
+    # start and end of each month
+    dt_start = datetime.strptime(start, '%m-%d-%Y')
+    dt_end = datetime.strptime(end, '%m-%d-%Y')
+    start_dates = [dt_start.strftime('%m-%d-%Y')]
+    end_dates = []
+    ts1 = dt_start
+    while ts1 <= dt_end:
+        ts2 = ts1 + timedelta(days=1)
+        if ts2.month != ts1.month:
+            start_dates.append(ts2.strftime('%m-%d-%Y'))
+            end_dates.append(ts1.strftime('%m-%d-%Y'))
+        ts1 = ts2
+
+    end_dates.append(dt_end.strftime('%m-%d-%Y'))
+
+    # buoy SST data of each month, and SST "at" the buoys from each file of the month read once for all the buoys
+    months = []
+    for t0, t1 in zip(start_dates, end_dates):
+        if not isinstance(t0, int):  # if t0 is not integer, define date
+            t0 = cf.format_dates(t0)
+
+        if not isinstance(t1, int):  # if t1 is not integer, define date
+            t1 = cf.format_dates(t1)
+
+        if isinstance(t0, int):  # if t0 is integer, redefine as t1-[t0 days]
+            t0 = t1-timedelta(days=t0)
+
+        if isinstance(t1, int):  # if t1 is integer, redefine as t0+[t1 days]
+            t1 = t0+timedelta(days=t1)
+
+        # the start date and end dates should be the day before the requested date, because the data from the
+        # previous day are used for the model
+        t0 = t0.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+        t1 = t1.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+
+        # define array of times
+        times = pd.to_datetime(np.arange(t0, t1+timedelta(days=1), timedelta(days=1)))
+
+        all_years = np.unique(times.year)
+        #all_years = np.append(all_years, 9999)  # 9999 buoy year is for 'real-time' data (past 45 days)
+
+        # get buoy SST data
+        buoy_dicts = dict()
+        for buoy in buoys:
+            buoy_dicts[buoy] = cf.get_buoy_data(buoy, all_years, t0, t1)
+        sat_buoys = get_sat_data(times, buoy_dicts, avgrad, bpudatadir, index_cache_dir)
+        months.append((t0, t1, times, buoy_dicts, sat_buoys))
+
     for buoy in buoys:
         print(buoy)
 
-        dt_start = datetime.strptime(start, '%m-%d-%Y')
-        dt_end = datetime.strptime(end, '%m-%d-%Y')
-        start_dates = [dt_start.strftime('%m-%d-%Y')]
-        end_dates = []
-        ts1 = dt_start
-        while ts1 <= dt_end:
-            ts2 = ts1 + timedelta(days=1)
-            if ts2.month != ts1.month:
-                start_dates.append(ts2.strftime('%m-%d-%Y'))
-                end_dates.append(ts1.strftime('%m-%d-%Y'))
-            ts1 = ts2
-
-        end_dates.append(dt_end.strftime('%m-%d-%Y'))
-
-        for t0, t1 in zip(start_dates, end_dates):
-            if not isinstance(t0, int):  # if t0 is not integer, define date
-                t0 = cf.format_dates(t0)
-
-            if not isinstance(t1, int):  # if t1 is not integer, define date
-                t1 = cf.format_dates(t1)
-
-            if isinstance(t0, int):  # if t0 is integer, redefine as t1-[t0 days]
-                t0 = t1-timedelta(days=t0)
-
-            if isinstance(t1, int):  # if t1 is integer, redefine as t0+[t1 days]
-                t1 = t0+timedelta(days=t1)
-
-            # the start date and end dates should be the day before the requested date, because the data from the
-            # previous day are used for the model
-            t0 = t0.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
-            t1 = t1.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
-
-            # define array of times
-            times = pd.to_datetime(np.arange(t0, t1+timedelta(days=1), timedelta(days=1)))
-
-            all_years = np.unique(times.year)
-            #all_years = np.append(all_years, 9999)  # 9999 buoy year is for 'real-time' data (past 45 days)
-
-            # get buoy SST data
-            buoy_dict = cf.get_buoy_data(buoy, all_years, t0, t1)
-
+        for t0, t1, times, buoy_dicts, sat_buoys in months:
+            buoy_dict = buoy_dicts[buoy]
             buoy_full = pd.DataFrame(data={'time': buoy_dict['t'], 'sst': buoy_dict['sst']})
             buoy_full.drop_duplicates(inplace=True)
             buoy_daily = buoy_full.resample('d', on='time').mean().dropna(how='all').reset_index()
@@ -131,56 +197,10 @@ def main(start, end, buoys, avgrad, sDir):
             else:
                 buoy_status = 'valid'
 
-            buoylon = buoy_dict['lon']
-            buoylat = buoy_dict['lat']
-
-            # array for SST "at" buoy from daily AVHRR-only coldest pixel composite
-            coldsst = initialize_empty_array(times)
-
-            # array for SST "at" buoy from SPoRT (on server)
-            sportsst = initialize_empty_array(times)
-
-            # array for SST "at" buoy from the NREL case study (on server)
-            nrelsst = initialize_empty_array(times)
             if buoy_status == 'valid':
-                for t in times:
-                    # daily AVHRR coldest pixel composite
-                    ldir = '/Users/lgarzio/Documents/rucool/satellite/coldest_pixel/'
-                    # satfile = '{}daily_avhrr/composites/{}/avhrr_coldest-pixel_{}.nc'.format(bpudatadir, t.strftime('%Y'),
-                    #                                                                          t.strftime('%Y%m%d'))
-                    satfile = '{}daily_avhrr/composites/{}/avhrr_coldest-pixel_{}.nc'.format(ldir,
-                                                                                             t.strftime('%Y'),
-                                                                                             t.strftime('%Y%m%d'))
-                    try:
-                        cvalue = cf.append_satellite_sst_data(satfile, buoylat, buoylon, avgrad, 'daily_avhrr', 'sst')
-                        coldsst[times == t] = cvalue
-                    except:
-                        print('Issue reading from {}'.format(satfile))
-
-                    # SPoRT only
-                    sp_file = glob.glob(bpudatadir + 'sport_nc/' + t.strftime('%Y%m%d') + '*.nc')
-                    if len(sp_file) == 1:
-                        try:
-                            svalue = cf.append_satellite_sst_data(sp_file[0], buoylat, buoylon, avgrad, 'sport',
-                                                                  'TMP_P0_L1_GLL0')
-                            sportsst[times == t] = svalue
-                        except:
-                            print('Issue reading from {}'.format(sp_file[0]))
-
-                    else:
-                        print('{} files found for SPoRT at time {}'.format(str(len(sp_file)), t.strftime('%Y-%m-%d')))
-
-                    # NREL case study
-                    nrel_dir = '{}composite_archive/NREL_case_study/'.format(bpudatadir)
-                    nrel_file = glob.glob(nrel_dir + '/procdate_' + t.strftime('%Y%m%d') + '*.nc')
-                    if len(nrel_file) == 1:
-                        try:
-                            nrel_value = cf.append_satellite_sst_data(nrel_file[0], buoylat, buoylon, avgrad, 'nrel', 'sst')
-                            nrelsst[times == t] = nrel_value
-                        except:
-                            print('Issue reading from {}'.format(nrel_file))
-                    else:
-                        print('{} files found for NREL file at time {}'.format(str(len(nrel_file)), t.strftime('%Y-%m-%d')))
+                # SST "at" buoy from daily AVHRR-only coldest pixel composite, SPoRT (on server) and the NREL case
+                # study (on server)
+                coldsst, sportsst, nrelsst = sat_buoys[buoy]
 
                 # plot
                 times_plt = times + timedelta(days=1)
@@ -4,6 +4,14 @@ Created on 7/8/2019
 @author Lori Garzio
 @brief monthly comparison of sport and RTG data with buoy data
 @usage
+start: start date (mm-dd-yyyy)
+end: end date (mm-dd-yyyy)
+buoys: list of NDBC buoy IDs
+avgrad: radius around the buoy from which to grab SPoRT and coldest pixel composite data (RTG always uses the closest
+data point). options: x (average all data within radius x km of the buoy), 'closest' (grabs the closest data point),
+'closestwithinx' (get the closest non-nan measurement as long as it is within x km of the buoy
+sDir: location to save plots and the neighbour tables of the buoys
+group: 'monthly' (statistics by month between start and end) or 'season' (seasons defined in main)
 """
 
 
@@ -15,6 +23,7 @@ import pandas as pd
 import os
 import functions.common as cf
 import functions.plotting as pf
+import functions.grid_index as gi
 
 
 def combine_datasets(sat_data, buoy_full, all_data, buoy, monthly_data, month, summary, samplesize):
@@ -131,7 +140,78 @@ def plot_sport(axis, x, y, rmse, n):
     return axis
 
 
+def get_sat_data(models, times, buoy_dicts, avgrad, bpudatadir, index_cache_dir):
+    """
+    SST "at" the buoys from the daily SPoRT, RTG and AVHRR coldest pixel composite files, each file read once for all
+    the buoys
+    :param buoy_dicts: dictionary of buoy name: buoy data (from functions.common.get_buoy_data); buoys without data
+    have no location and are left out
+    :return: dictionary of buoy name: SPoRT, RTG and coldest pixel composite dictionaries of the day ('t') and SST
+    ('sst') of each file read
+    """
+    located = [b for b in buoy_dicts if len(buoy_dicts[b]['t']) > 0]
+    buoylats = [buoy_dicts[b]['lat'] for b in located]
+    buoylons = [buoy_dicts[b]['lon'] for b in located]
+    sat_data = dict()
+    for b in located:
+        sat_data[b] = tuple({'t': np.array([], dtype='datetime64[ns]'), 'sst': np.array([])} for model in models)
+    if len(located) == 0:
+        return sat_data
+
+    for tm in times:
+        print(tm)
+        dd = datetime.strftime(tm, '%Y%m%d')
+        fmdt = np.datetime64(datetime.strptime(dd, '%Y%m%d'))
+
+        for m, model in enumerate(models):
+            svalues = None
+            if model == 'sport':
+                # get SPoRT data
+                sp_file = glob.glob(bpudatadir + 'sport_nc/' + dd + '*.nc')
+                if len(sp_file) == 1:
+                    try:
+                        svalues = cf.extract_satellite_sst(sp_file[0], buoylats, buoylons, [avgrad], 'sport',
+                                                           'TMP_P0_L1_GLL0', index_cache_dir=index_cache_dir)
+                    except:
+                        print('Issue reading from {}'.format(sp_file[0]))
+
+                else:
+                    print('{} files found for SPoRT at time {}'.format(str(len(sp_file)), tm.strftime('%Y-%m-%d')))
+
+            if model == 'rtg':
+                # get RTG data
+                rtg_files = []
+                rtg_dir = '{}{}/{}/'.format(bpudatadir, 'rtg_nc', str(tm.year))
+                for file in os.listdir(rtg_dir):
+                    if file.startswith('rtg_sst_grb') and file.endswith('{}.nc'.format(dd)):
+                        rtg_files.append(os.path.join(rtg_dir, file))
+                if len(rtg_files) == 1:
+                    # take the closest grid cell to the buoy (RTG has full-coverage)
+                    svalues = cf.extract_satellite_sst(rtg_files[0], buoylats, buoylons, ['closest'], 'rtg',
+                                                       'TMP_173_SFC', index_cache_dir=index_cache_dir)
+
+                else:
+                    print('{} files found for RTG at time {}'.format(str(len(rtg_files)), tm.strftime('%Y-%m-%d')))
+
+            if model == 'avhrr':
+                # daily AVHRR daily coldest pixel composite
+                satfile = '{}daily_avhrr/composites/{}/avhrr_coldest-pixel_{}.nc'.format(bpudatadir, tm.strftime('%Y'),
+                                                                                         tm.strftime('%Y%m%d'))
+                try:
+                    svalues = cf.extract_satellite_sst(satfile, buoylats, buoylons, [avgrad], 'daily_avhrr', 'sst',
+                                                       index_cache_dir=index_cache_dir)
+                except:
+                    print('Issue reading from {}'.format(satfile))
+
+            if svalues is not None:
+                for b, svalue in zip(located, svalues[:, 0]):
+                    sat_data[b][m]['sst'] = np.append(sat_data[b][m]['sst'], svalue)
+                    sat_data[b][m]['t'] = np.append(sat_data[b][m]['t'], fmdt)
+    return sat_data
+
+
 def main(start, end, buoys, avgrad, sDir, group):
+    index_cache_dir = gi.table_cache_dir(sDir)
     bpudatadir = '/Volumes/boardwalk/coolgroup/bpu/wrf/data/'
     #bpudatadir = '/home/coolgroup/bpu/wrf/data/'  # boardwalk
     models = ['sport', 'rtg', 'avhrr']
@@ -146,56 +226,62 @@ def main(start, end, buoys, avgrad, sDir, group):
     monthly_data_sport = {}
     monthly_data_rtg = {}
     monthly_data_avhrr = {}
+    # start and end of each period
+    if group == 'monthly':
+        sample_size = 4
+        dt_start = datetime.strptime(start, '%m-%d-%Y')
+        dt_end = datetime.strptime(end, '%m-%d-%Y')
+        start_dates = [dt_start.strftime('%m-%d-%Y')]
+        end_dates = []
+        ts1 = dt_start
+        while ts1 <= dt_end:
+            ts2 = ts1 + timedelta(days=1)
+            if ts2.month != ts1.month:
+                start_dates.append(ts2.strftime('%m-%d-%Y'))
+                end_dates.append(ts1.strftime('%m-%d-%Y'))
+            ts1 = ts2
+
+        end_dates.append(dt_end.strftime('%m-%d-%Y'))
+    elif group == 'season':
+        sample_size = 14
+        start_dates = ['12-1-2015', '3-1-2016', '6-1-2016', '9-1-2016']
+        end_dates = ['2-29-2016', '5-31-2016', '8-31-2016', '11-30-2016']
+
+    # buoy SST data of each period, and SST "at" the buoys from each file of the period read once for all the buoys
+    periods = []
+    for t0, t1 in zip(start_dates, end_dates):
+        if not isinstance(t0, int):  # if t0 is not integer, define date
+            t0 = cf.format_dates(t0)
+
+        if not isinstance(t1, int):  # if t1 is not integer, define date
+            t1 = cf.format_dates(t1)
+
+        if isinstance(t0, int):  # if t0 is integer, redefine as t1-[t0 days]
+            t0 = t1-timedelta(days=t0)
+
+        if isinstance(t1, int):  # if t1 is integer, redefine as t0+[t1 days]
+            t1 = t0+timedelta(days=t1)
+
+        # define array of times
+        times = pd.to_datetime(np.arange(t0, t1+timedelta(days=1), timedelta(days=1)))
+        month = t0.strftime('%Y%m')
+        print('Year-month: {}'.format(month))
+
+        all_years = np.unique(times.year)
+        #all_years = np.append(all_years, 9999)  # 9999 buoy year is for 'real-time' data (past 45 days)
+
+        # get buoy SST data
+        buoy_dicts = dict()
+        for buoy in buoys:
+            buoy_dicts[buoy] = cf.get_buoy_data(buoy, all_years, t0, t1)
+        sat_buoys = get_sat_data(models, times, buoy_dicts, avgrad, bpudatadir, index_cache_dir)
+        periods.append((month, buoy_dicts, sat_buoys))
+
     for buoy in buoys:
         print('\nBuoy {}'.format(buoy))
-        # start_dates = [start]
-        # end_dates = [end]
-        # sample_size = 4
-
-        if group == 'monthly':
-            sample_size = 4
-            dt_start = datetime.strptime(start, '%m-%d-%Y')
-            dt_end = datetime.strptime(end, '%m-%d-%Y')
-            start_dates = [dt_start.strftime('%m-%d-%Y')]
-            end_dates = []
-            ts1 = dt_start
-            while ts1 <= dt_end:
-                ts2 = ts1 + timedelta(days=1)
-                if ts2.month != ts1.month:
-                    start_dates.append(ts2.strftime('%m-%d-%Y'))
-                    end_dates.append(ts1.strftime('%m-%d-%Y'))
-                ts1 = ts2
-
-            end_dates.append(dt_end.strftime('%m-%d-%Y'))
-        elif group == 'season':
-            sample_size = 14
-            start_dates = ['12-1-2015', '3-1-2016', '6-1-2016', '9-1-2016']
-            end_dates = ['2-29-2016', '5-31-2016', '8-31-2016', '11-30-2016']
-
-        for t0, t1 in zip(start_dates, end_dates):
-            if not isinstance(t0, int):  # if t0 is not integer, define date
-                t0 = cf.format_dates(t0)
-
-            if not isinstance(t1, int):  # if t1 is not integer, define date
-                t1 = cf.format_dates(t1)
-
-            if isinstance(t0, int):  # if t0 is integer, redefine as t1-[t0 days]
-                t0 = t1-timedelta(days=t0)
-
-            if isinstance(t1, int):  # if t1 is integer, redefine as t0+[t1 days]
-                t1 = t0+timedelta(days=t1)
-
-            # define array of times
-            times = pd.to_datetime(np.arange(t0, t1+timedelta(days=1), timedelta(days=1)))
-            month = t0.strftime('%Y%m')
-            print('Year-month: {}'.format(month))
-
-            all_years = np.unique(times.year)
-            #all_years = np.append(all_years, 9999)  # 9999 buoy year is for 'real-time' data (past 45 days)
-
-            # get buoy SST data
-            buoy_dict = cf.get_buoy_data(buoy, all_years, t0, t1)
 
+        for month, buoy_dicts, sat_buoys in periods:
+            buoy_dict = buoy_dicts[buoy]
             buoy_full = pd.DataFrame(data={'time': buoy_dict['t'], 'buoy_sst': buoy_dict['sst']})
             buoy_full.drop_duplicates(inplace=True)
             buoy_full = buoy_full.dropna()
@@ -204,63 +290,7 @@ def main(start, end, buoys, avgrad, sDir, group):
             # monthly analysis: must be at least 5 days of buoy data
             # seasonal analysis: must be at least 15 days of buoy data
             if len(buoy_daily) > sample_size:
-                buoylon = buoy_dict['lon']
-                buoylat = buoy_dict['lat']
-
-                sat_data_sport = {'t': np.array([], dtype='datetime64[ns]'), 'sst': np.array([])}
-                sat_data_rtg = {'t': np.array([], dtype='datetime64[ns]'), 'sst': np.array([])}
-                sat_data_avhrr = {'t': np.array([], dtype='datetime64[ns]'), 'sst': np.array([])}
-                for tm in times:
-                    print(tm)
-                    dd = datetime.strftime(tm, '%Y%m%d')
-                    fmdt = np.datetime64(datetime.strptime(dd, '%Y%m%d'))
-
-                    for model in models:
-                        if model == 'sport':
-                            # get SPoRT data
-                            sp_file = glob.glob(bpudatadir + 'sport_nc/' + dd + '*.nc')
-                            if len(sp_file) == 1:
-                                try:
-                                    svalue = cf.append_satellite_sst_data(sp_file[0], buoylat, buoylon, avgrad, 'sport',
-                                                                          'TMP_P0_L1_GLL0')
-                                    sat_data_sport['sst'] = np.append(sat_data_sport['sst'], svalue)
-                                    sat_data_sport['t'] = np.append(sat_data_sport['t'], fmdt)
-                                except:
-                                    print('Issue reading from {}'.format(sp_file[0]))
-
-                            else:
-                                print('{} files found for SPoRT at time {}'.format(str(len(sp_file)), tm.strftime('%Y-%m-%d')))
-
-                        if model == 'rtg':
-                            # get RTG data
-                            rtg_files = []
-                            rtg_dir = '{}{}/{}/'.format(bpudatadir, 'rtg_nc', str(tm.year))
-                            for file in os.listdir(rtg_dir):
-                                if file.startswith('rtg_sst_grb') and file.endswith('{}.nc'.format(dd)):
-                                    rtg_files.append(os.path.join(rtg_dir, file))
-                            if len(rtg_files) == 1:
-                                # take the closest grid cell to the buoy (RTG has full-coverage)
-                                svalue = cf.append_satellite_sst_data(rtg_files[0], buoylat, buoylon, 'closest', 'rtg',
-                                                                      'TMP_173_SFC')
-                                sat_data_rtg['sst'] = np.append(sat_data_rtg['sst'], svalue)
-                                sat_data_rtg['t'] = np.append(sat_data_rtg['t'], fmdt)
-
-                            else:
-                                print('{} files found for RTG at time {}'.format(str(len(rtg_files)), tm.strftime('%Y-%m-%d')))
-
-                        if model == 'avhrr':
-                            # daily AVHRR daily coldest pixel composite
-                            satfile = '{}daily_avhrr/composites/{}/avhrr_coldest-pixel_{}.nc'.format(bpudatadir,
-                                                                                                     tm.strftime('%Y'),
-                                                                                                     tm.strftime(
-                                                                                                         '%Y%m%d'))
-                            try:
-                                cvalue = cf.append_satellite_sst_data(satfile, buoylat, buoylon, avgrad, 'daily_avhrr',
-                                                                      'sst')
-                                sat_data_avhrr['sst'] = np.append(sat_data_avhrr['sst'], cvalue)
-                                sat_data_avhrr['t'] = np.append(sat_data_avhrr['t'], fmdt)
-                            except:
-                                print('Issue reading from {}'.format(satfile))
+                sat_data_sport, sat_data_rtg, sat_data_avhrr = sat_buoys[buoy]
 
                 # merge SPoRT with buoy data
                 [df_sport, rmse_sport, n_sport] = combine_datasets(sat_data_sport, buoy_daily, all_data_sport, buoy,
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+@brief Create rolling N-day coldest pixel composites (e.g. the 3-day avhrr3 product) from the daily composites
+(avhrr_coldest-pixel_YYYYMMDD.nc) instead of the AVHRR passes. Each daily is read once for all window lengths
+@usage
+python AvhrrColdestPixelComposite_NDay.py template_file daily_dir out_dir start_date end_date N [N ...]
+daily_dir: directory of daily composites, either directly or in yearly subdirectories (daily_dir/YYYY/)
+start_date, end_date: first and last output day (mm-dd-yyyy, 'today' or 'yesterday'); each N-day composite ends on,
+and includes, its output day
+Each composite is written to out_dir/YYYY/avhrr_coldest-pixel_<N>day_YYYYMMDD.nc
+"""
+
+from sys import argv
+import os
+import time
+from datetime import timedelta
+import functions.common as cf
+import functions.coldest_pixel as cp
+
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+
+
+def find_daily(daily_dir, d):
+    fname = 'avhrr_coldest-pixel_{}.nc'.format(d.strftime('%Y%m%d'))
+    for f in [os.path.join(daily_dir, str(d.year), fname), os.path.join(daily_dir, fname)]:
+        if os.path.isfile(f):
+            return f
+    return None
+
+
+def main(template_file, daily_dir, out_dir, start_date, end_date, n_days):
+    start_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    end_date = end_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    days = [start_date + timedelta(n) for n in range(int((end_date - start_date).days) + 1)]
+
+    # daily composites of the output days and the max(n_days) - 1 days before them
+    daily_files = dict()
+    for n in range(-(max(n_days) - 1), len(days)):
+        d = start_date + timedelta(n)
+        f = find_daily(daily_dir, d)
+        if f is not None:
+            daily_files[d] = f
+        else:
+            print('No daily composite for {}'.format(d.strftime('%Y-%m-%d')))
+
+    t0 = time.time()
+    n_written = 0
+    for d, n, acc in cp.sliding_composites(days, daily_files, n_days):
+        save_dir = os.path.join(out_dir, str(d.year))
+        cf.create_dir(save_dir)
+        out_file = os.path.join(save_dir, 'avhrr_coldest-pixel_{}day_{}.nc'.format(n, d.strftime('%Y%m%d')))
+        cp.write_composite(template_file, out_file, d, acc, n_days=n)
+        n_written += 1
+        print('{} {}-day: {} passes, written to {}'.format(d.strftime('%Y-%m-%d'), n, acc.n_passes, out_file))
+
+    print('{} composites from {} dailies in {:.1f} s'.format(n_written, len(daily_files), time.time() - t0))
+
+
+if __name__ == '__main__':
+    template_file, daily_dir, out_dir = argv[1:4]
+    start_date = cf.format_dates(argv[4])
+    end_date = cf.format_dates(argv[5])
+    n_days = [int(n) for n in argv[6:]]
+    main(template_file, daily_dir, out_dir, start_date, end_date, n_days)
@@ -1,11 +1,17 @@
 from sys import argv, exit
-script, template_file = argv
+script, template_file = argv[:2]
+# optional storage profile for the gridded variables: 'map', 'point' or 'balanced' (see
+# functions.template.STORAGE_PROFILES and benchmarks/composite_storage_profiles.py); default netCDF chunking if not
+# given
+profile=argv[2] if len(argv)>2 else None
 
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 from netCDF4 import Dataset
 import numpy as np
+import functions.template as tp
+import functions.coldest_pixel as cp
 # import time
 # import xarray as xr
 
@@ -53,9 +59,11 @@ time_var=temp.createVariable('time','f8',('time',),zlib=True,least_significant_d
 lon_var=temp.createVariable('lon','f4',('lon',))#,zlib=True,complevel=4)
 lat_var=temp.createVariable('lat','f4',('lat',))#,zlib=True,complevel=4)
 z_var=temp.createVariable('z','f4',('z',))#,zlib=True,complevel=4)
-mask_var=temp.createVariable('mask','i1',('lat','lon',),zlib=True,complevel=4)
-sst_var=temp.createVariable('sst','f4',('time','z','lat','lon',),fill_value=-999,zlib=True,complevel=4)
-flag_var=temp.createVariable('sst_qc_flag','i4',('time','z','lat','lon',),fill_value=-1,zlib=True,complevel=4)
+mask_var=temp.createVariable('mask','i1',('lat','lon',),**tp.storage_options(profile,(len(lat_new),len(lon_new))))
+sst_var=temp.createVariable('sst','f4',('time','z','lat','lon',),fill_value=-999,
+    **tp.storage_options(profile,(1,1,len(lat_new),len(lon_new))))
+flag_var=temp.createVariable('sst_qc_flag','i4',('time','z','lat','lon',),fill_value=-1,
+    **tp.storage_options(profile,(1,1,len(lat_new),len(lon_new))))
 platform_var=temp.createVariable('platform',str,(),zlib=True,complevel=4)
 start_var=temp.createVariable('composite_start_time','i1',('time',),fill_value=-1,zlib=True,complevel=4)
 end_var=temp.createVariable('composite_end_time','i1',('time',),fill_value=-1,zlib=True,complevel=4)
@@ -224,6 +232,8 @@ sun_var.comment=["if provided, all data points, regardless of time of day, " +
     "given number; if -999, included data is based on defined time window " +
     "for satellite passes (see 'composite_start_time' and 'composite_end_time')"]
 
+# per-pixel provenance variables (pass index, observation time, observation count and spread), chunked like sst
+cp.add_provenance_variables(temp)
 
 # write variables
 # fill in time later
@@ -3,153 +3,180 @@
 @author Laura Nazarro
 @modified by Lori Garzio on 1/8/2019
 @brief Create daily composite coldest pixel netCDF files for historical AVHRR satellite data (from 9/1/2013 to 9/19/2018)
+@usage
+catalog_file: SQLite index of the pass files in avhrr_dir (see functions.pass_catalog), created or refreshed at the
+start of each run
+n_workers: number of worker processes; each day is composited independently. 1 runs every day in this process
+retries: number of times a day that failed is resubmitted before it is reported as failed
+tile_size: None to composite the whole grid at once, or (lat, lon) tile size to build each composite tile by tile
+with bounded memory (see functions.coldest_pixel.tiled_daylight_composite), e.g. when running many days side by side on
+the 1 km MUR-subset grid
+regrid_method: 'bilinear', or 'conservative' to average all the AVHRR pixels in each grid cell (area-weighted) instead
+of interpolating between the nearest ones, for grids that are coarser than the passes (e.g. the 9 km WRF grid)
+archive_store: None, or a regional Zarr archive (see functions.composite_archive) that every composite is also written
+to; it's created or extended to cover start_date to end_date before the days are processed, so the workers write their
+days side by side
 """
 
-from netCDF4 import date2num, Dataset
-import numpy as np
 import time
-import subprocess
 import os
+import traceback
 from datetime import datetime, timedelta
-from mpl_toolkits.basemap import interp
+from multiprocessing import Pool
 import functions.common as cf
+import functions.coldest_pixel as cp
+import functions.regrid as rg
+import functions.template as tp
+import functions.pass_catalog as pc
+import functions.composite_archive as ca
 
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
+# contributors added to the template's for the reprocessed composites
+CONTRIBUTORS = [('Lori Garzio', 'Data Manager')]
 
-# daylight hours limits for each month
-H0_lst = [14, 14, 13, 13, 12, 12, 12, 12, 13, 13, 14, 14]
-H1_lst = [20, 20, 20, 22, 22, 23, 23, 23, 21, 20, 20, 20]
-
-#template_file = '/Volumes/boardwalk/coolgroup/bpu/wrf/data/daily_avhrr/templates/wrf_9km_template.nc'
-template_file = '/Users/lgarzio/Documents/rucool/satellite/coldest_pixel/wrf_9km_template.nc'
-avhrr_dir = '/Volumes/boardwalk/coolgroup/bpu/wrf/data/avhrr_nc/'
-out_dir = '/Users/lgarzio/Documents/rucool/satellite/coldest_pixel/daily_avhrr/composites'
-#start_date = datetime(2013, 9, 1)
-#end_date = datetime(2018, 9, 20)
-#template_file = '/home/lgarzio/rucool/satellite/coldest_pixel/wrf_9km_template.nc'
-#avhrr_dir = '/home/coolgroup/bpu/wrf/data/avhrr_nc/'
-#out_dir = '/home/lgarzio/rucool/satellite/coldest_pixel/daily_avhrr/composites'
-#start_date = datetime(2016, 1, 1)
-#end_date = datetime(2017, 1, 1)
-
-start_date = datetime(2013, 12, 13)
-end_date = datetime(2013, 12, 14)
-
-for n in range(int((end_date - start_date).days)):
-    d = start_date + timedelta(n)
-    yr = d.year
+
+def composite_day(d, template_file, avhrr_dir, catalog_file, out_dir, regrid_cache_dir, tile_size, archive_store,
+                  regrid_method):
     save_dir = os.path.join(out_dir, str(d.year))
     cf.create_dir(save_dir)
-    dd = datetime.strftime(d, '%y%m%d')
-    avhrr_files = []
-    for file in os.listdir(avhrr_dir):
-        if file.startswith(dd) and file.endswith('.CF.nc'):
-            avhrr_files.append(os.path.join(avhrr_dir, file))
-    print(avhrr_files)
+    # passes of the day from the pass catalog (refreshed once in main)
+    catalog = pc.PassCatalog(catalog_file)
+    avhrr_files = [p['path'] for p in catalog.query(d, d + timedelta(days=1), directory=avhrr_dir)]
+    catalog.close()
+
+    n_passes = 0
+    rejected = dict()
     if len(avhrr_files) > 0:
         print('\nProcessing files: {}'.format(datetime.strftime(d, '%Y-%m-%d')))
         out_file = os.path.join(save_dir, 'avhrr_coldest-pixel_{}.nc'.format(datetime.strftime(d, '%Y%m%d')))
 
         # select pre-defined daylight hour limits for that month
-        H0 = H0_lst[d.month - 1]
-        H1 = H1_lst[d.month - 1]
-
-        # copy the template file with the new file name
-        subprocess.call("cp " + template_file + " " + out_file, shell=True)
-
-        sst_file = Dataset(out_file, "a")
-        lon = sst_file.variables['lon']
-        lat = sst_file.variables['lat']
-
-        lonx, laty = np.meshgrid(lon[:], lat[:])
-
-        pass_info = ''
-        minT = np.empty(np.shape(lonx))
-        minT[:] = np.nan
-
-        for avhrr in avhrr_files:
-            print("processing", avhrr)
-            passH = avhrr[-18:-16]  # hour
-            passM = avhrr[-16:-14]  # minute
-            passS = avhrr[-12:-10]  # satelliteID (ie NOAA-19)
-
-            # check if the pass is within the daylight window defined by H0 and H1
-            # add pass to composite if it is
-            if int(passH) >= H0 and int(passH) < H1:
-                pass_info = pass_info + "NOAA-" + passS + " " + passH + ":" + passM + "GMT, "
-
-                # open AVHRR single-pass netcdf file and read grid
-                avhrr_data = Dataset(avhrr, "r")
-                avhrrlon = avhrr_data.variables['lon'][:]
-                avhrrlat = avhrr_data.variables['lat'][:]
-                # squeeze SST to remove time dimension and get 2D matrix
-                avhrrsst = np.squeeze(avhrr_data.variables['mcsst'])
-                avhrrsst_data = avhrrsst[:]
-                avhrrsst_data[avhrrsst_data == -999] = np.nan
-                try:
-                    # if any lons are masked, remove them
-                    if True in avhrrlon[:].mask:
-                        avhrrsst_data = avhrrsst_data[:, ~avhrrlon[:].mask]
-                        avhrrlon = avhrrlon[~avhrrlon[:].mask]
-                except:
-                    pass
-                try:
-                    # if any lats are masked, remove them
-                    if True in avhrrlat[:].mask:
-                        avhrrsst_data = avhrrsst_data[~avhrrlat[:].mask, :]
-                        avhrrlat = avhrrlat[~avhrrlat[:].mask]
-                except:
-                    pass
-
-                # reverse data array if lat values are descending
-                if avhrrlat[0] > avhrrlat[-1]:
-                    avhrrlat[:] = avhrrlat[::-1]
-                    avhrrsst_data = avhrrsst_data[::-1, :]
-                # reverse data array if lon values are descending
-                if avhrrlon[0] > avhrrlon[-1]:
-                    avhrrlon[:] = avhrrlon[::-1]
-                    avhrrsst_data = avhrrsst_data[:, ::-1]
-
-                # regrid AVHRR pass SST to the output composite grid
-                regrid_sst = interp(avhrrsst_data[:], avhrrlon[:], avhrrlat[:], lonx, laty)
-                # remove any data artifacts on the new grid that are outside the domain of the AVHRR grid
-                regrid_sst[lonx > np.max(avhrrlon[:])] = np.nan
-                regrid_sst[lonx < np.min(avhrrlon[:])] = np.nan
-                regrid_sst[laty > np.max(avhrrlat[:])] = np.nan
-                regrid_sst[laty < np.min(avhrrlat[:])] = np.nan
-
-                # replace any data points in composite grid with data from current
-                # AVHRR pass, as long as corresponding data points in the composite
-                # are 1) nans or 2) warmer than the new data
-                minT = np.fmin(minT, regrid_sst)
-                avhrr_data.close()
-
-        # add time
-        out_time = sst_file.variables['time']
-        out_time[0] = date2num(d, units=out_time.units, calendar=out_time.calendar)
-        # add sst
-        out_sst = sst_file.variables['sst']
-        minT[np.isnan(minT)] = -999
-        out_sst[0, 0, :, :] = minT
-        # add start time
-        out_start = sst_file.variables['composite_start_time']
-        out_start[:] = H0
-        # add end time
-        out_end = sst_file.variables['composite_end_time']
-        out_end[:] = H1
-        # add included passes
-        out_passes = sst_file.variables['included_passes']
-        out_passes[0] = pass_info[:-2]
-
-        # add date and time info to metadata
-        sst_file.date_created = time.strftime("%B-%d-%Y GMT", time.gmtime())
-        sst_file.time_coverage_start = d.strftime("%B-%d-%Y 00:00")
-        sst_file.time_coverage_end = d.strftime("%B-%d-%Y 23:59")
-        sst_file.date_modified = time.strftime("%B-%d-%Y GMT", time.gmtime())
-        sst_file.history = ["Created " + time.strftime("%B-%d-%Y GMT", time.gmtime())]
-        sst_file.contributor_name = sst_file.contributor_name + ', Lori Garzio'
-        sst_file.contributor_role = sst_file.contributor_role + ', Data Manager'
-
-        sst_file.close()
+        H0 = cp.H0_lst[d.month - 1]
+        H1 = cp.H1_lst[d.month - 1]
+
+        # new composite files are built from the template in memory (no copy of the template file)
+        template = tp.get_template(template_file)
+        lon_data = template.static_data['lon']
+        lat_data = template.static_data['lat']
+
+        if tile_size is None:
+            acc = cp.daylight_composite(avhrr_files, lon_data, lat_data, H0, H1,
+                                        regrid_cache_dir=regrid_cache_dir, method=regrid_method)
+            passes = acc.passes
+            rejected = acc.rejected
+            # sst, per-pixel provenance (pass index, observation time, observation count and spread) and metadata
+            cp.write_composite(template_file, out_file, d, acc, contributors=CONTRIBUTORS)
+        else:
+            with template.new_file(out_file) as sst_file:
+                # sst and the provenance layers are written tile by tile
+                passes, rejected = cp.tiled_daylight_composite(avhrr_files, sst_file.variables['sst'], lon_data,
+                                                               lat_data, H0, H1, tile_size=tile_size,
+                                                               method=regrid_method)
+                cp.write_composite_info(sst_file, d, passes, H0=H0, H1=H1, contributors=CONTRIBUTORS)
+        n_passes = len(passes)
+
+        if archive_store is not None:
+            ca.CompositeArchive(archive_store).append(out_file)
+
+    return n_passes, rejected
+
+
+def run_day(args):
+    # worker wrapper: never raise, so that one bad day doesn't take down the pool
+    d = args[0]
+    t0 = time.time()
+    try:
+        n_passes, rejected = composite_day(*args)
+        error = None
+    except Exception:
+        n_passes = 0
+        rejected = dict()
+        error = traceback.format_exc()
+    return dict(day=d, n_passes=n_passes, rejected=rejected, elapsed=time.time() - t0, error=error)
+
+
+def main(template_file, avhrr_dir, catalog_file, out_dir, regrid_cache_dir, start_date, end_date, n_workers, retries,
+         tile_size=None, archive_store=None, regrid_method='bilinear'):
+    days = [start_date + timedelta(n) for n in range(int((end_date - start_date).days))]
+    if archive_store is not None:
+        ca.open_archive(archive_store, template_file, start_date, days[-1])
+    # index the pass directory once (only new or changed files are read), instead of listing it for every day
+    pc.open_catalog(catalog_file, avhrr_dir).close()
+    t_start = time.time()
+    n_done = 0
+    n_passes = 0
+    n_rejected = 0
+    failed = []
+
+    todo = days
+    for attempt in range(retries + 1):
+        if len(todo) == 0:
+            break
+        if attempt > 0:
+            print('\nRetrying {} failed day(s) (attempt {} of {})'.format(len(todo), attempt, retries))
+        jobs = [(d, template_file, avhrr_dir, catalog_file, out_dir, regrid_cache_dir, tile_size, archive_store,
+                 regrid_method) for d in todo]
+        if n_workers > 1:
+            pool = Pool(n_workers)
+            results = pool.imap_unordered(run_day, jobs)
+        else:
+            pool = None
+            results = map(run_day, jobs)
+
+        failed = []
+        for r in results:
+            if r['error'] is None:
+                n_done += 1
+                n_passes += r['n_passes']
+                n_rejected += len(r['rejected'])
+                print('[{}/{}] {} finished: {} passes, {} rejected in {:.1f} s'.format(n_done, len(days),
+                                                                                     r['day'].strftime('%Y-%m-%d'),
+                                                                                     r['n_passes'],
+                                                                                     len(r['rejected']),
+                                                                                     r['elapsed']))
+            else:
+                failed.append(r)
+                print('{} failed:\n{}'.format(r['day'].strftime('%Y-%m-%d'), r['error']))
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+        todo = sorted([r['day'] for r in failed])
+
+    # throughput summary
+    elapsed = time.time() - t_start
+    print('\n{} of {} days composited ({} passes, {} rejected) in {:.1f} s with {} worker(s)'.format(
+        n_done, len(days), n_passes, n_rejected, elapsed, n_workers))
+    if elapsed > 0:
+        print('{:.1f} days/hour, {:.2f} passes/sec'.format(n_done / elapsed * 3600, n_passes / elapsed))
+    if len(failed) > 0:
+        print('Failed days: {}'.format(', '.join([r['day'].strftime('%Y-%m-%d') for r in failed])))
+
+
+if __name__ == '__main__':
+    #template_file = '/Volumes/boardwalk/coolgroup/bpu/wrf/data/daily_avhrr/templates/wrf_9km_template.nc'
+    template_file = '/Users/lgarzio/Documents/rucool/satellite/coldest_pixel/wrf_9km_template.nc'
+    avhrr_dir = '/Volumes/boardwalk/coolgroup/bpu/wrf/data/avhrr_nc/'
+    out_dir = '/Users/lgarzio/Documents/rucool/satellite/coldest_pixel/daily_avhrr/composites'
+    regrid_cache_dir = rg.template_cache_dir(template_file)  # shared with the daily and reprocess scripts
+    catalog_file = '/Users/lgarzio/Documents/rucool/satellite/coldest_pixel/avhrr_passes.db'
+    #start_date = datetime(2013, 9, 1)
+    #end_date = datetime(2018, 9, 20)
+    #template_file = '/home/lgarzio/rucool/satellite/coldest_pixel/wrf_9km_template.nc'
+    #avhrr_dir = '/home/coolgroup/bpu/wrf/data/avhrr_nc/'
+    #out_dir = '/home/lgarzio/rucool/satellite/coldest_pixel/daily_avhrr/composites'
+    #catalog_file = '/home/lgarzio/rucool/satellite/coldest_pixel/avhrr_passes.db'
+    #start_date = datetime(2016, 1, 1)
+    #end_date = datetime(2017, 1, 1)
+
+    start_date = datetime(2013, 12, 13)
+    end_date = datetime(2013, 12, 14)
+    n_workers = 4
+    retries = 2
+    tile_size = None  # e.g. (512, 512) for the 1 km MUR-subset template
+    archive_store = None  # e.g. '/Users/lgarzio/Documents/rucool/satellite/coldest_pixel/daily_avhrr/composites.zarr'
+    regrid_method = 'bilinear'  # 'conservative' for the 9 km WRF template
+    main(template_file, avhrr_dir, catalog_file, out_dir, regrid_cache_dir, start_date, end_date, n_workers, retries,
+         tile_size, archive_store, regrid_method)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+@brief Create the daily daylight window coldest pixel composite on several grids (e.g. the 1 km MUR-subset and the
+9 km WRF templates) from a single read of each AVHRR pass
+@usage
+python DailyAvhrrColdestPixelComposite_MultiTarget.py avhrr_dir proc_date H0 H1 target [target ...]
+proc_date: date (mm-dd-yyyy), 'today' or 'yesterday'
+H0, H1: daylight window (passes from H0:00 up to, not including, H1:00 GMT)
+target: 'template_file:out_dir' or 'template_file:out_dir:method', where method is 'bilinear' (default) or
+'conservative' (area-weighted average of all the AVHRR pixels in each grid cell, for grids coarser than the passes).
+Each composite is written to out_dir/avhrr_coldest-pixel_YYYYMMDD.nc, so every target needs its own out_dir
+"""
+
+from sys import argv
+import os
+import glob
+import functions.common as cf
+import functions.coldest_pixel as cp
+import functions.regrid as rg
+import functions.template as tp
+
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+
+
+def parse_target(target_str):
+    parts = target_str.split(':')
+    method = parts[2] if len(parts) > 2 else 'bilinear'
+    # targets are named by their output directory, so a template can be used more than once (e.g. with both methods)
+    # but two targets can't write to the same place
+    return dict(name=os.path.normpath(parts[1]), template_file=parts[0], out_dir=parts[1], method=method)
+
+
+def main(avhrr_dir, proc_date, H0, H1, targets):
+    d = cf.format_dates(proc_date)
+
+    # regridding weights are kept next to the first template and reused between runs
+    regrid_cache_dir = rg.template_cache_dir(targets[0]['template_file'])
+
+    # read the composite grids from the templates
+    for t in targets:
+        cf.create_dir(t['out_dir'])
+        template = tp.get_template(t['template_file'])
+        t['lon'] = template.static_data['lon']
+        t['lat'] = template.static_data['lat']
+
+    avhrr_files = sorted(glob.glob(os.path.join(avhrr_dir, d.strftime('%y%m%d') + '*.CF.nc')))
+    accs = cp.multi_target_composite(avhrr_files, targets, H0, H1, regrid_cache_dir=regrid_cache_dir)
+
+    for t in targets:
+        acc = accs[t['name']]
+        out_file = os.path.join(t['out_dir'], 'avhrr_coldest-pixel_{}.nc'.format(d.strftime('%Y%m%d')))
+        cp.write_composite(t['template_file'], out_file, d, acc)
+        print('{} ({}): {} passes, written to {}'.format(os.path.basename(t['template_file']), t['method'],
+                                                         acc.n_passes, out_file))
+
+
+if __name__ == '__main__':
+    avhrr_dir, proc_date = argv[1:3]
+    H0 = int(argv[3])
+    H1 = int(argv[4])
+    targets = [parse_target(t) for t in argv[5:]]
+    main(avhrr_dir, proc_date, H0, H1, targets)
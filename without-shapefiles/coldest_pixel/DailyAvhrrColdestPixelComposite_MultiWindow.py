@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+@brief Create several daily coldest pixel composites (e.g. daylight window, full day, monthly daylight hours) from a
+single read and regrid of each AVHRR pass
+@usage
+python DailyAvhrrColdestPixelComposite_MultiWindow.py template_file avhrr_dir out_dir proc_date window [window ...]
+proc_date: date (mm-dd-yyyy), 'today' or 'yesterday'
+window: 'name=H0-H1' (passes from H0:00 up to, not including, H1:00 GMT), e.g. 'daylight=15-20' or 'allday=0-24', or
+'name=monthly' for the pre-defined monthly daylight hours, or 'name=sunX' to include every pixel of every pass where
+the sun is at least X degrees above the horizon at that pixel and pass time. Each composite is written to
+out_dir/avhrr_coldest-pixel_<name>_YYYYMMDD.nc
+"""
+
+from sys import argv
+import os
+import glob
+from netCDF4 import Dataset
+import functions.common as cf
+import functions.coldest_pixel as cp
+import functions.regrid as rg
+
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+
+
+def main(template_file, avhrr_dir, out_dir, proc_date, windows):
+    d = cf.format_dates(proc_date)
+    cf.create_dir(out_dir)
+
+    # regridding weights are kept next to the template and reused between runs
+    regrid_cache_dir = rg.template_cache_dir(template_file)
+
+    # read the composite grid from the template
+    with Dataset(template_file, 'r') as temp:
+        lon_data = temp.variables['lon'][:]
+        lat_data = temp.variables['lat'][:]
+
+    avhrr_files = glob.glob(os.path.join(avhrr_dir, d.strftime('%y%m%d') + '*.CF.nc'))
+    accs = cp.multi_window_composite(avhrr_files, lon_data, lat_data, windows, d, regrid_cache_dir=regrid_cache_dir)
+
+    for w in windows:
+        acc = accs[w['name']]
+        out_file = os.path.join(out_dir, 'avhrr_coldest-pixel_{}_{}.nc'.format(w['name'], d.strftime('%Y%m%d')))
+        cp.write_composite(template_file, out_file, d, acc)
+        if acc.min_sun_angle is None:
+            desc = '{}-{} GMT'.format(acc.H0, acc.H1)
+        else:
+            desc = 'sun angle >= {}'.format(acc.min_sun_angle)
+        print('{} ({}): {} passes, written to {}'.format(w['name'], desc, acc.n_passes, out_file))
+
+
+if __name__ == '__main__':
+    template_file, avhrr_dir, out_dir, proc_date = argv[1:5]
+    windows = [cp.parse_window(w) for w in argv[5:]]
+    main(template_file, avhrr_dir, out_dir, proc_date, windows)
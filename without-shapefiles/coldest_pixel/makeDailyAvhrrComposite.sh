@@ -15,8 +15,8 @@ fi
 H0=15
 H1=20
 
-# create composite
-/home/nazzaro/miniconda3/envs/coldest_pixel/bin/python /home/coolgroup/bpu/wrf/code/python/DailyAvhrrColdestPixelComposite_DaylightWindow.py /home/coolgroup/bpu/wrf/data/daily_avhrr/templates/wrf_9km_template.nc /home/coolgroup/bpu/wrf/data/avhrr_nc/ /home/coolgroup/bpu/wrf/data/daily_avhrr/composites/$(date +%Y)/ today $H0 $H1
+# create composite (incremental: only passes that arrived since the last run are regridded and added)
+/home/nazzaro/miniconda3/envs/coldest_pixel/bin/python /home/coolgroup/bpu/wrf/code/python/DailyAvhrrColdestPixelComposite_DaylightWindow.py /home/coolgroup/bpu/wrf/data/daily_avhrr/templates/wrf_9km_template.nc /home/coolgroup/bpu/wrf/data/avhrr_nc/ /home/coolgroup/bpu/wrf/data/daily_avhrr/composites/$(date +%Y)/ today $H0 $H1 incremental
 
 # create image
 /home/nazzaro/miniconda3/envs/coldest_pixel/bin/python /home/coolgroup/bpu/wrf/code/python/PlotColdestPixel.py /home/coolgroup/bpu/wrf/data/daily_avhrr/composites/$(date +%Y)/avhrr_coldest-pixel_$(date +%Y%m%d).nc /home/coolgroup/bpu/wrf/data/daily_avhrr/images/$(date +%Y)/avhrr_coldest-pixel_$(date +%Y%m%d).png
@@ -1,2 +1,10 @@
 from . import common
-from . import plotting
\ No newline at end of file
+from . import plotting
+from . import regrid
+from . import solar
+from . import template
+from . import coldest_pixel
+from . import pass_catalog
+from . import composite_archive
+from . import grid_index
+from . import sst_cube
\ No newline at end of file
@@ -0,0 +1,937 @@
+#! /usr/bin/env python
+
+import glob
+import multiprocessing as mp
+import os
+import re
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+from netCDF4 import date2num, Dataset
+import functions.regrid as rg
+import functions.solar as solar
+import functions.template as tp
+
+
+# daylight hours limits for each month
+H0_lst = [14, 14, 13, 13, 12, 12, 12, 12, 13, 13, 14, 14]
+H1_lst = [20, 20, 20, 22, 22, 23, 23, 23, 21, 20, 20, 20]
+
+
+def parse_pass_filename(avhrr_file):
+    """
+    Get the pass time and satellite from an AVHRR pass file name (YYMMDD.DOY.HHMM.nNN.BPU.CF.nc)
+    :param avhrr_file: path to an AVHRR single-pass netCDF file
+    :return: pass hour, pass minute and satellite ID as strings
+    """
+    passH = avhrr_file[-18:-16]  # hour
+    passM = avhrr_file[-16:-14]  # minute
+    passS = avhrr_file[-12:-10]  # satelliteID (ie NOAA-19)
+    return passH, passM, passS
+
+
+def pass_datetime(avhrr_file):
+    # pass time (GMT) from the file name
+    fname = os.path.basename(avhrr_file)
+    return datetime.strptime(fname[:6] + fname[-18:-14], '%y%m%d%H%M')
+
+
+def pass_file_name(d, passH, passM, passS):
+    # AVHRR pass file name for a pass time and satellite (inverse of parse_pass_filename)
+    return '{}.{:03d}.{}{}.n{}.BPU.CF.nc'.format(d.strftime('%y%m%d'), d.timetuple().tm_yday, passH, passM, passS)
+
+
+def pass_label(passH, passM, passS):
+    # pass description used in the 'included_passes' variable
+    return "NOAA-" + passS + " " + passH + ":" + passM + "GMT"
+
+
+def overlap_slice(coord, cmin, cmax):
+    """
+    Index range of a 1D coordinate (ascending or descending, possibly masked) that covers [cmin, cmax], including the
+    nearest valid point on each side so that every point in [cmin, cmax] can be interpolated
+    :return: slice, or None if the coordinate doesn't overlap [cmin, cmax]
+    """
+    c = np.ma.filled(np.ma.asarray(coord, dtype='f8'), np.nan)
+    valid = np.flatnonzero(~np.isnan(c))
+    below = valid[c[valid] < cmin]
+    above = valid[c[valid] > cmax]
+    inside = valid[np.logical_and(c[valid] >= cmin, c[valid] <= cmax)]
+    if len(inside) > 0:
+        i0 = inside[0]
+        i1 = inside[-1]
+        if np.any(valid < i0):
+            i0 = valid[valid < i0][-1]
+        if np.any(valid > i1):
+            i1 = valid[valid > i1][0]
+    elif len(below) > 0 and len(above) > 0:
+        # [cmin, cmax] falls between two neighbouring points
+        i0 = min(below[-1], above[-1])
+        i1 = max(below[0], above[0])
+    else:
+        return None
+    return slice(int(i0), int(i1) + 1)
+
+
+def format_pass_info(passes, dated=False):
+    # string for the 'included_passes' variable (passes labeled with their date for multi-day composites)
+    if dated:
+        return ', '.join([pass_datetime(p).strftime('%Y-%m-%d ') + pass_label(*parse_pass_filename(p))
+                          for p in passes])
+    return ', '.join([pass_label(*parse_pass_filename(p)) for p in passes])
+
+
+def parse_pass_info(pass_info, d):
+    """
+    Pass file names from an 'included_passes' string of a daily composite (inverse of format_pass_info)
+    :param pass_info: 'included_passes' string, e.g. 'NOAA-19 15:45GMT, NOAA-18 18:10GMT'
+    :param d: datetime of the composite
+    :return: list of pass file names
+    """
+    return [pass_file_name(d, passH, passM, passS)
+            for passS, passH, passM in re.findall(r'NOAA-(\d+) (\d\d):(\d\d)GMT', pass_info)]
+
+
+def read_avhrr_pass(avhrr_file, bounds=None):
+    """
+    Read the SST from an AVHRR single-pass file, removing masked coordinates and flipping the data so that lon and
+    lat are ascending
+    :param avhrr_file: path to an AVHRR single-pass netCDF file
+    :param bounds: optional [min lon, max lon, min lat, max lat] of the composite grid; only the part of the pass
+    that covers it is read from disk
+    :return: lon, lat and 2D (lat, lon) SST with -999 converted to nans, or None if the pass doesn't overlap bounds
+    """
+    avhrr_data = Dataset(avhrr_file, "r")
+    avhrrlon = avhrr_data.variables['lon'][:]
+    avhrrlat = avhrr_data.variables['lat'][:]
+    if bounds is None:
+        lon_ind = slice(None)
+        lat_ind = slice(None)
+    else:
+        lon_ind = overlap_slice(avhrrlon, bounds[0], bounds[1])
+        lat_ind = overlap_slice(avhrrlat, bounds[2], bounds[3])
+        if lon_ind is None or lat_ind is None:
+            avhrr_data.close()
+            return None
+        avhrrlon = avhrrlon[lon_ind]
+        avhrrlat = avhrrlat[lat_ind]
+    # read the hyperslab and remove the time dimension to get a 2D matrix
+    avhrrsst_data = avhrr_data.variables['mcsst'][..., lat_ind, lon_ind]
+    avhrrsst_data = avhrrsst_data.reshape(avhrrsst_data.shape[-2:])
+    avhrr_data.close()
+    avhrrsst_data[avhrrsst_data == -999] = np.nan
+
+    # remove masked lons/lats and make both ascending
+    avhrrlon, avhrrlat, avhrrsst_data = rg.clean_source_grid(avhrrlon, avhrrlat, avhrrsst_data)
+
+    return avhrrlon, avhrrlat, avhrrsst_data
+
+
+def grid_bounds(lon, lat, method='bilinear'):
+    """
+    Extent of a composite grid that a pass has to cover to be regridded: the outermost grid points for bilinear
+    interpolation, and the outer edges of the outermost grid cells for conservative regridding
+    :return: [min lon, max lon, min lat, max lat]
+    """
+    if method == 'conservative':
+        lon_lo, lon_hi = rg.cell_edges(lon)
+        lat_lo, lat_hi = rg.cell_edges(lat)
+        return [np.min(lon_lo), np.max(lon_hi), np.min(lat_lo), np.max(lat_hi)]
+    return [np.min(lon), np.max(lon), np.min(lat), np.max(lat)]
+
+
+def screen_pass(avhrr_file, bounds, step=8):
+    """
+    Cheap check of whether an AVHRR pass can add anything to a composite, before it is read in full and regridded.
+    Only the coordinates and a decimated sample (every step-th row and column) of the SST over the composite grid are
+    read. A pass whose clear pixels all fall between the sampled rows and columns (clear patches smaller than about
+    step x step pixels) is rejected too; use step=1 to check every pixel
+    :param avhrr_file: path to an AVHRR single-pass netCDF file
+    :param bounds: [min lon, max lon, min lat, max lat] of the composite grid (see grid_bounds)
+    :param step: decimation of the SST sample
+    :return: None if the pass should be composited, otherwise the reason it was rejected
+    """
+    try:
+        with Dataset(avhrr_file, "r") as avhrr_data:
+            lon_ind = overlap_slice(avhrr_data.variables['lon'][:], bounds[0], bounds[1])
+            lat_ind = overlap_slice(avhrr_data.variables['lat'][:], bounds[2], bounds[3])
+            if lon_ind is None or lat_ind is None:
+                return 'outside the composite grid'
+            sample = avhrr_data.variables['mcsst'][..., slice(lat_ind.start, lat_ind.stop, step),
+                                                   slice(lon_ind.start, lon_ind.stop, step)]
+    except (OSError, KeyError, IndexError) as e:
+        return 'unreadable ({})'.format(e)
+    sample = np.ma.filled(np.ma.asarray(sample, dtype='f4'), np.nan)
+    if not np.any(np.logical_and(~np.isnan(sample), sample != -999)):
+        return 'no valid SST over the composite grid (1/{} sample)'.format(step)
+    return None
+
+
+class ColdestPixelAccumulator(object):
+    """
+    Running coldest pixel composite and the list of passes folded into it. The composite is defined either by a
+    daylight window (H0, H1) or by a minimum sun angle. Along with the composite, the same reduction keeps per-pixel
+    provenance: the index (in passes) of the pass that gave the coldest value, the number of valid observations and
+    the warmest valid value (spread = maxT - minT)
+    """
+    def __init__(self, shape, H0=None, H1=None, min_sun_angle=None, method=None):
+        # float32, like the regridded passes and the sst variable
+        self.minT = np.full(shape, np.nan, dtype='f4')
+        self.maxT = np.full(shape, np.nan, dtype='f4')
+        self.pass_index = np.full(shape, -1, dtype='i2')  # -1 where there is no data
+        self.n_obs = np.zeros(shape, dtype='i2')
+        self.H0 = H0
+        self.H1 = H1
+        self.min_sun_angle = min_sun_angle
+        self.method = method  # regridding method of the passes, None if unknown
+        self.passes = []  # file names of the passes in the composite
+        self.rejected = dict()  # file name: reason, for passes rejected by screen_pass (not kept between runs)
+        self.provenance = True  # False if built from composites without provenance layers
+
+    @property
+    def n_passes(self):
+        return len(self.passes)
+
+    def add(self, avhrr_file, regrid_sst, mask=None):
+        # replace any data points in composite grid with data from current
+        # AVHRR pass, as long as corresponding data points in the composite
+        # are 1) nans or 2) warmer than the new data
+        # (if a mask is given, only points where it is True are considered)
+        self.fold(regrid_sst, len(self.passes), mask=mask)
+        self.passes.append(os.path.basename(avhrr_file))
+
+    def fold(self, regrid_sst, index, mask=None):
+        """
+        Fold a regridded pass into the composite and its provenance layers
+        :param regrid_sst: 2D SST on the composite grid, nans where there is no data
+        :param index: pass index recorded where this pass gives the coldest value
+        :param mask: optional boolean array, only points where it is True are considered
+        """
+        valid = ~np.isnan(regrid_sst)
+        if mask is not None:
+            valid &= mask
+        # points where this pass is colder than the composite (nans in the composite never compare as colder)
+        colder = np.logical_and(valid, ~(regrid_sst >= self.minT))
+        np.copyto(self.minT, regrid_sst, where=colder)
+        np.copyto(self.pass_index, index, where=colder)
+        np.fmax(self.maxT, regrid_sst, out=self.maxT, where=valid)
+        np.add(self.n_obs, 1, out=self.n_obs, where=valid)
+
+    def merge(self, other, earlier=False):
+        """
+        Fold another composite on the same grid (e.g. the composite of another day) into this one
+        :param other: ColdestPixelAccumulator
+        :param earlier: True if the passes of other come before the passes of this composite; they are listed first
+        :return: this accumulator
+        """
+        offset = 0 if earlier else len(self.passes)
+        if earlier:
+            self.pass_index[self.pass_index >= 0] += len(other.passes)
+            self.passes = other.passes + self.passes
+        else:
+            self.passes = self.passes + other.passes
+        self.combine(other, offset=offset)
+        self.provenance = self.provenance and other.provenance
+        # the window is only kept if it is the same for both composites
+        if (self.H0, self.H1, self.min_sun_angle) != (other.H0, other.H1, other.min_sun_angle):
+            self.H0, self.H1, self.min_sun_angle = None, None, None
+        if self.method != other.method:
+            self.method = None
+        return self
+
+    def combine(self, other, offset=0):
+        """
+        Fold the composite and provenance layers of another accumulator on the same grid into this one, leaving the
+        list of passes alone (the pass indices of other, shifted by offset, must refer to this accumulator's passes)
+        """
+        colder = np.logical_and(~np.isnan(other.minT), ~(other.minT >= self.minT))
+        np.copyto(self.minT, other.minT, where=colder)
+        np.copyto(self.pass_index, other.pass_index + offset, where=colder)
+        np.fmax(self.maxT, other.maxT, out=self.maxT)
+        self.n_obs += other.n_obs
+
+    def copy(self):
+        acc = ColdestPixelAccumulator(self.minT.shape, H0=self.H0, H1=self.H1, min_sun_angle=self.min_sun_angle,
+                                      method=self.method)
+        acc.minT[:] = self.minT
+        acc.maxT[:] = self.maxT
+        acc.pass_index[:] = self.pass_index
+        acc.n_obs[:] = self.n_obs
+        acc.passes = list(self.passes)
+        acc.provenance = self.provenance
+        return acc
+
+    def reject(self, avhrr_file, reason):
+        self.rejected[os.path.basename(avhrr_file)] = reason
+        print('{} rejected: {}'.format(os.path.basename(avhrr_file), reason))
+
+    def contains(self, avhrr_file):
+        return os.path.basename(avhrr_file) in self.passes
+
+    def pass_info(self):
+        return format_pass_info(self.passes)
+
+    def save(self, state_file):
+        # write to a temporary file first so that an interrupted run never leaves a partial state file
+        tmp_file = '{}.{}.tmp.npz'.format(state_file[:-len('.npz')], os.getpid())
+        window = [self.H0, self.H1, self.min_sun_angle]
+        np.savez_compressed(tmp_file, minT=self.minT, maxT=self.maxT, pass_index=self.pass_index, n_obs=self.n_obs,
+                            passes=np.array(self.passes, dtype=str),
+                            window=np.array([-999 if w is None else w for w in window]),
+                            method=np.array('' if self.method is None else self.method))
+        os.replace(tmp_file, state_file)
+
+    @classmethod
+    def load(cls, state_file):
+        f = np.load(state_file)
+        H0, H1, min_sun_angle = [None if w == -999 else int(w) for w in f['window']]
+        # states saved without a method have None, which never matches a requested method
+        method = str(f['method']) if 'method' in f and str(f['method']) != '' else None
+        acc = cls(f['minT'].shape, H0=H0, H1=H1, min_sun_angle=min_sun_angle, method=method)
+        acc.minT[:] = f['minT']
+        acc.maxT[:] = f['maxT']
+        acc.pass_index[:] = f['pass_index']
+        acc.n_obs[:] = f['n_obs']
+        acc.passes = [str(p) for p in f['passes']]
+        return acc
+
+
+def read_composite(composite_file):
+    """
+    Read a daily composite file back into an accumulator: composite SST, passes, daylight window or sun angle and,
+    if the file has them, the provenance layers
+    :param composite_file: daily composite netCDF file
+    :return: datetime of the composite, ColdestPixelAccumulator
+    """
+    with Dataset(composite_file, 'r') as nc:
+        d = datetime.strptime(nc.time_coverage_start, '%B-%d-%Y %H:%M')
+        minT = np.ma.filled(nc.variables['sst'][0, 0, :, :].astype('f4'), np.nan)
+        minT[minT == -999] = np.nan
+        window = []
+        for name in ['composite_start_time', 'composite_end_time', 'minimum_sun_angle']:
+            w = nc.variables[name][0] if name in nc.variables else np.ma.masked
+            window.append(None if np.ma.is_masked(w) else int(w))
+        acc = ColdestPixelAccumulator(minT.shape, *window)
+        acc.minT[:] = minT
+        pass_info = nc.variables['included_passes'][0]
+        acc.passes = parse_pass_info(pass_info if isinstance(pass_info, str) else '', d)
+        if 'sst_pass_index' in nc.variables:
+            acc.pass_index[:] = np.ma.filled(nc.variables['sst_pass_index'][0, 0, :, :], -1)
+            acc.n_obs[:] = np.ma.filled(nc.variables['sst_count'][0, 0, :, :], 0)
+            acc.maxT[:] = minT + np.ma.filled(nc.variables['sst_spread'][0, 0, :, :].astype('f4'), np.nan)
+        else:
+            acc.maxT[:] = minT
+            acc.provenance = False
+    return d, acc
+
+
+def sliding_composites(days, daily_files, n_days):
+    """
+    Rolling multi-day coldest pixel composites from daily composites. The last max(n_days) dailies are kept in
+    memory, so each daily is read once however many window lengths are made: every output day reads one new daily
+    and drops the oldest one
+    :param days: consecutive output days (datetimes); each N-day composite ends on (and includes) its output day
+    :param daily_files: dictionary of day: daily composite file; days without a file add nothing to the composites
+    :param n_days: list of window lengths (days)
+    :return: generator of (day, N, ColdestPixelAccumulator); windows with no dailies at all are skipped
+    """
+    max_n = max(n_days)
+    window = deque(maxlen=max_n)  # dailies (or None) of the last max_n days, oldest first
+    first_day = days[0] - timedelta(days=max_n - 1)
+    for n in range(int((days[-1] - first_day).days) + 1):
+        d = first_day + timedelta(days=n)
+        if d in daily_files:
+            window.append(read_composite(daily_files[d])[1])
+        else:
+            window.append(None)
+        if d < days[0]:
+            continue
+
+        # fold the dailies from the newest back, handing out each window length on the way
+        running = None
+        for k, daily in enumerate(reversed(window)):
+            if daily is not None:
+                running = daily.copy() if running is None else running.merge(daily, earlier=True)
+            if k + 1 in n_days and running is not None:
+                yield d, k + 1, running.copy()
+
+
+def state_file_name(out_file, state_dir):
+    # running composite state of an output file, kept in a work directory apart from the published composites
+    return os.path.join(state_dir, os.path.splitext(os.path.basename(out_file))[0] + '.state.npz')
+
+
+def remove_closed_states(state_dir, d):
+    """
+    Remove the running composite states of the days before d: their composites are final, so the states won't be
+    updated again
+    :param state_dir: directory of the state files (see state_file_name)
+    :param d: datetime of the first day whose state is kept
+    """
+    for state_file in glob.glob(os.path.join(state_dir, '*_????????.state.npz')):
+        day = datetime.strptime(state_file[-len('YYYYMMDD.state.npz'):-len('.state.npz')], '%Y%m%d')
+        if day.date() < d.date():
+            os.remove(state_file)
+
+
+def load_state(state_file, shape, H0, H1, method='bilinear'):
+    """
+    Load the running composite for an output file, as long as it was built on the same grid and daylight window and
+    with the same regridding method
+    :return: ColdestPixelAccumulator, or None if there is no usable state
+    """
+    if not os.path.isfile(state_file):
+        return None
+    try:
+        acc = ColdestPixelAccumulator.load(state_file)
+    except (OSError, ValueError, KeyError):
+        print('Unreadable composite state {}, starting over'.format(state_file))
+        return None
+    if acc.minT.shape != tuple(shape) or acc.H0 != H0 or acc.H1 != H1 or acc.method != method:
+        print('Composite state {} does not match the grid, daylight window or regridding method, starting over'
+              .format(state_file))
+        return None
+    return acc
+
+
+def running_composite(acc, shape, H0, H1, method):
+    # new accumulator, or the running composite to update as long as its passes were regridded the same way
+    if acc is None:
+        return ColdestPixelAccumulator(shape, H0=H0, H1=H1, method=method)
+    if acc.method != method:
+        raise ValueError('The running composite was regridded with the {} method, not {}'.format(acc.method, method))
+    return acc
+
+
+def daylight_composite(avhrr_files, lon, lat, H0, H1, regrid_cache_dir=None, acc=None, method='bilinear'):
+    """
+    Coldest pixel composite of all passes within the daylight window defined by H0 and H1
+    :param avhrr_files: list of AVHRR single-pass files for one day
+    :param lon: 1D composite grid longitudes
+    :param lat: 1D composite grid latitudes
+    :param H0: beginning daylight hour (GMT)
+    :param H1: ending daylight hour (GMT), not included in the window
+    :param regrid_cache_dir: optional directory in which regridding weights are stored between runs
+    :param acc: optional running composite to update; passes already in it are skipped
+    :param method: regridding method, 'bilinear' or 'conservative' (see functions.regrid.get_regridder)
+    :return: ColdestPixelAccumulator (composite SST is nan where there is no data)
+    """
+    acc = running_composite(acc, (len(lat), len(lon)), H0, H1, method)
+    regrid_sst = np.empty((len(lat), len(lon)), dtype='f4')  # reused for every pass
+    bounds = grid_bounds(lon, lat, method)
+
+    for avhrr in avhrr_files:
+        passH, passM, passS = parse_pass_filename(avhrr)
+
+        # check if the pass is within the daylight window defined by H0 and H1
+        # add pass to composite if it is
+        if H0 <= int(passH) < H1 and not acc.contains(avhrr):
+            # skip passes with nothing to add before reading them in full
+            reason = screen_pass(avhrr, bounds)
+            if reason is not None:
+                acc.reject(avhrr, reason)
+                continue
+            print("processing", avhrr)
+            if regrid_pass(avhrr, lon, lat, regrid_cache_dir=regrid_cache_dir, out=regrid_sst,
+                           method=method) is not None:
+                acc.add(avhrr, regrid_sst)
+
+    return acc
+
+
+def shared_accumulator(buffers, shape, H0=None, H1=None):
+    """
+    Accumulator whose arrays are views of shared memory buffers (multiprocessing RawArrays), so that a worker process
+    can fold passes into it and the parent can read the result without copying
+    :param buffers: RawArrays for minT and maxT ('f') and pass_index and n_obs ('h'), each of the grid size
+    """
+    acc = ColdestPixelAccumulator((0, 0), H0=H0, H1=H1)
+    acc.minT = np.frombuffer(buffers[0], dtype='f4').reshape(shape)
+    acc.maxT = np.frombuffer(buffers[1], dtype='f4').reshape(shape)
+    acc.pass_index = np.frombuffer(buffers[2], dtype='i2').reshape(shape)
+    acc.n_obs = np.frombuffer(buffers[3], dtype='i2').reshape(shape)
+    return acc
+
+
+# per-process state of the parallel_daylight_composite workers
+_worker = dict()
+
+
+def _init_composite_worker(slots, counter, lon, lat, regrid_cache_dir, method):
+    # each worker process claims its own slot of shared buffers, so no locks are needed while folding passes
+    with counter.get_lock():
+        slot = counter.value
+        counter.value += 1
+    _worker['acc'] = shared_accumulator(slots[slot], (len(lat), len(lon)))
+    _worker['lon'] = lon
+    _worker['lat'] = lat
+    _worker['bounds'] = grid_bounds(lon, lat, method)
+    _worker['regrid_sst'] = np.empty((len(lat), len(lon)), dtype='f4')
+    _worker['regrid_cache_dir'] = regrid_cache_dir
+    _worker['method'] = method
+
+
+def _composite_pass(task):
+    # screen, regrid and fold one pass into the worker's slot; k is the index of the pass in the candidate list
+    k, avhrr = task
+    reason = screen_pass(avhrr, _worker['bounds'])
+    if reason is None:
+        print("processing", avhrr)
+        if regrid_pass(avhrr, _worker['lon'], _worker['lat'], regrid_cache_dir=_worker['regrid_cache_dir'],
+                       out=_worker['regrid_sst'], method=_worker['method']) is None:
+            reason = 'outside the composite grid'
+        else:
+            _worker['acc'].fold(_worker['regrid_sst'], k)
+    return k, reason
+
+
+def parallel_daylight_composite(avhrr_files, lon, lat, H0, H1, n_workers, regrid_cache_dir=None, acc=None,
+                                method='bilinear'):
+    """
+    Same as daylight_composite, with the passes of the day regridded and folded by n_workers processes. Each worker
+    folds its passes into its own composite (and provenance layers) in shared memory, lock-free, and the worker
+    composites are reduced once at the end, so the result, including the pass order, is the same as with
+    daylight_composite. Shared memory is n_workers x 12 bytes per grid point.
+    Workers are forked where the platform allows it, so this can be called from scripts without a main guard.
+    :param n_workers: number of worker processes
+    :return: ColdestPixelAccumulator
+    """
+    shape = (len(lat), len(lon))
+    acc = running_composite(acc, shape, H0, H1, method)
+    candidates = [avhrr for avhrr in avhrr_files
+                  if H0 <= int(parse_pass_filename(avhrr)[0]) < H1 and not acc.contains(avhrr)]
+    if len(candidates) == 0:
+        return acc
+
+    # one set of shared buffers per worker
+    n_workers = min(n_workers, len(candidates))
+    size = shape[0] * shape[1]
+    slots = []
+    for n in range(n_workers):
+        buffers = (RawArray('f', size), RawArray('f', size), RawArray('h', size), RawArray('h', size))
+        slot_acc = shared_accumulator(buffers, shape)
+        slot_acc.minT[:] = np.nan
+        slot_acc.maxT[:] = np.nan
+        slot_acc.pass_index[:] = -1
+        slots.append(buffers)
+
+    ctx = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else mp.get_context()
+    counter = ctx.Value('i', 0)
+    pool = ctx.Pool(n_workers, initializer=_init_composite_worker,
+                    initargs=(slots, counter, lon, lat, regrid_cache_dir, method))
+    try:
+        results = dict(pool.imap_unordered(_composite_pass, list(enumerate(candidates))))
+    finally:
+        pool.close()
+        pool.join()
+
+    # reduce the worker composites; pass indices refer to the candidate list until the passes without data are dropped
+    new = ColdestPixelAccumulator(shape, H0=H0, H1=H1, method=method)
+    for buffers in slots:
+        new.combine(shared_accumulator(buffers, shape))
+    added = [k for k in range(len(candidates)) if results[k] is None]
+    remap = np.full(len(candidates) + 1, -1, dtype='i2')  # the extra -1 maps -1 (no data) to itself
+    remap[added] = np.arange(len(added))
+    new.pass_index[:] = remap[new.pass_index]
+    new.passes = [os.path.basename(candidates[k]) for k in added]
+    for k in range(len(candidates)):
+        if results[k] is not None:
+            acc.reject(candidates[k], results[k])
+
+    return acc.merge(new)
+
+
+def window_hours(window, d):
+    """
+    Daylight window hours for a date
+    :param window: dictionary with 'H0' and 'H1', either single hours or lists of 12 monthly hours
+    :param d: datetime of the composite
+    :return: H0, H1 (None for sun angle windows)
+    """
+    if 'min_sun_angle' in window:
+        return None, None
+    H0 = window['H0']
+    H1 = window['H1']
+    if not isinstance(H0, int):
+        H0 = H0[d.month - 1]
+    if not isinstance(H1, int):
+        H1 = H1[d.month - 1]
+    return H0, H1
+
+
+def parse_window(window_str):
+    """
+    Build a window from a command line string: 'name=H0-H1' (e.g. 'daylight=15-20', 'allday=0-24'),
+    'name=monthly' for the monthly daylight hours in H0_lst and H1_lst, or 'name=sunX' to include every pixel where
+    the sun is at least X degrees above the horizon at the pass time (e.g. 'sun10=sun10')
+    """
+    name, hours = window_str.split('=')
+    if hours == 'monthly':
+        return dict(name=name, H0=H0_lst, H1=H1_lst)
+    if hours.startswith('sun'):
+        return dict(name=name, min_sun_angle=int(hours[3:]))
+    H0, H1 = hours.split('-')
+    return dict(name=name, H0=int(H0), H1=int(H1))
+
+
+def multi_window_composite(avhrr_files, lon, lat, windows, d, regrid_cache_dir=None, method='bilinear'):
+    """
+    Coldest pixel composites for several daylight windows at once: each pass is read and regridded once and added to
+    every composite whose window it falls in
+    :param avhrr_files: list of AVHRR single-pass files for one day
+    :param lon: 1D composite grid longitudes
+    :param lat: 1D composite grid latitudes
+    :param windows: list of window dictionaries (see window_hours and parse_window), each with a unique 'name'.
+    Sun angle windows ('min_sun_angle') include, from every pass, the pixels where the sun is high enough
+    :param d: datetime of the composite, used to select monthly window hours
+    :param regrid_cache_dir: optional directory in which regridding weights are stored between runs
+    :param method: regridding method, 'bilinear' or 'conservative' (see functions.regrid.get_regridder)
+    :return: dictionary of ColdestPixelAccumulator by window name
+    """
+    accs = dict()
+    hours = dict()
+    for w in windows:
+        hours[w['name']] = window_hours(w, d)
+        accs[w['name']] = ColdestPixelAccumulator((len(lat), len(lon)), *hours[w['name']],
+                                                  min_sun_angle=w.get('min_sun_angle'))
+    regrid_sst = np.empty((len(lat), len(lon)), dtype='f4')  # reused for every pass
+    bounds = grid_bounds(lon, lat, method)
+
+    for avhrr in avhrr_files:
+        passH = int(parse_pass_filename(avhrr)[0])
+        matches = dict()
+        for name, acc in accs.items():
+            if acc.min_sun_angle is None:
+                if hours[name][0] <= passH < hours[name][1]:
+                    matches[name] = None
+            else:
+                # pixels with enough sun at the pass time; the pass is skipped if there are none
+                mask = solar.sunlit(lon, lat, pass_datetime(avhrr), acc.min_sun_angle)
+                if mask.any():
+                    matches[name] = mask
+        if len(matches) > 0:
+            # skip passes with nothing to add before reading them in full
+            reason = screen_pass(avhrr, bounds)
+            if reason is not None:
+                for name in matches:
+                    accs[name].reject(avhrr, reason)
+                continue
+            print("processing", avhrr)
+            if regrid_pass(avhrr, lon, lat, regrid_cache_dir=regrid_cache_dir, out=regrid_sst, method=method) is None:
+                continue
+            for name, mask in matches.items():
+                accs[name].add(avhrr, regrid_sst, mask=mask)
+
+    return accs
+
+
+def multi_target_composite(avhrr_files, targets, H0, H1, regrid_cache_dir=None):
+    """
+    Coldest pixel composites on several grids at once (e.g. the 1 km MUR-subset and the 9 km WRF grids): each pass in
+    the daylight window is read and cleaned once, over the combined extent of the grids, and regridded to every grid
+    it covers with that grid's cached weights
+    :param avhrr_files: list of AVHRR single-pass files for one day
+    :param targets: list of dictionaries with the 'name', 'lon' and 'lat' (1D) of each grid, and optionally its
+    regridding 'method' ('bilinear' or 'conservative', see functions.regrid.get_regridder). Names must be unique; the
+    same grid can be a target more than once under different names (e.g. with both methods)
+    :param H0: beginning daylight hour (GMT)
+    :param H1: ending daylight hour (GMT), not included in the window
+    :param regrid_cache_dir: optional directory in which regridding weights are stored between runs
+    :return: dictionary of ColdestPixelAccumulator by target name
+    """
+    names = [t['name'] for t in targets]
+    duplicates = sorted(set([n for n in names if names.count(n) > 1]))
+    if len(duplicates) > 0:
+        raise ValueError('Composite target names must be unique, found more than one {}'.format(', '.join(duplicates)))
+
+    accs = dict()
+    regrid_sst = dict()
+    bounds = dict()
+    for t in targets:
+        accs[t['name']] = ColdestPixelAccumulator((len(t['lat']), len(t['lon'])), H0=H0, H1=H1)
+        regrid_sst[t['name']] = np.empty((len(t['lat']), len(t['lon'])), dtype='f4')  # reused for every pass
+        bounds[t['name']] = grid_bounds(t['lon'], t['lat'], t.get('method', 'bilinear'))
+    all_bounds = [min([b[0] for b in bounds.values()]), max([b[1] for b in bounds.values()]),
+                  min([b[2] for b in bounds.values()]), max([b[3] for b in bounds.values()])]
+
+    for avhrr in avhrr_files:
+        if not H0 <= int(parse_pass_filename(avhrr)[0]) < H1:
+            continue
+        # skip passes with nothing to add to any of the grids before reading them in full
+        reason = screen_pass(avhrr, all_bounds)
+        if reason is None:
+            pass_data = read_avhrr_pass(avhrr, bounds=all_bounds)
+            if pass_data is None:
+                reason = 'outside the composite grid'
+        if reason is not None:
+            for acc in accs.values():
+                acc.reject(avhrr, reason)
+            continue
+        print("processing", avhrr)
+        avhrrlon, avhrrlat, avhrrsst_data = pass_data
+
+        for t in targets:
+            # only grids where the pass has valid SST
+            b = bounds[t['name']]
+            lon_ind = overlap_slice(avhrrlon, b[0], b[1])
+            lat_ind = overlap_slice(avhrrlat, b[2], b[3])
+            if lon_ind is None or lat_ind is None or not np.isfinite(avhrrsst_data[lat_ind, lon_ind]).any():
+                accs[t['name']].reject(avhrr, 'no valid SST over the composite grid')
+                continue
+            regridder = rg.get_regridder(avhrrlon, avhrrlat, t['lon'], t['lat'], cache_dir=regrid_cache_dir,
+                                         method=t.get('method', 'bilinear'))
+            accs[t['name']].add(avhrr, regridder(avhrrsst_data, out=regrid_sst[t['name']]))
+
+    return accs
+
+
+def regrid_pass(avhrr_file, lon, lat, regrid_cache_dir=None, out=None, method='bilinear'):
+    """
+    Read the part of an AVHRR pass that covers the composite grid and regrid its SST to the grid (weights are cached
+    per AVHRR grid)
+    :param out: optional preallocated (lat, lon) array the regridded SST is written to
+    :param method: regridding method, 'bilinear' or 'conservative' (see functions.regrid.get_regridder)
+    :return: 2D (lat, lon) SST on the composite grid, nans outside the pass, or None if the pass doesn't overlap the
+    composite grid
+    """
+    pass_data = read_avhrr_pass(avhrr_file, bounds=grid_bounds(lon, lat, method))
+    if pass_data is None:
+        print('{} does not overlap the composite grid, skipping'.format(os.path.basename(avhrr_file)))
+        return None
+    avhrrlon, avhrrlat, avhrrsst_data = pass_data
+    regridder = rg.get_regridder(avhrrlon, avhrrlat, lon, lat, cache_dir=regrid_cache_dir, method=method)
+    return regridder(avhrrsst_data, out=out)
+
+
+def tiled_daylight_composite(avhrr_files, out_var, lon, lat, H0, H1, tile_size=(512, 512), method='bilinear'):
+    """
+    Coldest pixel composite of all passes within the daylight window defined by H0 and H1, built one tile of the
+    composite grid at a time and written straight into the output variable, so that memory use depends on the tile
+    size and not on the size of the grid. For each tile only the part of each pass that covers the tile is read.
+
+    Peak memory per tile is about tile_y * tile_x * 28 bytes (float32 composite and warmest value, int16 pass index
+    and count, float32 regrid buffer and the float32 temporaries of interp_bilinear) plus 4 bytes per source pixel in
+    the pass hyperslab that covers the tile; for 512 x 512 tiles regridded from ~1 km passes this is roughly 8 MB,
+    compared with ~200 MB of working arrays for the full 1 km MUR-subset grid. Regridding weights aren't cached in
+    this mode, so the conservative method (whose weights are built for every tile of every pass) is much slower here
+    than with the whole-grid compositors.
+
+    :param avhrr_files: list of AVHRR single-pass files for one day
+    :param out_var: netCDF sst variable (time, z, lat, lon) the composite is written to, with nans as -999; the
+    provenance layers (see write_provenance) are written to the same file
+    :param lon: 1D composite grid longitudes
+    :param lat: 1D composite grid latitudes
+    :param H0: beginning daylight hour (GMT)
+    :param H1: ending daylight hour (GMT), not included in the window
+    :param tile_size: (lat, lon) number of grid points in each tile
+    :param method: regridding method, 'bilinear' or 'conservative' (see functions.regrid.get_regridder)
+    :return: list of the passes in the daylight window with data over the composite grid, and dictionary of the passes
+    rejected by screen_pass (file name: reason), as in ColdestPixelAccumulator.rejected
+    """
+    # open every pass in the daylight window that has data over the composite grid once and keep its coordinates;
+    # data are read per tile
+    passes = []
+    rejected = dict()
+    bounds = grid_bounds(lon, lat, method)
+    for avhrr in avhrr_files:
+        if H0 <= int(parse_pass_filename(avhrr)[0]) < H1:
+            # skip passes with nothing to add (see screen_pass)
+            reason = screen_pass(avhrr, bounds)
+            if reason is not None:
+                rejected[os.path.basename(avhrr)] = reason
+                print('{} rejected: {}'.format(os.path.basename(avhrr), reason))
+                continue
+            avhrr_data = Dataset(avhrr, "r")
+            passes.append((avhrr, avhrr_data, avhrr_data.variables['lon'][:], avhrr_data.variables['lat'][:]))
+    pass_names = [os.path.basename(p[0]) for p in passes]
+
+    # the provenance variables are created once; each tile only writes its slice of them
+    add_provenance_variables(out_var.group())
+    regrid_sst = np.empty(tile_size, dtype='f4')
+    try:
+        for j0 in range(0, len(lat), tile_size[0]):
+            for i0 in range(0, len(lon), tile_size[1]):
+                tile_lat = lat[j0:j0 + tile_size[0]]
+                tile_lon = lon[i0:i0 + tile_size[1]]
+                tile_acc = ColdestPixelAccumulator((len(tile_lat), len(tile_lon)), H0=H0, H1=H1)
+                tile_regrid = regrid_sst[:len(tile_lat), :len(tile_lon)]
+                tile_bounds = grid_bounds(tile_lon, tile_lat, method)
+
+                for k, (avhrr, avhrr_data, avhrrlon, avhrrlat) in enumerate(passes):
+                    # read only the hyperslab of the pass that covers this tile
+                    lon_ind = overlap_slice(avhrrlon, tile_bounds[0], tile_bounds[1])
+                    lat_ind = overlap_slice(avhrrlat, tile_bounds[2], tile_bounds[3])
+                    if lon_ind is None or lat_ind is None:
+                        continue
+                    avhrrsst_data = avhrr_data.variables['mcsst'][..., lat_ind, lon_ind]
+                    avhrrsst_data = avhrrsst_data.reshape(avhrrsst_data.shape[-2:])
+                    avhrrsst_data[avhrrsst_data == -999] = np.nan
+                    if method == 'bilinear':
+                        rg.interp_bilinear(avhrrsst_data, avhrrlon[lon_ind], avhrrlat[lat_ind], tile_lon, tile_lat,
+                                           out=tile_regrid)
+                    else:
+                        src_lon, src_lat, avhrrsst_data = rg.clean_source_grid(avhrrlon[lon_ind], avhrrlat[lat_ind],
+                                                                               avhrrsst_data)
+                        rg.REGRIDDERS[method].from_grids(src_lon, src_lat, tile_lon, tile_lat)(avhrrsst_data,
+                                                                                               out=tile_regrid)
+                    tile_acc.fold(tile_regrid, k)
+
+                region = (slice(j0, j0 + len(tile_lat)), slice(i0, i0 + len(tile_lon)))
+                write_provenance(out_var.group(), tile_acc, passes=pass_names, region=region)
+                tile_minT = tile_acc.minT
+                tile_minT[np.isnan(tile_minT)] = -999
+                out_var[0, 0, region[0], region[1]] = tile_minT
+    finally:
+        for p in passes:
+            p[1].close()
+
+    return pass_names, rejected
+
+
+# per-pixel provenance variables written next to sst: name, datatype, fill value and attributes
+PROVENANCE_VARIABLES = [
+    ('sst_pass_index', 'i2', -1,
+     dict(long_name='index of the pass that gave the coldest pixel',
+          comment="0-based index into the list of passes in 'included_passes'")),
+    ('sst_time', 'f8', -999,
+     dict(long_name='time of the observation that gave the coldest pixel', standard_name='time',
+          comment='pass time GMT')),
+    ('sst_count', 'i2', -1,
+     dict(long_name='number of valid observations in composite',
+          comment='number of passes with valid (regridded) data at each pixel')),
+    ('sst_spread', 'f4', -999,
+     dict(long_name='spread of valid observations in composite', units='degrees Celsius',
+          comment='warmest minus coldest valid observation at each pixel')),
+]
+
+
+def add_provenance_variables(nc):
+    """
+    Create the provenance variables in a composite file or template that doesn't have them yet, with the dimensions,
+    chunking and compression of sst
+    :param nc: netCDF4 Dataset open for writing, with sst and time variables
+    """
+    sst = nc.variables['sst']
+    chunks = sst.chunking()
+    filters = sst.filters() or dict()
+    for name, datatype, fill_value, atts in PROVENANCE_VARIABLES:
+        if name in nc.variables:
+            continue
+        var = nc.createVariable(name, datatype, sst.dimensions, fill_value=fill_value, zlib=True,
+                                complevel=filters.get('complevel', 4), shuffle=True,
+                                chunksizes=None if chunks in (None, 'contiguous') else chunks)
+        var.setncatts(atts)
+        var.coordinates = 'lon lat z time'
+        if name == 'sst_time':
+            var.units = nc.variables['time'].units
+            var.calendar = nc.variables['time'].calendar
+    sst.ancillary_variables = ', '.join(['included_passes', 'sst_qc_flag'] + [v[0] for v in PROVENANCE_VARIABLES])
+
+
+def write_provenance(sst_file, acc, passes=None, region=None):
+    """
+    Write the provenance layers of a composite (pass index, observation time, observation count and spread)
+    :param sst_file: composite netCDF4 Dataset open for writing, with the provenance variables (see
+    add_provenance_variables)
+    :param acc: ColdestPixelAccumulator
+    :param passes: file names of the passes the pass indices refer to (default acc.passes)
+    :param region: optional (lat slice, lon slice) of the composite grid that acc covers, e.g. a tile
+    """
+    if passes is None:
+        passes = acc.passes
+    if region is None:
+        region = (slice(None), slice(None))
+    has_data = acc.pass_index >= 0
+
+    # observation time of each pixel from the time of the pass that gave the coldest value (-1 picks the fill value)
+    out_time = sst_file.variables['time']
+    pass_times = np.array([date2num(pass_datetime(p), units=out_time.units, calendar=out_time.calendar)
+                           for p in passes] + [-999])
+    spread = acc.maxT - acc.minT
+    spread[~has_data] = -999
+
+    sst_file.variables['sst_pass_index'][0, 0, region[0], region[1]] = acc.pass_index
+    sst_file.variables['sst_time'][0, 0, region[0], region[1]] = pass_times[acc.pass_index]
+    sst_file.variables['sst_count'][0, 0, region[0], region[1]] = acc.n_obs
+    sst_file.variables['sst_spread'][0, 0, region[0], region[1]] = spread
+
+
+def write_composite_info(sst_file, d, passes, H0=None, H1=None, min_sun_angle=None, n_days=1, date_created=None,
+                         history=None, history_note=None, contributors=None):
+    """
+    Write the time, daylight window or minimum sun angle, included passes and metadata of a composite, i.e. everything
+    but sst and the provenance layers (see write_composite)
+    :param sst_file: composite netCDF4 Dataset built from the template, open for writing
+    :param d: datetime of the composite (last day for multi-day composites)
+    :param passes: file names of the passes in the composite
+    :param H0: beginning daylight hour (GMT), None for composites without a daylight window
+    :param H1: ending daylight hour (GMT)
+    :param min_sun_angle: minimum sun angle of sun angle composites
+    :param n_days: number of days in the composite
+    :param date_created: creation date of the composite being updated, to keep it (default: now)
+    :param history: history of the composite being updated; the update is appended to it instead of starting a new one
+    :param history_note: optional description of the update, added after its time in the history
+    :param contributors: optional list of (name, role) added to the contributors of the template
+    """
+    # add time (end of day)
+    out_time = sst_file.variables['time']
+    out_time[0] = date2num(d.replace(hour=23, minute=59, second=0, microsecond=0), units=out_time.units,
+                           calendar=out_time.calendar)
+    # add start and end times (daylight hours) or the minimum sun angle; the other is left as fill values (both are
+    # left as fill values for multi-day composites with different windows)
+    if H0 is not None:
+        sst_file.variables['composite_start_time'][:] = H0
+        sst_file.variables['composite_end_time'][:] = H1
+    elif min_sun_angle is not None:
+        sst_file.variables['minimum_sun_angle'][:] = min_sun_angle
+    # add included passes info
+    sst_file.variables['included_passes'][0] = format_pass_info(passes, dated=n_days > 1)
+
+    # add date and time info to metadata
+    now = time.strftime("%B-%d-%Y %H:%M GMT", time.gmtime())
+    sst_file.date_created = now if date_created is None else date_created
+    sst_file.time_coverage_start = (d - timedelta(days=n_days - 1)).strftime("%B-%d-%Y 00:00")
+    sst_file.time_coverage_end = d.strftime("%B-%d-%Y 23:59")  # end of day, not end of daylight window
+    sst_file.date_modified = now
+    if history is None:
+        sst_file.history = ["Created " + now]
+    else:
+        sst_file.history = [history + ", Updated " + now + ('' if history_note is None else ' ' + history_note)]
+    if n_days > 1:
+        sst_file.title = sst_file.title.replace('Daily', '{}-Day'.format(n_days))
+        sst_file.time_coverage_duration = '{} days'.format(n_days)
+    # add contributors
+    for name, role in contributors or []:
+        sst_file.contributor_name = sst_file.contributor_name + ', ' + name
+        sst_file.contributor_role = sst_file.contributor_role + ', ' + role
+
+
+def write_composite(template_file, out_file, d, acc, n_days=1, date_created=None, history=None, history_note=None,
+                    contributors=None):
+    """
+    Write a composite to a new file built from the template
+    :param template_file: composite template netCDF file
+    :param out_file: output file name
+    :param d: datetime of the composite (last day for multi-day composites)
+    :param acc: ColdestPixelAccumulator with the composite and daylight window hours or minimum sun angle
+    :param n_days: number of days in the composite
+    :param date_created: creation date of the composite being updated, to keep it (default: now)
+    :param history: history of the composite being updated; the update is appended to it instead of starting a new one
+    :param history_note: optional description of the update, added after its time in the history
+    :param contributors: optional list of (name, role) added to the contributors of the template
+    """
+    template = tp.get_template(template_file)
+    with template.new_file(out_file) as sst_file:
+        # add sst
+        minT = acc.minT.copy()
+        minT[np.isnan(minT)] = -999
+        sst_file.variables['sst'][0, 0, :, :] = minT
+        # add the per-pixel provenance
+        if acc.provenance:
+            add_provenance_variables(sst_file)
+            write_provenance(sst_file, acc)
+        write_composite_info(sst_file, d, acc.passes, H0=acc.H0, H1=acc.H1, min_sun_angle=acc.min_sun_angle,
+                             n_days=n_days, date_created=date_created, history=history, history_note=history_note,
+                             contributors=contributors)
@@ -8,93 +8,122 @@ import xarray as xr
 import requests
 import re
 import itertools
+import functions.grid_index as gi
+import functions.regrid as rg
+from functions.grid_index import haversine_dist  # moved to grid_index, still available as cf.haversine_dist
 
 
-def append_satellite_sst_data(sat_nc_file, buoylat, buoylon, radius, method, sst_varname):
-    value = ''
-    satdata = xr.open_dataset(sat_nc_file, mask_and_scale=False)
-    if method == 'sport':
-        satlon = satdata['lon_0'].values - 360
-        satlat = satdata['lat_0'].values
-    elif method == 'rtg':
-        satlon = satdata['lon_173'].values - 360
-        satlat = satdata['lat_173'].values
-    else:
-        satlon = satdata['lon'].values
-        satlat = satdata['lat'].values
-
-    # select data near the buoy
-    lon_ind = np.logical_and(satlon > buoylon - 2, satlon < buoylon + 2)
-    lat_ind = np.logical_and(satlat > buoylat - 2, satlat < buoylat + 2)
-    if (len(np.unique(lon_ind)) == 1 and np.unique(lon_ind)[0] == False) or (len(np.unique(lat_ind)) == 1 and np.unique(lat_ind)[0] == False):
-        value = np.nan
-    else:
-        if method == 'daily_avhrr':
-            satsst = np.squeeze(satdata[sst_varname][:, :, lat_ind, lon_ind])
-            land_mask = satdata['mask'][lat_ind, lon_ind]  # exclude data over land
-            satsst.values[land_mask.values == 1] = np.nan
-            satsst.values[satsst == satdata[sst_varname]._FillValue] = np.nan  # turn fill values to nans
-            lonx, laty = np.meshgrid(satlon[lon_ind], satlat[lat_ind])
-        elif method == 'cold_sport':
-            satsst = np.squeeze(satdata[sst_varname][:, lon_ind, lat_ind])
-            satsst.values[satsst == satdata[sst_varname]._FillValue] = np.nan  # turn fill values to nans
-            laty, lonx = np.meshgrid(satlat[lat_ind], satlon[lon_ind])
-        elif method in ['sport', 'rtg']:
-            satsst = np.squeeze(satdata[sst_varname][lat_ind, lon_ind])
-            satsst.values[satsst == satdata[sst_varname]._FillValue] = np.nan  # turn fill values to nans
-            satsst.values[satsst == -9999] = np.nan
-            satsst.values = satsst.values - 273.15  # convert K to C
-            lonx, laty = np.meshgrid(satlon[lon_ind], satlat[lat_ind])
-        elif method == 'nrel':
-            satsst = np.squeeze(satdata[sst_varname][lon_ind, lat_ind])
-            satsst.values[satsst == satdata[sst_varname]._FillValue] = np.nan  # turn fill values to nans
-            laty, lonx = np.meshgrid(satlat[lat_ind], satlon[lon_ind])
-        elif method == 'avhrr':
-            satsst = np.squeeze(satdata[sst_varname][:, lat_ind, lon_ind])
-            # if the array is all fill values, return nan
-            if (len(np.unique(satsst.values)) == 1 and np.unique(satsst.values)[0] == satdata[sst_varname]._FillValue):
-                value = np.nan
-            else:
-                satsst.values[satsst == satdata[sst_varname]._FillValue] = np.nan  # turn fill values to nans
-                lonx, laty = np.meshgrid(satlon[lon_ind], satlat[lat_ind])
-
-        if value == '':  # if value hasn't been defined yet
-            d = haversine_dist(buoylon, buoylat, lonx, laty)
-
-            # define the distance envelope and find the closest data point(s)
-            if isinstance(radius, numbers.Number):
-                dist_satsst = satsst.values[d <= radius]
-                if check_nans(dist_satsst) == 'valid':
-                    value = np.nanmean(satsst.values[d <= radius])
-                else:
-                    value = np.nan
-
-            elif radius == 'closest':
-                dist_satsst = satsst.values[d == np.nanmin(d)]
-                if check_nans(dist_satsst) == 'valid':
-                    d[np.isnan(satsst.values)] = np.nan  # turn distance to nan if the value at that location is nan
-                    value = np.nanmean(satsst.values[d == np.nanmin(d)])
-                else:
-                    value = np.nan
-
-            elif 'closestwithin' in radius:
-                dist = np.float(radius.split('closestwithin')[-1])
-                dist_satsst = satsst.values[d <= dist]
-                if check_nans(dist_satsst) == 'valid':
-                    if 1 - (np.sum(np.isnan(dist_satsst)) / len(dist_satsst)) < .05:  # if the coverage is <5%, return nan
-                        value = np.nan
-                    else:
-                        d[np.isnan(satsst.values)] = np.nan  # turn distance to nan if the value at that location is nan
-                        # take the average on the off chance that the distance is exactly the same for >1 pixel
-                        value = np.nanmean(satsst.values[d == np.nanmin(d)])
-                else:
-                    value = np.nan
+def append_satellite_sst_data(sat_nc_file, buoylat, buoylon, radius, method, sst_varname, index_cache_dir=None):
+    # SST around a single buoy (see extract_satellite_sst to get several buoys and radius options from one file read)
+    return extract_satellite_sst(sat_nc_file, [buoylat], [buoylon], [radius], method, sst_varname,
+                                 index_cache_dir=index_cache_dir)[0, 0]
 
-            else:
-                print('Invalid SST averaging option provided.')
 
-    satdata.close()
-    return value
+def average_sst_rules(sst, d, radii):
+    """
+    SST "at" a buoy from the satellite pixels around it, for several averaging options at once, vectorized over the
+    pixels and over any leading dimensions of sst (e.g. the times of an SSTCube)
+    :param sst: SST of the pixels (..., pixels), nans where there is no data
+    :param d: 1D distance (km) of each pixel from the buoy
+    :param radii: averaging options: x (average all data within radius x km of the buoy), 'closest' (the closest data
+    point) or 'closestwithinx' (the closest non-nan measurement as long as it is within x km of the buoy and at least
+    5% of the pixels within x km have data)
+    :return: array of SST (..., averaging options), nan where there is no data
+    """
+    sst = np.asarray(sst)
+    d = np.asarray(d)
+    values = np.full(sst.shape[:-1] + (len(radii),), np.nan)
+    valid = ~np.isnan(sst)
+    filled = np.where(valid, sst, 0).astype('f8')
+
+    # distance of the closest pixel with data (inf where there is none)
+    d_valid = np.where(valid, d, np.inf)
+    dmin_valid = d_valid.min(axis=-1) if len(d) > 0 else np.full(sst.shape[:-1], np.inf)
+
+    for k, radius in enumerate(radii):
+        try:
+            dist = gi.parse_radius(radius)
+        except ValueError:
+            print('Invalid SST averaging option provided.')
+            continue
+        if len(d) == 0:
+            continue
+        if isinstance(radius, numbers.Number):
+            selected = d <= radius
+        elif dist is None:
+            # all pixels at the closest distance, on the off chance that the distance is exactly the same for >1 pixel
+            selected = d == np.min(d)
+        else:
+            # the closest pixel(s) with data, as long as there are data within dist km covering at least 5% of the
+            # pixels
+            inside = d <= dist
+            n_inside = np.sum(inside)
+            n_valid = np.sum(valid[..., inside], axis=-1)
+            ok = np.logical_and(n_valid > 0, ~(1 - (n_inside - n_valid) / max(n_inside, 1) < .05))
+            selected = np.logical_and(valid, d_valid == dmin_valid[..., np.newaxis])
+            n = np.sum(selected, axis=-1)
+            mean = np.sum(filled * selected, axis=-1) / np.maximum(n, 1)
+            values[..., k] = np.where(np.logical_and(ok, n > 0), mean, np.nan)
+            continue
+
+        n = np.sum(np.logical_and(valid, selected), axis=-1)
+        mean = np.sum(filled * selected, axis=-1) / np.maximum(n, 1)
+        values[..., k] = np.where(n > 0, mean, np.nan)
+    return values
+
+
+def extract_satellite_sst(sat_nc_file, buoylats, buoylons, radii, method, sst_varname, index_cache_dir=None):
+    """
+    SST around several buoys, for several averaging options, from a single open and read of a satellite file. The
+    pixels each buoy and averaging option use come from neighbour tables (see functions.grid_index), computed once per
+    grid, buoy and averaging option and reused for every file on the same grid. Only the block of the file that spans
+    the pixels of all the buoys is read, and all the averaging options of a buoy are evaluated in one call of
+    average_sst_rules
+    :param sat_nc_file: satellite SST file
+    :param buoylats: buoy latitudes
+    :param buoylons: buoy longitudes
+    :param radii: averaging options (see average_sst_rules)
+    :param method: type of file: 'daily_avhrr' (coldest pixel composite), 'cold_sport' (AVHRR + SPoRT composite),
+    'sport', 'rtg', 'nrel' or 'avhrr' (single pass)
+    :param sst_varname: name of the SST variable
+    :param index_cache_dir: optional directory in which the neighbour tables are stored between runs
+    :return: array of SST (buoys, averaging options), nan where there is no data
+    """
+    values = np.full((len(buoylats), len(radii)), np.nan)
+    satdata = xr.open_dataset(sat_nc_file, mask_and_scale=False)
+    try:
+        satlon, satlat = satellite_grid(satdata, method)
+        grid_key = rg.grid_hash(satlon, satlat)
+
+        # pixels of each buoy: those of all its averaging options, so that the options are evaluated together
+        pixels = dict()
+        for n in range(len(buoylats)):
+            tables = []
+            for radius in radii:
+                try:
+                    tables.append(gi.get_neighbour_table(satlon, satlat, buoylons[n], buoylats[n], radius,
+                                                         cache_dir=index_cache_dir, grid_key=grid_key))
+                except ValueError:
+                    continue  # reported by average_sst_rules
+            flat = np.unique(np.concatenate([t.rows * len(satlon) + t.cols for t in tables] or [[]]).astype(np.int64))
+            if len(flat) > 0:
+                rows, cols = np.divmod(flat, len(satlon))
+                pixels[n] = (rows, cols, haversine_dist(buoylons[n], buoylats[n], satlon[cols], satlat[rows]))
+        if len(pixels) == 0:
+            return values
+
+        # read the block that spans all the pixels
+        row0 = min([p[0].min() for p in pixels.values()])
+        row1 = max([p[0].max() for p in pixels.values()]) + 1
+        col0 = min([p[1].min() for p in pixels.values()])
+        col1 = max([p[1].max() for p in pixels.values()]) + 1
+        satsst = satellite_sst(satdata, method, sst_varname, slice(row0, row1), slice(col0, col1))
+
+        for n, (rows, cols, d) in pixels.items():
+            values[n] = average_sst_rules(satsst[rows - row0, cols - col0], d, radii)
+    finally:
+        satdata.close()
+    return values
 
 
 def check_nans(data_array):
@@ -191,19 +220,60 @@ def get_nc_urls(catalog_urls):
     return datasets
 
 
-def haversine_dist(blon, blat, slon, slat):
-    # return distance (km) from one lon/lat to another (or an entire set)
-    R = 6373.0
-    blon = blon*np.pi/180
-    blat = blat*np.pi/180
-    slon = slon*np.pi/180
-    slat = slat*np.pi/180
-    dlon = slon-blon
-    dlat = slat-blat
-    a = np.sin(dlat/2)**2+np.cos(blat)*np.cos(slat)*np.sin(dlon/2)**2
-    c = 2*np.arctan2(np.sqrt(a), np.sqrt(1-a))
-    distance = R*c
-    return distance
+def satellite_grid(satdata, method):
+    """
+    1D longitudes (-180 to 180) and latitudes of a satellite SST product
+    :param satdata: xarray Dataset of the satellite file
+    :param method: type of file (see extract_satellite_sst)
+    """
+    if method == 'sport':
+        return satdata['lon_0'].values - 360, satdata['lat_0'].values
+    elif method == 'rtg':
+        return satdata['lon_173'].values - 360, satdata['lat_173'].values
+    return satdata['lon'].values, satdata['lat'].values
+
+
+def bounding_slice(ind):
+    """
+    Slice that spans a boolean index, and the boolean index relative to the slice
+    """
+    if isinstance(ind, slice):
+        return ind, slice(None)
+    ind = np.asarray(ind)
+    where = np.flatnonzero(ind)
+    return slice(where[0], where[-1] + 1), ind[where[0]:where[-1] + 1]
+
+
+def satellite_sst(satdata, method, sst_varname, lat_ind, lon_ind):
+    """
+    Read SST (Celsius) from a window of a satellite file, as a 2D (lat, lon) array with nans for fill values (and
+    land, for the daily coldest pixel composites)
+    :param satdata: xarray Dataset of the satellite file, opened with mask_and_scale=False
+    :param method: type of file (see extract_satellite_sst)
+    :param sst_varname: name of the SST variable
+    :param lat_ind: latitude indices of the window (boolean array or slice)
+    :param lon_ind: longitude indices of the window
+    """
+    # read the block that spans the window (one contiguous read), then select the window from it
+    lat_slice, lat_sel = bounding_slice(lat_ind)
+    lon_slice, lon_sel = bounding_slice(lon_ind)
+    sst_var = satdata[sst_varname]
+    if method in ['cold_sport', 'nrel']:
+        # these files are (lon, lat)
+        satsst = sst_var[..., lon_slice, lat_slice].values
+        satsst = satsst.reshape(satsst.shape[-2:]).T
+    else:
+        satsst = sst_var[..., lat_slice, lon_slice].values
+        satsst = satsst.reshape(satsst.shape[-2:])
+    satsst = satsst[lat_sel][:, lon_sel]
+    if method == 'daily_avhrr':
+        land_mask = satdata['mask'][lat_slice, lon_slice].values[lat_sel][:, lon_sel]
+        satsst[land_mask == 1] = np.nan  # exclude data over land
+    satsst[satsst == sst_var._FillValue] = np.nan  # turn fill values to nans
+    if method in ['sport', 'rtg']:
+        satsst[satsst == -9999] = np.nan
+        satsst = satsst - 273.15  # convert K to C
+    return satsst
 
 
 def range1(start, end):
@@ -0,0 +1,251 @@
+#! /usr/bin/env python
+
+import base64
+import os
+import re
+import struct
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import numpy as np
+from netCDF4 import Dataset, date2num, num2date
+import functions.template as tp
+
+
+# chunk sizes of the archive arrays. Each chunk holds 8 days of a 128 x 128 tile (512 KB of float32 before
+# compression), so a map reads one slab of chunks and a point time series reads one chunk per 8 days. The time chunk is
+# also the unit of locking between writers (see CompositeArchive.write_day)
+ARCHIVE_CHUNKS = dict(time=8, lat=128, lon=128)
+
+
+# oldest versions the archive works with: the zarr 3 array API (create_array, dimension_names) and an xarray that
+# reads zarr 3 stores. environment_archive.yml is a tested environment
+MIN_ZARR_VERSION = (3, 0, 0)
+MIN_XARRAY_VERSION = (2025, 1, 2)
+
+
+def version_tuple(version):
+    # leading numbers of a version string, e.g. '2025.01.2' -> (2025, 1, 2)
+    return tuple([int(n) for n in re.findall(r'\d+', version.split('+')[0])[:3]])
+
+
+def check_version(name, version, min_version):
+    if version_tuple(version) < min_version:
+        raise ImportError('The composite archive needs {} {} or later (found {}), see environment_archive.yml'.format(
+            name, '.'.join([str(n) for n in min_version]), version))
+
+
+def import_zarr():
+    # zarr is only needed for the archive, so it's imported when an archive is used
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError('The composite archive needs the zarr package (version 3 or later), see '
+                          'environment_archive.yml')
+    check_version('zarr', zarr.__version__, MIN_ZARR_VERSION)
+    return zarr
+
+
+def json_value(att):
+    # netCDF attribute as a value that can be stored in the Zarr metadata
+    if isinstance(att, np.ndarray):
+        return att.tolist()
+    if isinstance(att, np.generic):
+        return att.item()
+    return att
+
+
+def fill_value_attribute(fill_value, dtype):
+    # _FillValue attribute in the encoding xarray reads from Zarr stores (floats as base64 of a little-endian double),
+    # so that fill values come back as nan in to_xarray()
+    if np.dtype(dtype).kind == 'f':
+        return base64.standard_b64encode(struct.pack('<d', float(fill_value))).decode()
+    return int(fill_value)
+
+
+@contextmanager
+def file_lock(lock_file, exclusive=True):
+    # advisory lock (flock) shared by all processes on the machine that use the same lock file. fcntl is Unix only,
+    # so it's imported here rather than with the module, which is imported by functions/__init__.py
+    import fcntl
+    with open(lock_file, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class CompositeArchive(object):
+    """
+    Regional Zarr store of daily composites along time: each gridded variable of the composite template is an array of
+    (time, lat, lon) and each per-day variable (composite_start_time, included_passes, ...) an array of (time,), with
+    one time step per calendar day from the start date of the archive. Days are written in place, so any number of
+    processes can write different days at the same time; writers of days that share a time chunk take turns (a lock
+    file per time chunk), and growing the time axis waits for the writers to finish. The lock files are kept in
+    <store>.locks, which only works for writers on the same machine (or a file system with working flock).
+    Read the archive with to_xarray() (lazy) to extract point time series or climatologies in a single open.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.lock_dir = '{}.locks'.format(store)
+        self.zarr = import_zarr()
+        attrs = self.zarr.open_group(store, mode='r').attrs
+        self.start_date = datetime.strptime(attrs['start_date'], '%Y-%m-%d')
+        self.time_units = attrs['time_units']
+        self.calendar = attrs['calendar']
+
+    @classmethod
+    def create(cls, store, template_file, start_date, end_date, chunks=None):
+        """
+        Create an archive for the composites of a template
+        :param store: directory of the Zarr store (must not exist)
+        :param template_file: composite template netCDF file
+        :param start_date: first day of the archive (the time axis can only grow at the end)
+        :param end_date: last day the archive has room for (included); extended automatically when later days are
+        written
+        :param chunks: optional dictionary of time, lat and lon chunk sizes (default ARCHIVE_CHUNKS)
+        :return: CompositeArchive
+        """
+        zarr = import_zarr()
+        chunks = dict(ARCHIVE_CHUNKS, **(chunks or dict()))
+        template = tp.get_template(template_file)
+        sizes = dict(template.dimensions)
+        shape = dict(lat=sizes['lat'], lon=sizes['lon'])
+        start_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+        n_days = int((end_date - start_date).days) + 1
+
+        root = zarr.open_group(store, mode='w-')
+        time_var = [v for v in template.variables if v['name'] == 'time'][0]
+        root.attrs.update(dict([(k, json_value(a)) for k, a in template.global_atts.items()]))
+        root.attrs.update(dict(start_date=start_date.strftime('%Y-%m-%d'), time_units=time_var['attributes']['units'],
+                               calendar=time_var['attributes'].get('calendar', 'standard')))
+
+        for v in template.variables:
+            dims = [d for d in v['dimensions'] if d != 'z']
+            atts = dict([(k, json_value(a)) for k, a in v['attributes'].items() if k != 'least_significant_digit'])
+            if v['name'] in template.static_data:
+                if dims in (['lat'], ['lon'], ['lat', 'lon']):
+                    data = np.ma.filled(template.static_data[v['name']], v['fill_value'] or 0)
+                    arr = root.create_array(v['name'], shape=data.shape, chunks=tuple([chunks[d] for d in dims]),
+                                            dtype=data.dtype, fill_value=v['fill_value'], dimension_names=dims,
+                                            attributes=atts)
+                    arr[...] = data
+                elif len(v['dimensions']) == 0:
+                    root.attrs[v['name']] = str(template.static_data[v['name']])
+                continue
+            if dims not in (['time'], ['time', 'lat', 'lon']):
+                continue
+            dtype = str if v['datatype'] == str else v['datatype']
+            fill_value = (v['fill_value'] or '') if dtype == str else v['fill_value']
+            if dtype != str and fill_value is not None:
+                atts['_FillValue'] = fill_value_attribute(fill_value, dtype)
+            root.create_array(v['name'], shape=tuple([n_days if d == 'time' else shape[d] for d in dims]),
+                              chunks=tuple([chunks[d] for d in dims]), dtype=dtype, fill_value=fill_value,
+                              dimension_names=dims, attributes=atts)
+
+        archive = cls(store)
+        archive.fill_time(0, n_days)
+        return archive
+
+    def lock(self, name, exclusive=True):
+        if not os.path.isdir(self.lock_dir):
+            os.makedirs(self.lock_dir, exist_ok=True)
+        return file_lock(os.path.join(self.lock_dir, '{}.lock'.format(name)), exclusive=exclusive)
+
+    def day_index(self, d):
+        return int((d.replace(hour=0, minute=0, second=0, microsecond=0) - self.start_date).days)
+
+    def time_arrays(self, root):
+        return [arr for name, arr in root.arrays() if arr.metadata.dimension_names[0] == 'time']
+
+    def fill_time(self, i0, i1):
+        # time of each day (end of day, as in the daily composite files)
+        days = [self.start_date + timedelta(days=i, hours=23, minutes=59) for i in range(i0, i1)]
+        root = self.zarr.open_group(self.store, mode='r+')
+        root['time'][i0:i1] = date2num(days, units=self.time_units, calendar=self.calendar)
+
+    def n_days(self):
+        return self.zarr.open_group(self.store, mode='r')['time'].shape[0]
+
+    def extend(self, end_date):
+        """
+        Grow the time axis so that it goes up to end_date (included). Waits for the writers that are running
+        """
+        n_days = self.day_index(end_date) + 1
+        with self.lock('metadata'):
+            root = self.zarr.open_group(self.store, mode='r+')
+            n_old = root['time'].shape[0]
+            if n_days <= n_old:
+                return
+            for arr in self.time_arrays(root):
+                arr.resize((n_days,) + arr.shape[1:])
+        self.fill_time(n_old, n_days)
+
+    def write_day(self, d, data):
+        """
+        Write (or overwrite) one day of the archive
+        :param d: datetime of the composite
+        :param data: dictionary of variable name: data, 2D (lat, lon) for the gridded variables and a single value for
+        the per-day variables. Missing values are given as the fill value of the variable
+        """
+        i = self.day_index(d)
+        if i < 0:
+            raise ValueError('{} is before the start of the archive ({})'.format(d.strftime('%Y-%m-%d'),
+                                                                               self.start_date.strftime('%Y-%m-%d')))
+        if i >= self.n_days():
+            self.extend(d + timedelta(days=ARCHIVE_CHUNKS['time'] - 1))
+        with self.lock('metadata', exclusive=False), self.lock('time_{}'.format(i // ARCHIVE_CHUNKS['time'])):
+            root = self.zarr.open_group(self.store, mode='r+')
+            for name, values in data.items():
+                root[name][i, ...] = values
+
+    def append(self, sst_file):
+        """
+        Write the day of a composite file (e.g. avhrr_coldest-pixel_YYYYMMDD.nc) to the archive
+        :param sst_file: composite netCDF file (one time step)
+        :return: datetime of the day written
+        """
+        root = self.zarr.open_group(self.store, mode='r')
+        names = [name for name, arr in root.arrays() if arr.metadata.dimension_names[0] == 'time' and name != 'time']
+        data = dict()
+        with Dataset(sst_file, 'r') as nc:
+            out_time = nc.variables['time']
+            d = num2date(out_time[0], units=out_time.units, calendar=out_time.calendar)
+            d = datetime(d.year, d.month, d.day)
+            for name in names:
+                if name not in nc.variables:
+                    continue
+                var = nc.variables[name]
+                var.set_auto_mask(False)
+                values = var[0, ...]
+                # drop the z dimension of the gridded variables
+                data[name] = values.reshape(values.shape[-2:]) if np.ndim(values) > 2 else values
+        self.write_day(d, data)
+        return d
+
+    def to_xarray(self):
+        """
+        Open the archive as a lazy xarray Dataset (only the chunks that are indexed are read)
+        """
+        import xarray as xr
+        check_version('xarray', xr.__version__, MIN_XARRAY_VERSION)
+        return xr.open_zarr(self.store, consolidated=False, chunks=None)
+
+
+def open_archive(store, template_file=None, start_date=None, end_date=None):
+    """
+    Open a composite archive, creating it from the template if it doesn't exist and making sure it has room up to
+    end_date. Create or extend the archive before starting parallel writers, so that they don't have to wait for each
+    other to grow it
+    :param store: directory of the Zarr store
+    :param template_file: composite template netCDF file (only needed to create the archive)
+    :param start_date: first day of a new archive
+    :param end_date: optional last day to make room for
+    :return: CompositeArchive
+    """
+    if not os.path.isdir(store):
+        return CompositeArchive.create(store, template_file, start_date, end_date or start_date)
+    archive = CompositeArchive(store)
+    if end_date is not None:
+        archive.extend(end_date)
+    return archive
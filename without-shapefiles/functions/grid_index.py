@@ -0,0 +1,263 @@
+#! /usr/bin/env python
+
+import hashlib
+import numbers
+import os
+from collections import OrderedDict
+import numpy as np
+from scipy.spatial import cKDTree
+import functions.regrid as rg
+
+
+EARTH_RADIUS = 6373.0  # km
+MAX_INDEXES = 4  # spatial indexes of whole product grids kept in memory
+
+
+def haversine_dist(blon, blat, slon, slat):
+    # return distance (km) from one lon/lat to another (or an entire set)
+    R = EARTH_RADIUS
+    blon = blon*np.pi/180
+    blat = blat*np.pi/180
+    slon = slon*np.pi/180
+    slat = slat*np.pi/180
+    dlon = slon-blon
+    dlat = slat-blat
+    a = np.sin(dlat/2)**2+np.cos(blat)*np.cos(slat)*np.sin(dlon/2)**2
+    c = 2*np.arctan2(np.sqrt(a), np.sqrt(1-a))
+    distance = R*c
+    return distance
+
+
+def unit_vectors(lon, lat):
+    """
+    3D unit vectors of points on the sphere
+    :param lon: longitudes (degrees)
+    :param lat: latitudes (degrees)
+    :return: array of (..., 3)
+    """
+    lon = np.radians(np.asarray(lon, dtype='f8'))
+    lat = np.radians(np.asarray(lat, dtype='f8'))
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def km_to_chord(d):
+    return 2 * np.sin(np.minimum(d / (2 * EARTH_RADIUS), np.pi / 2))
+
+
+def parse_radius(radius):
+    """
+    Search distance of an averaging option (see functions.common.average_sst_rules)
+    :return: distance (km), or None for 'closest'
+    """
+    if isinstance(radius, numbers.Number):
+        return radius
+    elif radius == 'closest':
+        return None
+    elif 'closestwithin' in radius:
+        return float(radius.split('closestwithin')[-1])
+    raise ValueError('Invalid SST averaging option {}'.format(radius))
+
+
+class GridIndex(object):
+    """
+    KD-tree over the pixels of a rectilinear lon/lat grid, built on 3D unit vectors so that tree distances are chords
+    of the great circle. Finding the pixels an averaging option uses around a buoy ('closest', 'closestwithinX', X km)
+    is then a tree lookup instead of a distance calculation over the whole window. There is one tree per product grid
+    (e.g. SPoRT lon_0/lat_0, RTG lon_173/lat_173 or the composite lon/lat), shared by all the buoys on that grid and
+    kept in memory only: what is reused between runs are the neighbour tables built from it.
+    """
+    def __init__(self, lon, lat, tree):
+        self.lon = np.asarray(lon, dtype='f8')
+        self.lat = np.asarray(lat, dtype='f8')
+        self.tree = tree
+        self.shape = (len(lat), len(lon))
+
+    @classmethod
+    def from_grid(cls, lon, lat):
+        """
+        :param lon: 1D grid longitudes
+        :param lat: 1D grid latitudes
+        """
+        lonx, laty = np.meshgrid(lon, lat)
+        return cls(lon, lat, cKDTree(unit_vectors(lonx.ravel(), laty.ravel())))
+
+    def neighbours(self, buoylon, buoylat, radius, box=2):
+        """
+        Pixels that an averaging option uses around a buoy: all pixels within X km for 'X' and 'closestwithinX', and
+        the closest pixel (or pixels, if several are at exactly the same distance) for 'closest'
+        :param buoylon: buoy longitude
+        :param buoylat: buoy latitude
+        :param radius: averaging option (see functions.common.average_sst_rules)
+        :param box: only pixels within +/- box degrees of the buoy in longitude and latitude are used, as in
+        functions.common.extract_satellite_sst
+        :return: flat (lat, lon) pixel indices sorted by distance (pixels at the same distance in grid order), and their
+        distances (km, from haversine_dist)
+        """
+        dist = parse_radius(radius)
+        center = unit_vectors(buoylon, buoylat)
+        if dist is None:
+            # a few candidates, for pixels at the same distance
+            chord, idx = self.tree.query(center, k=min(16, self.tree.n))
+            idx = np.atleast_1d(idx)[np.isfinite(np.atleast_1d(chord))]
+        else:
+            # the search chord is padded slightly so that pixels right at the radius aren't lost to rounding
+            idx = self.tree.query_ball_point(center, km_to_chord(dist) * (1 + 1e-9))
+        idx = np.sort(np.asarray(idx, dtype=np.int64))
+
+        # pixels within the box around the buoy, by distance
+        rows, cols = np.divmod(idx, self.shape[1])
+        inside = np.logical_and(np.abs(self.lon[cols] - buoylon) < box, np.abs(self.lat[rows] - buoylat) < box)
+        idx = idx[inside]
+        d = haversine_dist(buoylon, buoylat, self.lon[cols[inside]], self.lat[rows[inside]])
+        order = np.argsort(d, kind='stable')
+        idx = idx[order]
+        d = d[order]
+        if dist is None:
+            keep = d == d[0] if len(d) > 0 else np.zeros(0, dtype=bool)
+        else:
+            keep = d <= dist
+        return idx[keep], d[keep]
+
+
+class NeighbourTable(object):
+    """
+    Pixels of a satellite grid that an averaging option uses around a buoy, as (lat, lon) indices of the full grid
+    sorted by distance. Buoys and grids don't move, so a table is computed once and reused for every file of the time
+    series: the SST at the buoy is then sst[rows, cols] reduced with functions.common.average_sst_rules
+    """
+    def __init__(self, rows, cols, dist):
+        self.rows = rows
+        self.cols = cols
+        self.dist = dist
+
+    @classmethod
+    def from_grid(cls, lon, lat, buoylon, buoylat, radius, box=2, grid_key=None):
+        """
+        :param lon: 1D grid longitudes
+        :param lat: 1D grid latitudes
+        :param buoylon: buoy longitude
+        :param buoylat: buoy latitude
+        :param radius: averaging option (see functions.common.average_sst_rules)
+        :param box: only pixels within +/- box degrees of the buoy are used
+        :param grid_key: optional regrid.grid_hash(lon, lat)
+        """
+        # buoys without grid points around them don't need the index of the grid
+        if not (np.any(np.abs(lon - buoylon) < box) and np.any(np.abs(lat - buoylat) < box)):
+            parse_radius(radius)  # invalid options fail the same way with or without data
+            return cls(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0))
+        idx, d = get_grid_index(lon, lat, grid_key=grid_key).neighbours(buoylon, buoylat, radius, box=box)
+        rows, cols = np.divmod(idx, len(lon))
+        return cls(rows, cols, d)
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as f:
+            return cls(f['rows'], f['cols'], f['dist'])
+
+    def save(self, fname):
+        # write to a temporary file first so that concurrent readers never see a partial file
+        tmp_file = '{}.{}.tmp'.format(fname, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, rows=self.rows, cols=self.cols, dist=self.dist)
+        os.replace(tmp_file, fname)
+
+    def __len__(self):
+        return len(self.dist)
+
+
+class NeighbourCache(object):
+    """
+    Least-recently-used cache of the neighbour tables of satellite grids, optionally backed by a directory so that
+    they survive between runs (neighbours_<grid hash>_<key>.npz)
+    """
+    def __init__(self, maxsize=4096, cache_dir=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.tables = OrderedDict()
+
+    def cached(self, items, maxsize, key, fname, load, build, errors):
+        if key in items:
+            items.move_to_end(key)
+            return items[key]
+
+        obj = None
+        if self.cache_dir is not None:
+            fname = os.path.join(self.cache_dir, fname)
+            if os.path.isfile(fname):
+                try:
+                    obj = load(fname)
+                except errors:
+                    obj = None  # unreadable cache file, rebuild it
+            if obj is None:
+                obj = build()
+                if not os.path.isdir(self.cache_dir):
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                obj.save(fname)
+        else:
+            obj = build()
+
+        items[key] = obj
+        if len(items) > maxsize:
+            items.popitem(last=False)
+        return obj
+
+    def get_table(self, lon, lat, buoylon, buoylat, radius, grid_key=None):
+        grid_key = grid_key or rg.grid_hash(lon, lat)
+        key = '{}_{}'.format(grid_key, table_key(buoylon, buoylat, radius))
+        return self.cached(self.tables, self.maxsize, key, 'neighbours_{}.npz'.format(key), NeighbourTable.load,
+                           lambda: NeighbourTable.from_grid(lon, lat, buoylon, buoylat, radius, grid_key=grid_key),
+                           (OSError, ValueError, KeyError))
+
+
+def table_key(buoylon, buoylat, radius):
+    # hex digest identifying a buoy position and averaging option
+    return hashlib.sha1('{!r}_{!r}_{}'.format(float(buoylon), float(buoylat), radius).encode()).hexdigest()
+
+
+def table_cache_dir(save_dir):
+    # directory in which the buoy comparison scripts keep the neighbour tables of their buoys between runs: buoys and
+    # grids don't change from one run to the next, so the tables are computed on the first run only
+    return os.path.join(save_dir, 'neighbour_tables')
+
+
+def get_cache(cache_dir=None):
+    if cache_dir not in _caches:
+        _caches[cache_dir] = NeighbourCache(cache_dir=cache_dir)
+    return _caches[cache_dir]
+
+
+def get_grid_index(lon, lat, grid_key=None):
+    """
+    Return the spatial index of a grid, built once per grid definition and kept in memory for the few most recently
+    used grids. It is only needed to build neighbour tables, so it isn't stored between runs
+    :param lon: 1D grid longitudes
+    :param lat: 1D grid latitudes
+    :param grid_key: optional regrid.grid_hash(lon, lat)
+    """
+    grid_key = grid_key or rg.grid_hash(lon, lat)
+    if grid_key in _indexes:
+        _indexes.move_to_end(grid_key)
+    else:
+        _indexes[grid_key] = GridIndex.from_grid(lon, lat)
+        if len(_indexes) > MAX_INDEXES:
+            _indexes.popitem(last=False)
+    return _indexes[grid_key]
+
+
+def get_neighbour_table(lon, lat, buoylon, buoylat, radius, cache_dir=None, grid_key=None):
+    """
+    Return the neighbour table of a buoy and averaging option on a grid, computed once per (grid, buoy, averaging
+    option) and kept in memory (and, with cache_dir, on disk between runs)
+    :param lon: 1D grid longitudes
+    :param lat: 1D grid latitudes
+    :param buoylon: buoy longitude
+    :param buoylat: buoy latitude
+    :param radius: averaging option (see functions.common.average_sst_rules)
+    :param cache_dir: optional directory in which tables are stored between runs
+    :param grid_key: optional regrid.grid_hash(lon, lat), to hash the grid once for many buoys
+    """
+    return get_cache(cache_dir).get_table(lon, lat, buoylon, buoylat, radius, grid_key=grid_key)
+
+
+_caches = {}
+_indexes = OrderedDict()
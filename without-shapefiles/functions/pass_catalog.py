@@ -0,0 +1,140 @@
+#! /usr/bin/env python
+
+import os
+import sqlite3
+from datetime import datetime
+import numpy as np
+from netCDF4 import Dataset
+import functions.coldest_pixel as cp
+
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class PassCatalog(object):
+    """
+    Index of AVHRR single-pass files (pass time, satellite, path, size, modification time and lon/lat bounding box)
+    stored in an SQLite database, so that finding the passes of a day is an indexed query instead of a listing of the
+    whole pass directory. refresh() only reads the files that are new or changed since the last refresh. A catalog file
+    can index several pass directories; queries return the passes of one directory at a time.
+    """
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.directory = None
+        self.db = sqlite3.connect(db_file, timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS passes (path TEXT PRIMARY KEY, directory TEXT, pass_time TEXT, '
+                        'hour INTEGER, minute INTEGER, satellite TEXT, size INTEGER, mtime REAL, lon_min REAL, '
+                        'lon_max REAL, lat_min REAL, lat_max REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS passes_time ON passes (pass_time)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS passes_directory ON passes (directory)')
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def refresh(self, avhrr_dir, suffix='.CF.nc'):
+        """
+        Bring the catalog up to date with a pass directory: new files and files whose size or modification time
+        changed are (re)read, and files that no longer exist are removed
+        :param avhrr_dir: directory of AVHRR single-pass files (YYMMDD.DOY.HHMM.nNN.BPU.CF.nc)
+        :param suffix: file name ending of the pass files
+        :return: number of files added or updated, number of files removed
+        """
+        avhrr_dir = os.path.abspath(avhrr_dir)
+        self.directory = avhrr_dir
+        known = dict()
+        for path, size, mtime in self.db.execute('SELECT path, size, mtime FROM passes WHERE directory = ?',
+                                                 (avhrr_dir,)):
+            known[path] = (size, mtime)
+
+        rows = []
+        found = set()
+        for entry in os.scandir(avhrr_dir):
+            if not entry.name.endswith(suffix) or not entry.is_file():
+                continue
+            found.add(entry.path)
+            st = entry.stat()
+            if known.get(entry.path) == (st.st_size, st.st_mtime):
+                continue
+            passH, passM, passS = cp.parse_pass_filename(entry.name)
+            rows.append((entry.path, avhrr_dir, cp.pass_datetime(entry.name).strftime(TIME_FORMAT), int(passH),
+                         int(passM), passS, st.st_size, st.st_mtime) + pass_bounds(entry.path))
+
+        removed = [(path,) for path in known if path not in found]
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO passes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.db.executemany('DELETE FROM passes WHERE path = ?', removed)
+        return len(rows), len(removed)
+
+    def query(self, t0, t1, H0=None, H1=None, satellite=None, bounds=None, directory=None):
+        """
+        Passes between two times, ordered by pass time
+        :param t0: start time (datetime, included)
+        :param t1: end time (datetime, not included)
+        :param H0: optional beginning hour (GMT) of the daily window
+        :param H1: optional ending hour (GMT) of the daily window, not included
+        :param satellite: optional satellite ID (e.g. '19')
+        :param bounds: optional [min lon, max lon, min lat, max lat]; only passes whose bounding box overlaps it (passes
+        whose coordinates couldn't be read are left out)
+        :param directory: pass directory; defaults to the directory the catalog was last refreshed from
+        :return: list of dictionaries with the path, time, satellite, size and bounding box of each pass
+        """
+        if directory is None:
+            directory = self.directory
+        if directory is None:
+            raise ValueError('No pass directory given and the catalog {} was not refreshed'.format(self.db_file))
+        sql = 'SELECT * FROM passes WHERE directory = ? AND pass_time >= ? AND pass_time < ?'
+        args = [os.path.abspath(directory), t0.strftime(TIME_FORMAT), t1.strftime(TIME_FORMAT)]
+        if H0 is not None:
+            sql += ' AND hour >= ?'
+            args.append(H0)
+        if H1 is not None:
+            sql += ' AND hour < ?'
+            args.append(H1)
+        if satellite is not None:
+            sql += ' AND satellite = ?'
+            args.append(satellite)
+        if bounds is not None:
+            sql += ' AND lon_max >= ? AND lon_min <= ? AND lat_max >= ? AND lat_min <= ?'
+            args += [bounds[0], bounds[1], bounds[2], bounds[3]]
+        sql += ' ORDER BY pass_time, path'
+
+        cursor = self.db.execute(sql, args)
+        names = [c[0] for c in cursor.description]
+        passes = []
+        for row in cursor:
+            p = dict(zip(names, row))
+            p['time'] = datetime.strptime(p.pop('pass_time'), TIME_FORMAT)
+            passes.append(p)
+        return passes
+
+
+def pass_bounds(avhrr_file):
+    """
+    Bounding box of the valid coordinates of an AVHRR pass
+    :return: min lon, max lon, min lat, max lat (all None if the file can't be read)
+    """
+    try:
+        with Dataset(avhrr_file, 'r') as avhrr_data:
+            lon = np.ma.compressed(avhrr_data.variables['lon'][:])
+            lat = np.ma.compressed(avhrr_data.variables['lat'][:])
+    except (OSError, KeyError):
+        print('Unable to read the coordinates of {}'.format(avhrr_file))
+        return None, None, None, None
+    if len(lon) == 0 or len(lat) == 0:
+        return None, None, None, None
+    return float(np.min(lon)), float(np.max(lon)), float(np.min(lat)), float(np.max(lat))
+
+
+def open_catalog(db_file, avhrr_dir=None):
+    """
+    Open a pass catalog, refreshing it from a pass directory first if one is given
+    :param db_file: SQLite catalog file (created if it doesn't exist)
+    :param avhrr_dir: optional directory of AVHRR single-pass files to refresh the catalog from
+    :return: PassCatalog
+    """
+    catalog = PassCatalog(db_file)
+    if avhrr_dir is not None:
+        n_updated, n_removed = catalog.refresh(avhrr_dir)
+        print('Pass catalog {}: {} files added or updated, {} removed'.format(db_file, n_updated, n_removed))
+    return catalog
@@ -0,0 +1,380 @@
+#! /usr/bin/env python
+
+import hashlib
+import os
+from collections import OrderedDict
+import numpy as np
+from scipy import sparse
+
+
+def grid_hash(*coords):
+    """
+    Return a hex digest identifying a set of 1D coordinate vectors
+    :param coords: coordinate arrays (e.g. lon, lat)
+    :return: sha1 hex digest
+    """
+    h = hashlib.sha1()
+    for c in coords:
+        c = np.ascontiguousarray(np.ma.filled(c, np.nan), dtype='f8')
+        h.update(str(c.shape).encode())
+        h.update(c.tobytes())
+    return h.hexdigest()
+
+
+def clean_source_grid(lon, lat, data):
+    """
+    Prepare a rectilinear source grid for regridding: masked lon/lat (and the matching rows and columns of data) are
+    removed and the axes are flipped so that lon and lat are ascending
+    :param lon: 1D longitudes, possibly masked
+    :param lat: 1D latitudes, possibly masked
+    :param data: 2D (lat, lon) field
+    :return: lon, lat, data
+    """
+    if np.ma.is_masked(lon):
+        data = data[:, ~lon.mask]
+        lon = lon[~lon.mask]
+    if np.ma.is_masked(lat):
+        data = data[~lat.mask, :]
+        lat = lat[~lat.mask]
+    lon = np.ma.getdata(lon)
+    lat = np.ma.getdata(lat)
+
+    # reverse data array if lat or lon values are descending
+    if lat[0] > lat[-1]:
+        lat = lat[::-1]
+        data = data[::-1, :]
+    if lon[0] > lon[-1]:
+        lon = lon[::-1]
+        data = data[:, ::-1]
+    return lon, lat, data
+
+
+def fractional_index(xin, xout):
+    """
+    Locate output coordinates on an ascending input axis, using the same lookup as basemap.interp (order=1)
+    :param xin: ascending 1D input coordinates
+    :param xout: 1D output coordinates
+    :return: lower cell index, upper cell index and fractional distance between them for each output coordinate
+    """
+    xcoords = np.interp(xout, xin, np.arange(len(xin), dtype='f8'))
+    xi = xcoords.astype(np.int64)
+    delx = xcoords - xi
+    # points that fall exactly on an input coordinate use that cell twice, so that a nan neighbour with no weight
+    # doesn't blank them (basemap.interp would return nan there)
+    xip1 = np.where(delx > 0, np.clip(xi + 1, 0, len(xin) - 1), xi)
+    return xi, xip1, delx
+
+
+def interp_bilinear(datain, xin, yin, xout, yout, out=None):
+    """
+    Bilinear interpolation of a field on a rectilinear grid to another rectilinear grid, a vectorized replacement
+    for basemap.interp (order=1) that takes 1D output coordinates. The input axes may be masked or descending. Output
+    points outside the input grid, or with a nan among the input points they depend on, are nans.
+    :param datain: 2D (yin, xin) field; masked values are treated as nans
+    :param xin: 1D input x coordinates (e.g. lon)
+    :param yin: 1D input y coordinates (e.g. lat)
+    :param xout: 1D output x coordinates
+    :param yout: 1D output y coordinates
+    :param out: optional preallocated (len(yout), len(xout)) array the result is written to, float32 by default
+    :return: 2D (yout, xout) field
+    """
+    xin, yin, datain = clean_source_grid(xin, yin, datain)
+    datain = np.ma.filled(np.ma.asarray(datain, dtype='f4'), np.nan)
+    xout = np.asarray(xout, dtype='f8')
+    yout = np.asarray(yout, dtype='f8')
+    if out is None:
+        out = np.empty((len(yout), len(xout)), dtype='f4')
+    out[:] = np.nan
+
+    inside_x = np.flatnonzero(np.logical_and(xout >= np.min(xin), xout <= np.max(xin)))
+    inside_y = np.flatnonzero(np.logical_and(yout >= np.min(yin), yout <= np.max(yin)))
+    if len(inside_x) == 0 or len(inside_y) == 0:
+        return out
+    xi, xip1, delx = fractional_index(xin, xout[inside_x])
+    yi, yip1, dely = fractional_index(yin, yout[inside_y])
+    delx = delx.astype(out.dtype)
+    dely = dely.astype(out.dtype)[:, None]
+
+    # interpolate along y onto the input columns, then along x onto the output points
+    ydata = (1 - dely) * datain[yi, :] + dely * datain[yip1, :]
+    out[inside_y[:, None], inside_x[None, :]] = (1 - delx) * ydata[:, xi] + delx * ydata[:, xip1]
+    return out
+
+
+class SparseRegridder(object):
+    """
+    Regridding from one rectilinear grid to another stored as a sparse (target points, source pixels) weight matrix,
+    so that regridding a field is a single sparse matrix product. inside_lon and inside_lat flag the target longitudes
+    and latitudes that the source grid covers. The weights, grids and the parameters named in options are saved to and
+    loaded from .npz files (see RegridderCache); subclasses build the weights (from_grids) and apply them (__call__)
+    """
+    options = ()  # names of the constructor parameters that are saved along with the weights
+
+    def __init__(self, weights, inside_lon, inside_lat, src_shape):
+        self.weights = weights
+        self.inside_lon = inside_lon
+        self.inside_lat = inside_lat
+        self.src_shape = tuple(src_shape)
+        self.shape = (len(inside_lat), len(inside_lon))
+
+    @classmethod
+    def load(cls, fname):
+        f = np.load(fname)
+        weights = sparse.csr_matrix((f['data'].astype('f4'), f['indices'], f['indptr']), shape=tuple(f['shape']))
+        options = dict([(name, f[name].item()) for name in cls.options])
+        return cls(weights, f['inside_lon'], f['inside_lat'], f['src_shape'], **options)
+
+    def save(self, fname):
+        # write to a temporary file first so that concurrent readers never see a partial file
+        tmp_file = '{}.{}.tmp.npz'.format(fname[:-len('.npz')], os.getpid())
+        options = dict([(name, getattr(self, name)) for name in self.options])
+        np.savez(tmp_file, data=self.weights.data, indices=self.weights.indices, indptr=self.weights.indptr,
+                 shape=np.array(self.weights.shape), inside_lon=self.inside_lon, inside_lat=self.inside_lat,
+                 src_shape=np.array(self.src_shape), **options)
+        os.replace(tmp_file, fname)
+
+    def source_field(self, data):
+        # float32 source field with nans for masked values, checked against the source grid of the weights
+        data = np.ma.filled(np.ma.asarray(data, dtype='f4'), np.nan)
+        if data.shape != self.src_shape:
+            raise ValueError('Source field shape {} does not match regridder grid {}'.format(data.shape,
+                                                                                             self.src_shape))
+        return data
+
+
+class BilinearRegridder(SparseRegridder):
+    """
+    Bilinear interpolation from one rectilinear grid to another, stored as a sparse weight matrix so that regridding
+    a field is a single sparse matrix-vector product. Target points outside the source grid are returned as nans.
+    """
+
+    @classmethod
+    def from_grids(cls, src_lon, src_lat, dst_lon, dst_lat):
+        """
+        :param src_lon: ascending 1D source longitudes
+        :param src_lat: ascending 1D source latitudes
+        :param dst_lon: 1D target longitudes
+        :param dst_lat: 1D target latitudes
+        """
+        src_lon = np.asarray(src_lon, dtype='f8')
+        src_lat = np.asarray(src_lat, dtype='f8')
+        dst_lon = np.asarray(dst_lon, dtype='f8')
+        dst_lat = np.asarray(dst_lat, dtype='f8')
+        nx = len(src_lon)
+        ny = len(src_lat)
+
+        # only target points within the source grid get weights
+        inside_lon = np.logical_and(dst_lon >= np.min(src_lon), dst_lon <= np.max(src_lon))
+        inside_lat = np.logical_and(dst_lat >= np.min(src_lat), dst_lat <= np.max(src_lat))
+        xi, xip1, delx = fractional_index(src_lon, dst_lon[inside_lon])
+        yi, yip1, dely = fractional_index(src_lat, dst_lat[inside_lat])
+
+        # flattened target index of every inside point
+        rows = (np.flatnonzero(inside_lat)[:, None] * len(dst_lon) + np.flatnonzero(inside_lon)[None, :]).ravel()
+
+        # the four surrounding source cells and their weights
+        corners = [(yi, xi, (1 - dely)[:, None] * (1 - delx)[None, :]),
+                   (yi, xip1, (1 - dely)[:, None] * delx[None, :]),
+                   (yip1, xi, dely[:, None] * (1 - delx)[None, :]),
+                   (yip1, xip1, dely[:, None] * delx[None, :])]
+        all_rows, all_cols, all_w = [], [], []
+        for y, x, w in corners:
+            all_rows.append(rows)
+            all_cols.append((y[:, None] * nx + x[None, :]).ravel())
+            all_w.append(w.ravel())
+
+        # a nan in any surrounding cell with a nonzero weight gives a nan, as with basemap.interp. Weights are
+        # float32, like the SST they are applied to
+        weights = sparse.csr_matrix((np.concatenate(all_w).astype('f4'),
+                                     (np.concatenate(all_rows), np.concatenate(all_cols))),
+                                    shape=(len(dst_lat) * len(dst_lon), ny * nx))
+        return cls(weights, inside_lon, inside_lat, (ny, nx))
+
+    def __call__(self, data, out=None):
+        """
+        :param data: 2D (lat, lon) source field; masked values are treated as nans
+        :param out: optional preallocated array of the target grid shape (e.g. a reused buffer) that the result is
+        written to
+        :return: 2D float32 field on the target grid
+        """
+        data = self.source_field(data)
+        if out is None:
+            out = np.empty(self.shape, dtype='f4')
+        out[:] = self.weights.dot(data.ravel()).reshape(self.shape)
+        out[~self.inside_lat, :] = np.nan
+        out[:, ~self.inside_lon] = np.nan
+        return out
+
+
+def cell_edges(x):
+    """
+    Edges of the cells centered on 1D coordinates: halfway between neighbouring coordinates, and half a cell beyond
+    the first and last coordinate
+    :param x: 1D coordinates (ascending or descending)
+    :return: lower and upper edge of each cell
+    """
+    x = np.asarray(x, dtype='f8')
+    if len(x) < 2:
+        return x.copy(), x.copy()
+    mid = (x[:-1] + x[1:]) / 2
+    edges = np.concatenate([[2 * x[0] - mid[0]], mid, [2 * x[-1] - mid[-1]]])
+    return np.minimum(edges[:-1], edges[1:]), np.maximum(edges[:-1], edges[1:])
+
+
+def overlap_matrix(src_lo, src_hi, dst_lo, dst_hi):
+    """
+    Lengths of the overlaps between two sets of 1D cells
+    :param src_lo: lower edges of the source cells, ascending and contiguous (src_lo[1:] == src_hi[:-1])
+    :param src_hi: upper edges of the source cells
+    :param dst_lo: lower edges of the target cells
+    :param dst_hi: upper edges of the target cells
+    :return: sparse (target cells, source cells) matrix of overlap lengths
+    """
+    src_edges = np.append(src_lo, src_hi[-1])
+    n_src = len(src_lo)
+    # range of source cells that each target cell overlaps
+    i0 = np.clip(np.searchsorted(src_edges, dst_lo, side='right') - 1, 0, n_src)
+    i1 = np.clip(np.searchsorted(src_edges, dst_hi, side='left'), 0, n_src)
+    counts = np.maximum(i1 - i0, 0)
+    rows = np.repeat(np.arange(len(dst_lo)), counts)
+    cols = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(i0, counts)
+    w = np.minimum(src_hi[cols], dst_hi[rows]) - np.maximum(src_lo[cols], dst_lo[rows])
+    keep = w > 0
+    return sparse.csr_matrix((w[keep], (rows[keep], cols[keep])), shape=(len(dst_lo), n_src))
+
+
+class ConservativeRegridder(SparseRegridder):
+    """
+    Conservative (area-weighted) remapping from one rectilinear grid to another: each target cell is the average of
+    all source cells that overlap it, weighted by the overlapping area on the sphere. Unlike bilinear interpolation,
+    which samples the source at the target points, every source pixel contributes, so fine (~1 km) passes can be
+    regridded straight to coarse grids (e.g. the 9 km WRF grid). Missing (nan) source pixels are left out of the
+    average; target cells where less than min_valid of the overlapping area has data, or that don't overlap the source
+    grid, are nans. The overlap areas are a sparse matrix, so regridding a field is one sparse matrix product, as in
+    BilinearRegridder.
+    """
+    options = ('min_valid',)
+
+    def __init__(self, weights, inside_lon, inside_lat, src_shape, min_valid=0.5):
+        super(ConservativeRegridder, self).__init__(weights, inside_lon, inside_lat, src_shape)
+        self.min_valid = min_valid
+        # overlapping area of each target cell, with and without missing source pixels
+        self.area = np.asarray(weights.sum(axis=1), dtype='f4').ravel()
+
+    @classmethod
+    def from_grids(cls, src_lon, src_lat, dst_lon, dst_lat, min_valid=0.5):
+        """
+        :param src_lon: ascending 1D source longitudes
+        :param src_lat: ascending 1D source latitudes
+        :param dst_lon: 1D target longitudes
+        :param dst_lat: 1D target latitudes
+        :param min_valid: fraction of the overlapping area of a target cell that must have data
+        """
+        src_lon_lo, src_lon_hi = cell_edges(src_lon)
+        dst_lon_lo, dst_lon_hi = cell_edges(dst_lon)
+        # the area of a cell is proportional to its width in longitude times its width in sin(latitude)
+        sin_edges = [np.sin(np.radians(np.clip(e, -90, 90))) for e in cell_edges(src_lat) + cell_edges(dst_lat)]
+        wx = overlap_matrix(src_lon_lo, src_lon_hi, dst_lon_lo, dst_lon_hi)
+        wy = overlap_matrix(*sin_edges)
+        inside_lon = np.asarray(wx.sum(axis=1)).ravel() > 0
+        inside_lat = np.asarray(wy.sum(axis=1)).ravel() > 0
+        # target cell (j, i) and source cell (l, k) overlap by wy[j, l] * wx[i, k]; row and column order match the
+        # (lat, lon) ravel of the grids
+        weights = sparse.kron(wy, wx, format='csr').astype('f4')
+        return cls(weights, inside_lon, inside_lat, (len(src_lat), len(src_lon)), min_valid=min_valid)
+
+    def __call__(self, data, out=None):
+        """
+        :param data: 2D (lat, lon) source field; masked values are treated as nans
+        :param out: optional preallocated array of the target grid shape (e.g. a reused buffer) that the result is
+        written to
+        :return: 2D float32 field on the target grid
+        """
+        data = self.source_field(data)
+        if out is None:
+            out = np.empty(self.shape, dtype='f4')
+        # area-weighted sum of the valid pixels and their area, in one pass over the weights
+        valid = np.isfinite(data).ravel()
+        columns = np.empty((len(valid), 2), dtype='f4')
+        columns[:, 0] = np.where(valid, data.ravel(), 0)
+        columns[:, 1] = valid
+        sums = self.weights.dot(columns)
+        has_data = np.logical_and(sums[:, 1] > 0, sums[:, 1] >= self.min_valid * self.area)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out[:] = np.where(has_data, sums[:, 0] / sums[:, 1], np.nan).reshape(self.shape)
+        return out
+
+
+# regridding methods by name, for get_regridder
+REGRIDDERS = dict(bilinear=BilinearRegridder, conservative=ConservativeRegridder)
+
+
+class RegridderCache(object):
+    """
+    Least-recently-used cache of regridders keyed on (method, source grid hash, target grid hash), optionally backed
+    by a directory of weight files so that weights survive between runs
+    """
+    def __init__(self, maxsize=32, cache_dir=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.regridders = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, src_lon, src_lat, dst_lon, dst_lat, method='bilinear'):
+        if method not in REGRIDDERS:
+            raise ValueError('Unknown regridding method {}, expected one of {}'.format(method,
+                                                                                     ', '.join(sorted(REGRIDDERS))))
+        regridder_class = REGRIDDERS[method]
+        key = '{}_{}_{}'.format(method, grid_hash(src_lon, src_lat), grid_hash(dst_lon, dst_lat))
+        if key in self.regridders:
+            self.regridders.move_to_end(key)
+            self.hits += 1
+            return self.regridders[key]
+
+        self.misses += 1
+        regridder = None
+        if self.cache_dir is not None:
+            fname = os.path.join(self.cache_dir, '{}.npz'.format(key))
+            if os.path.isfile(fname):
+                try:
+                    regridder = regridder_class.load(fname)
+                except (OSError, ValueError, KeyError):
+                    regridder = None  # unreadable cache file, rebuild it
+            if regridder is None:
+                regridder = regridder_class.from_grids(src_lon, src_lat, dst_lon, dst_lat)
+                if not os.path.isdir(self.cache_dir):
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                regridder.save(fname)
+        else:
+            regridder = regridder_class.from_grids(src_lon, src_lat, dst_lon, dst_lat)
+
+        self.regridders[key] = regridder
+        if len(self.regridders) > self.maxsize:
+            self.regridders.popitem(last=False)
+        return regridder
+
+
+def template_cache_dir(template_file):
+    # directory next to a composite template in which the weights to its grid are kept, shared by the compositing
+    # scripts so that each grid pair is built and stored once
+    return os.path.join(os.path.dirname(os.path.abspath(template_file)), 'regrid_weights')
+
+
+def get_regridder(src_lon, src_lat, dst_lon, dst_lat, cache_dir=None, method='bilinear'):
+    """
+    Return a cached regridder from a source grid to a target grid
+    :param src_lon: ascending 1D source longitudes
+    :param src_lat: ascending 1D source latitudes
+    :param dst_lon: 1D target longitudes
+    :param dst_lat: 1D target latitudes
+    :param cache_dir: optional directory in which weights are stored between runs
+    :param method: 'bilinear' (BilinearRegridder) or 'conservative' (ConservativeRegridder, for target grids coarser
+    than the source)
+    """
+    if cache_dir not in _caches:
+        _caches[cache_dir] = RegridderCache(cache_dir=cache_dir)
+    return _caches[cache_dir].get(src_lon, src_lat, dst_lon, dst_lat, method=method)
+
+
+_caches = {}
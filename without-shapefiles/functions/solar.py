@@ -0,0 +1,50 @@
+#! /usr/bin/env python
+
+import numpy as np
+
+
+def solar_position(t):
+    """
+    Solar declination and equation of time (NOAA General Solar Position approximations)
+    :param t: datetime (GMT)
+    :return: declination (radians), equation of time (minutes)
+    """
+    doy = t.timetuple().tm_yday
+    gamma = 2 * np.pi / 365 * (doy - 1 + (t.hour - 12) / 24.)
+    eqtime = 229.18 * (0.000075 + 0.001868 * np.cos(gamma) - 0.032077 * np.sin(gamma)
+                       - 0.014615 * np.cos(2 * gamma) - 0.040849 * np.sin(2 * gamma))
+    decl = (0.006918 - 0.399912 * np.cos(gamma) + 0.070257 * np.sin(gamma) - 0.006758 * np.cos(2 * gamma)
+            + 0.000907 * np.sin(2 * gamma) - 0.002697 * np.cos(3 * gamma) + 0.00148 * np.sin(3 * gamma))
+    return decl, eqtime
+
+
+def sin_solar_elevation(lon, lat, t):
+    """
+    Sine of the solar elevation angle on a rectilinear grid. The lat and lon terms are computed on the 1D axes and
+    combined with a single broadcast, so the cost per grid is one array operation
+    :param lon: 1D longitudes (degrees east)
+    :param lat: 1D latitudes (degrees north)
+    :param t: datetime (GMT)
+    :return: 2D (lat, lon) float32 array
+    """
+    decl, eqtime = solar_position(t)
+    lon = np.asarray(lon, dtype='f8')
+    lat = np.radians(np.asarray(lat, dtype='f8'))
+
+    # true solar time (minutes) and hour angle at each longitude
+    tst = t.hour * 60 + t.minute + t.second / 60. + eqtime + 4 * lon
+    cos_ha = np.cos(np.radians(tst / 4 - 180))
+
+    # the 1D terms are float64, the 2D result is float32 like the rest of the compositing
+    sin_term = (np.sin(lat) * np.sin(decl)).astype('f4')
+    cos_term = (np.cos(lat) * np.cos(decl)).astype('f4')
+    return sin_term[:, None] + cos_term[:, None] * cos_ha.astype('f4')[None, :]
+
+
+def sunlit(lon, lat, t, min_sun_angle):
+    """
+    Pixels where the sun is at least min_sun_angle degrees above the horizon (compared in sine space, so no arcsin
+    is needed over the grid)
+    :return: 2D (lat, lon) boolean array
+    """
+    return sin_solar_elevation(lon, lat, t) >= np.sin(np.radians(min_sun_angle))
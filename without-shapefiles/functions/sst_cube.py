@@ -0,0 +1,169 @@
+#! /usr/bin/env python
+
+import multiprocessing as mp
+import numpy as np
+import xarray as xr
+import functions.common as cf
+import functions.grid_index as gi
+import functions.regrid as rg
+
+
+class SSTCube(object):
+    """
+    Satellite SST in a small pixel window around each buoy for every file of a time series, read once so that any
+    averaging option (see functions.common.average_sst_rules) can be evaluated afterwards from memory.
+    sst is (buoy, time, window_y, window_x), nan where there is no data, and dist (buoy, window_y, window_x) is the
+    distance (km) of each pixel of the window from the buoy. Windows are the same size for all buoys; buoys with a
+    smaller window (e.g. at the edge of the grid) are padded with nans, which have a nan distance
+    """
+    def __init__(self, sst, dist, radii, times=None, files=None):
+        self.sst = sst
+        self.dist = dist
+        self.radii = radii
+        self.times = times
+        self.files = files
+
+    def check_radius(self, radius):
+        # the windows only hold the pixels of the averaging options the cube was extracted for
+        dist = gi.parse_radius(radius)
+        limits = [gi.parse_radius(r) for r in self.radii]
+        if (dist is None and None not in limits) or \
+                (dist is not None and dist > max([r for r in limits if r is not None] or [0])):
+            raise ValueError('Averaging option {} needs pixels beyond the windows of the cube (extracted for {})'
+                             .format(radius, ', '.join([str(r) for r in self.radii])))
+
+    def average_rules(self, radii):
+        """
+        SST "at" each buoy and time for several averaging options, each buoy evaluated for all times and options in
+        one call of functions.common.average_sst_rules
+        :param radii: averaging options, within the options the cube was extracted for
+        :return: array of SST (buoy, time, averaging option), nan where there is no data
+        """
+        for radius in radii:
+            self.check_radius(radius)
+        values = np.full(self.sst.shape[:2] + (len(radii),), np.nan)
+        for b in range(self.sst.shape[0]):
+            d = self.dist[b].ravel()
+            in_window = ~np.isnan(d)
+            if in_window.any():
+                sst = self.sst[b].reshape(self.sst.shape[1], -1)[:, in_window]
+                values[b] = cf.average_sst_rules(sst, d[in_window], radii)
+        return values
+
+
+def buoy_windows(satlon, satlat, buoylats, buoylons, radii, index_cache_dir=None):
+    """
+    Pixel window of each buoy: the box that spans the pixels all the averaging options use around it
+    :return: list of (lat slice, lon slice) of the grid, None for buoys without pixels
+    """
+    grid_key = rg.grid_hash(satlon, satlat)
+    windows = []
+    for blat, blon in zip(buoylats, buoylons):
+        tables = [gi.get_neighbour_table(satlon, satlat, blon, blat, radius, cache_dir=index_cache_dir,
+                                         grid_key=grid_key) for radius in radii]
+        rows = np.concatenate([t.rows for t in tables])
+        cols = np.concatenate([t.cols for t in tables])
+        if len(rows) == 0:
+            windows.append(None)
+        else:
+            windows.append((slice(rows.min(), rows.max() + 1), slice(cols.min(), cols.max() + 1)))
+    return windows
+
+
+def read_windows(sat_file, method, sst_varname, grid_key, windows, shape):
+    """
+    Read the window of each buoy from a satellite file
+    :return: array of SST (buoy, window_y, window_x), nans where there is no data or no window
+    """
+    sst = np.full((len(windows),) + shape, np.nan, dtype='f4')
+    satdata = xr.open_dataset(sat_file, mask_and_scale=False)
+    try:
+        if rg.grid_hash(*cf.satellite_grid(satdata, method)) != grid_key:
+            raise ValueError('{} is not on the grid of the first file of the time series'.format(sat_file))
+        for b, w in enumerate(windows):
+            if w is not None:
+                window_sst = cf.satellite_sst(satdata, method, sst_varname, w[0], w[1])
+                sst[b, :window_sst.shape[0], :window_sst.shape[1]] = window_sst
+    finally:
+        satdata.close()
+    return sst
+
+
+_worker = dict()
+
+
+def _init_cube_worker(method, sst_varname, grid_key, windows, shape):
+    _worker.update(method=method, sst_varname=sst_varname, grid_key=grid_key, windows=windows, shape=shape)
+
+
+def _read_file(task):
+    t, sat_file = task
+    try:
+        return t, read_windows(sat_file, _worker['method'], _worker['sst_varname'], _worker['grid_key'],
+                               _worker['windows'], _worker['shape'])
+    except Exception:
+        print('Issue reading from {}'.format(sat_file))
+        return t, None
+
+
+def extract_sst_cube(sat_files, buoylats, buoylons, method, sst_varname, radii=(25, 'closest'), times=None,
+                     workers=4, index_cache_dir=None):
+    """
+    Read the pixels around several buoys from every file of a time series of one satellite product (e.g. the daily
+    coldest pixel composites of a date range), with several files read at a time. All files must be on the same grid
+    :param sat_files: satellite file of each time, None where there is no file
+    :param buoylats: buoy latitudes
+    :param buoylons: buoy longitudes
+    :param method: type of file (see functions.common.extract_satellite_sst)
+    :param sst_varname: name of the SST variable
+    :param radii: averaging options the cube has to support; the window of each buoy spans the pixels of all of them
+    :param times: optional time of each file, kept with the cube
+    :param workers: number of processes reading files (1 reads them in this process)
+    :param index_cache_dir: optional directory in which the neighbour tables are stored between runs
+    :return: SSTCube
+    """
+    tasks = [(t, f) for t, f in enumerate(sat_files) if f is not None]
+
+    # the buoy windows, from the grid of the first file that can be read
+    windows = []
+    grid_key = None
+    for t, f in tasks:
+        try:
+            with xr.open_dataset(f, mask_and_scale=False) as satdata:
+                satlon, satlat = cf.satellite_grid(satdata, method)
+        except Exception:
+            continue
+        grid_key = rg.grid_hash(satlon, satlat)
+        windows = buoy_windows(satlon, satlat, buoylats, buoylons, radii, index_cache_dir=index_cache_dir)
+        break
+
+    ny = max([w[0].stop - w[0].start for w in windows if w is not None] or [0])
+    nx = max([w[1].stop - w[1].start for w in windows if w is not None] or [0])
+    sst = np.full((len(buoylats), len(sat_files), ny, nx), np.nan, dtype='f4')
+    dist = np.full((len(buoylats), ny, nx), np.nan)
+    for b, w in enumerate(windows):
+        if w is not None:
+            lonx, laty = np.meshgrid(satlon[w[1]], satlat[w[0]])
+            dist[b, :lonx.shape[0], :lonx.shape[1]] = gi.haversine_dist(buoylons[b], buoylats[b], lonx, laty)
+
+    if grid_key is not None and ny > 0:
+        initargs = (method, sst_varname, grid_key, windows, (ny, nx))
+        if workers > 1 and len(tasks) > 1:
+            ctx = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else mp.get_context()
+            pool = ctx.Pool(min(workers, len(tasks)), initializer=_init_cube_worker, initargs=initargs)
+            try:
+                results = pool.imap_unordered(_read_file, tasks)
+                for t, values in results:
+                    if values is not None:
+                        sst[:, t] = values
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            _init_cube_worker(*initargs)
+            for task in tasks:
+                t, values = _read_file(task)
+                if values is not None:
+                    sst[:, t] = values
+
+    return SSTCube(sst, dist, list(radii), times=times, files=list(sat_files))
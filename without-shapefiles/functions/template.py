@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+
+import os
+from contextlib import contextmanager
+from netCDF4 import Dataset
+
+
+# chunking and compression of the gridded (..., lat, lon) variables. 'map' stores each daily field as one chunk (fastest
+# for reading whole maps, e.g. plotting), 'point' uses small tiles with light compression so that reading the window
+# around a buoy only decompresses the few tiles it touches, and 'balanced' is in between. chunk is (lat, lon), capped at
+# the grid size; None is the whole grid
+STORAGE_PROFILES = {
+    'map': dict(chunk=None, complevel=4),
+    'point': dict(chunk=(32, 32), complevel=1),
+    'balanced': dict(chunk=(128, 128), complevel=4),
+}
+
+
+def storage_options(profile, shape):
+    """
+    createVariable keyword arguments for a gridded variable stored with one of the STORAGE_PROFILES
+    :param profile: profile name, or None for the netCDF library defaults (zlib level 4, default chunking)
+    :param shape: shape of the variable, with lat and lon as the last two dimensions (unlimited dimensions as 1)
+    :return: dictionary of zlib, complevel, shuffle and chunksizes
+    """
+    if profile is None:
+        return dict(zlib=True, complevel=4, shuffle=True, chunksizes=None)
+    if profile not in STORAGE_PROFILES:
+        raise ValueError('Unknown storage profile {}, expected one of {}'.format(profile,
+                                                                                ', '.join(sorted(STORAGE_PROFILES))))
+    chunk = STORAGE_PROFILES[profile]['chunk']
+    if chunk is None:
+        chunk = shape[-2:]
+    chunksizes = [1] * (len(shape) - 2) + [min(chunk[0], shape[-2]), min(chunk[1], shape[-1])]
+    return dict(zlib=True, complevel=STORAGE_PROFILES[profile]['complevel'], shuffle=True, chunksizes=chunksizes)
+
+
+class CompositeTemplate(object):
+    """
+    In-memory description of a composite template file (see coldest_pixel/ColdestPixelTemplate.py): dimensions,
+    variable definitions and attributes, global attributes and the data of the variables that don't change from one
+    composite to the next (lon, lat, z, mask, platform). New composite files are created from it directly, without
+    copying or re-reading the template file.
+    """
+    def __init__(self, dimensions, variables, global_atts, static_data):
+        self.dimensions = dimensions  # name: length (None for unlimited)
+        self.variables = variables  # list of variable definitions (dicts)
+        self.global_atts = global_atts
+        self.static_data = static_data  # name: data
+
+    @classmethod
+    def from_file(cls, template_file):
+        temp = Dataset(template_file, 'r')
+        dimensions = []
+        for name, dim in temp.dimensions.items():
+            dimensions.append((name, None if dim.isunlimited() else len(dim)))
+
+        variables = []
+        static_data = dict()
+        for name, var in temp.variables.items():
+            atts = var.__dict__.copy()
+            filters = var.filters() or dict()
+            chunking = var.chunking()
+            variables.append(dict(name=name, datatype=var.dtype, dimensions=var.dimensions,
+                                  fill_value=atts.pop('_FillValue', None),
+                                  zlib=filters.get('zlib', False), complevel=filters.get('complevel', 4),
+                                  shuffle=filters.get('shuffle', True),
+                                  chunksizes=None if chunking in (None, 'contiguous') else chunking,
+                                  least_significant_digit=atts.get('least_significant_digit'),
+                                  attributes=atts))
+            # variables without an unlimited dimension are the same in every composite
+            if not any([temp.dimensions[d].isunlimited() for d in var.dimensions]):
+                static_data[name] = var[...]
+
+        global_atts = temp.__dict__.copy()
+        temp.close()
+        return cls(dimensions, variables, global_atts, static_data)
+
+    @contextmanager
+    def new_file(self, out_file, profile=None):
+        """
+        Create a new composite file from the template. The file is written under a temporary name and only moved to
+        out_file (atomic rename) once the block finishes without errors.
+        :param out_file: output file name
+        :param profile: optional storage profile (see STORAGE_PROFILES) for the gridded variables, instead of the
+        chunking and compression of the template
+        :return: open netCDF4 Dataset to fill in
+        """
+        tmp_file = '{}.{}.tmp'.format(out_file, os.getpid())
+        nc = Dataset(tmp_file, 'w', format='NETCDF4')
+        try:
+            for name, size in self.dimensions:
+                nc.createDimension(name, size)
+            sizes = dict([(name, 1 if size is None else size) for name, size in self.dimensions])
+            for v in self.variables:
+                storage = dict(zlib=v['zlib'], complevel=v['complevel'], shuffle=v['shuffle'],
+                               chunksizes=v['chunksizes'])
+                if profile is not None and v['dimensions'][-2:] == ('lat', 'lon'):
+                    storage = storage_options(profile, [sizes[d] for d in v['dimensions']])
+                var = nc.createVariable(v['name'], v['datatype'], v['dimensions'], fill_value=v['fill_value'],
+                                        least_significant_digit=v['least_significant_digit'], **storage)
+                var.setncatts(v['attributes'])
+            nc.setncatts(self.global_atts)
+            for name, data in self.static_data.items():
+                nc.variables[name][...] = data
+
+            yield nc
+        except BaseException:
+            nc.close()
+            os.remove(tmp_file)
+            raise
+        nc.close()
+        os.replace(tmp_file, out_file)
+
+
+def get_template(template_file):
+    """
+    Return the in-memory description of a template file, read once per process (and again if the file changes)
+    """
+    key = (os.path.abspath(template_file), os.path.getmtime(template_file))
+    if key not in _templates:
+        _templates[key] = CompositeTemplate.from_file(template_file)
+    return _templates[key]
+
+
+_templates = {}
@@ -0,0 +1,89 @@
+#! /usr/bin/env python
+"""
+@brief Check the NumPy bilinear regridding (interp_bilinear and BilinearRegridder) against basemap.interp, which the
+compositors used before. The basemap results for the test grids are stored in data/regrid_reference.npz, so the
+comparison also runs where basemap isn't installed
+@usage
+python -m pytest tests (from without-shapefiles)
+"""
+
+import os
+import numpy as np
+import pytest
+import functions.regrid as rg
+
+reference_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'regrid_reference.npz')
+
+# float32 SST, so results are compared to float32 precision
+TOLERANCE = 1e-5
+
+
+def source_grid():
+    """
+    AVHRR-like source grid: descending lon and lat, a masked coordinate in each, and nans and masked values in the SST
+    """
+    rs = np.random.RandomState(0)
+    lon = np.ma.masked_array(np.linspace(-70.0, -76.0, 53))
+    lon[17] = np.ma.masked
+    lat = np.ma.masked_array(np.linspace(42.0, 37.0, 37))
+    lat[30] = np.ma.masked
+    sst = np.ma.masked_array(15 + 10 * rs.rand(37, 53).astype('f4'))
+    sst[rs.rand(37, 53) < 0.1] = np.nan
+    sst[rs.rand(37, 53) < 0.05] = np.ma.masked
+    sst[5:9, 20:30] = np.nan  # a cloud
+    return lon, lat, sst
+
+
+def target_grid():
+    # extends beyond the source grid on every side, with no target point on a source coordinate
+    return np.linspace(-76.7, -69.4, 71), np.linspace(36.3, 42.6, 47)
+
+
+def basemap_regrid(lon, lat, sst, dst_lon, dst_lat):
+    # the regridding of the compositors before basemap was dropped
+    from mpl_toolkits.basemap import interp
+    lon, lat, sst = rg.clean_source_grid(lon, lat, sst)
+    lonx, laty = np.meshgrid(dst_lon, dst_lat)
+    regrid_sst = interp(np.ma.filled(sst.astype('f4'), np.nan), lon, lat, lonx, laty)
+    regrid_sst[lonx > np.max(lon)] = np.nan
+    regrid_sst[lonx < np.min(lon)] = np.nan
+    regrid_sst[laty > np.max(lat)] = np.nan
+    regrid_sst[laty < np.min(lat)] = np.nan
+    return regrid_sst
+
+
+def numpy_regrids():
+    lon, lat, sst = source_grid()
+    dst_lon, dst_lat = target_grid()
+    dense = rg.interp_bilinear(sst, lon, lat, dst_lon, dst_lat)
+    src_lon, src_lat, src_sst = rg.clean_source_grid(lon, lat, sst)
+    sparse = rg.BilinearRegridder.from_grids(src_lon, src_lat, dst_lon, dst_lat)(src_sst)
+    return dense, sparse
+
+
+def check_match(expected, result):
+    assert result.shape == expected.shape
+    assert np.array_equal(np.isnan(result), np.isnan(expected))
+    finite = ~np.isnan(expected)
+    assert finite.any() and np.isnan(expected).any()
+    assert np.max(np.abs(result[finite] - expected[finite])) < TOLERANCE
+
+
+def test_matches_stored_basemap_reference():
+    expected = np.load(reference_file)['regrid_sst']
+    for result in numpy_regrids():
+        check_match(expected, result)
+
+
+def test_matches_basemap_interp():
+    pytest.importorskip('mpl_toolkits.basemap')
+    lon, lat, sst = source_grid()
+    expected = basemap_regrid(lon, lat, sst, *target_grid())
+    for result in numpy_regrids():
+        check_match(expected, result)
+
+
+if __name__ == '__main__':
+    # regenerate the stored reference (needs basemap)
+    lon, lat, sst = source_grid()
+    np.savez_compressed(reference_file, regrid_sst=basemap_regrid(lon, lat, sst, *target_grid()))